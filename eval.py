@@ -18,7 +18,9 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = BASE_DIR
+sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
 sys.path.append(os.path.join(ROOT_DIR, 'models'))
+from pytorch_utils import autocast
 from ap_helper import APCalculator, parse_predictions, parse_groundtruths
 
 parser = argparse.ArgumentParser()
@@ -44,6 +46,11 @@ parser.add_argument('--nms_iou', type=float, default=0.25, help='NMS IoU thresho
 parser.add_argument('--conf_thresh', type=float, default=0.05, help='Filter out predictions with obj prob less than it. [default: 0.05]')
 parser.add_argument('--faster_eval', action='store_true', help='Faster evaluation by skippling empty bounding box removal.')
 parser.add_argument('--shuffle_dataset', action='store_true', help='Shuffle the dataset (random order).')
+parser.add_argument('--amp', action='store_true', help='Run the network under autocast (mixed precision).')
+parser.add_argument('--lean', action='store_true', help='Keep only the final detections during the forward pass (no eval losses), report peak memory.')
+parser.add_argument('--refine_topk', type=int, default=None, help='Match and refine only the top-K proposals by initial objectness (no eval losses) [default: all]')
+parser.add_argument('--refine_thresh', type=float, default=None, help='Match and refine only proposals with initial objectness above this (no eval losses) [default: all]')
+parser.add_argument('--amp_dtype', default='float16', help='Autocast dtype: float16 or bfloat16 [default: float16]')
 FLAGS = parser.parse_args()
 
 if FLAGS.use_cls_nms:
@@ -108,6 +115,9 @@ net = Detector(num_class=DATASET_CONFIG.num_class,
                input_feature_dim=num_input_channel,
                vote_factor=FLAGS.vote_factor,
                sampling=FLAGS.cluster_sampling)
+net.set_lean_inference(FLAGS.lean)
+net.set_refine_pruning(FLAGS.refine_topk, FLAGS.refine_thresh)
+COMPUTE_LOSS = not FLAGS.lean and FLAGS.refine_topk is None and FLAGS.refine_thresh is None
 
 if torch.cuda.device_count() > 1:
     log_string("Let's use %d GPUs!" % (torch.cuda.device_count()))
@@ -121,7 +131,7 @@ optimizer = optim.Adam(net.parameters(), lr=0.001)
 
 # Load checkpoint if there is any
 if CHECKPOINT_PATH is not None and os.path.isfile(CHECKPOINT_PATH):
-    checkpoint = torch.load(CHECKPOINT_PATH)
+    checkpoint = torch.load(CHECKPOINT_PATH, map_location=device)
     checkpoint_multigpu = dict()
     if torch.cuda.device_count() > 1:
         for name, param in checkpoint['model_state_dict'].items():
@@ -155,6 +165,8 @@ def evaluate_one_epoch():
         class2type_map=DATASET_CONFIG.class2type)
 
     net.eval() # set model to eval mode (for bn and dp)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
     for batch_idx, batch_data_label in enumerate(TEST_DATALOADER):
         end_points = {}
         if batch_idx % 10 == 0:
@@ -164,13 +176,14 @@ def evaluate_one_epoch():
         
         # Forward pass
         inputs = {'point_clouds': batch_data_label['point_clouds']}
-        with torch.no_grad():
+        with torch.no_grad(), autocast(FLAGS.amp, FLAGS.amp_dtype):
             end_points = net(inputs, end_points)
 
         # Compute loss
         for key in batch_data_label:
             end_points[key] = batch_data_label[key]
-        loss, end_points = criterion(inputs, end_points, DATASET_CONFIG)
+        if COMPUTE_LOSS:
+            loss, end_points = criterion(inputs, end_points, DATASET_CONFIG)
 
         # Accumulate statistics and print out
         for key in end_points:
@@ -190,6 +203,8 @@ def evaluate_one_epoch():
     # Log statistics
     for key in sorted(stat_dict.keys()):
         log_string('eval mean %s: %f'%(key, stat_dict[key]/(float(batch_idx+1))))
+    if torch.cuda.is_available():
+        log_string('peak GPU memory: %.1f MB' % (torch.cuda.max_memory_allocated() / 2**20))
 
     metrics_dict = ap_calculator.compute_metrics()
     for key in metrics_dict:
@@ -198,6 +213,8 @@ def evaluate_one_epoch():
     for key in metrics_dict:
         log_string('iou = 0.5, eval %s: %f'%(key, metrics_dict[key]))
 
+    if 'loss' not in stat_dict:
+        return None
     mean_loss = stat_dict['loss']/float(batch_idx+1)
     return mean_loss
 
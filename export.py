@@ -0,0 +1,131 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+""" Export a trained HDNet to a TorchScript archive for serving.
+
+The network is wrapped in HDNetInference and traced on a random point cloud,
+the pointnet2 kernels end up in the graph as torch.ops.pointnet2.* calls.
+Only tracing is supported, see HDNetInference.
+Loading the archive needs the compiled pointnet2 library, not this repo:
+
+    torch.ops.load_library('.../pointnet2/_ext.<abi>.so')
+    model = torch.jit.load('hdnet_sunrgbd.pt')
+    outputs = model(point_clouds)  # ordered as hdnet.INFERENCE_OUTPUTS
+
+Sample usage:
+python export.py --dataset sunrgbd --checkpoint_path log_sunrgbd/checkpoint.tar --output hdnet_sunrgbd.pt
+"""
+
+import os
+import sys
+import argparse
+import importlib
+import time
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = BASE_DIR
+sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+from hdnet import HDNetInference, INFERENCE_OUTPUTS
+import pointnet2_utils
+from pytorch_utils import optimize_for_inference
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', default='hdnet', help='Model file name [default: hdnet]')
+parser.add_argument('--dataset', default='sunrgbd', help='Dataset name. sunrgbd or scannet. [default: sunrgbd]')
+parser.add_argument('--checkpoint_path', default=None, help='Model checkpoint path [default: None]')
+parser.add_argument('--output', default=None, help='TorchScript archive to write [default: hdnet_<dataset>.pt]')
+parser.add_argument('--num_point', type=int, default=20000, help='Point Number [default: 20000]')
+parser.add_argument('--num_target', type=int, default=256, help='Proposal number [default: 256]')
+parser.add_argument('--batch_size', type=int, default=1, help='Batch size of the example input [default: 1]')
+parser.add_argument('--vote_factor', type=int, default=1, help='Number of votes generated from each seed [default: 1]')
+parser.add_argument('--cluster_sampling', default='vote_fps', help='Sampling strategy for vote clusters: vote_fps, seed_fps, random [default: vote_fps]')
+parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
+parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
+parser.add_argument('--fuse_backbones', action='store_true', help='Run the 4 backbone towers as one fused backbone.')
+parser.add_argument('--optimize', action='store_true', help='Fold batch norms into the convolutions (and fuse conv+ReLU on CPU) before saving.')
+parser.add_argument('--no_verify', action='store_true', help='Skip reloading the archive and comparing it with the eager model.')
+FLAGS = parser.parse_args()
+if FLAGS.optimize and not hasattr(torch.jit, 'optimize_for_inference'):
+    parser.error('--optimize needs torch.jit.freeze/optimize_for_inference (PyTorch 1.10 or newer)')
+
+if FLAGS.dataset == 'sunrgbd':
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DATASET_CONFIG = SunrgbdDatasetConfig()
+elif FLAGS.dataset == 'scannet':
+    sys.path.append(os.path.join(ROOT_DIR, 'scannet'))
+    from model_util_scannet import ScannetDatasetConfig
+    DATASET_CONFIG = ScannetDatasetConfig()
+else:
+    print('Unknown dataset %s. Exiting...'%(FLAGS.dataset))
+    exit(-1)
+
+OUTPUT = FLAGS.output if FLAGS.output is not None else 'hdnet_%s.pt' % FLAGS.dataset
+
+
+def build_net(device):
+    MODEL = importlib.import_module(FLAGS.model)
+    num_input_channel = int(FLAGS.use_color)*3 + int(not FLAGS.no_height)*1
+    net = MODEL.HDNet(num_class=DATASET_CONFIG.num_class,
+                      num_heading_bin=DATASET_CONFIG.num_heading_bin,
+                      num_size_cluster=DATASET_CONFIG.num_size_cluster,
+                      mean_size_arr=DATASET_CONFIG.mean_size_arr,
+                      num_proposal=FLAGS.num_target,
+                      input_feature_dim=num_input_channel,
+                      vote_factor=FLAGS.vote_factor,
+                      sampling=FLAGS.cluster_sampling)
+    if FLAGS.checkpoint_path is not None and os.path.isfile(FLAGS.checkpoint_path):
+        checkpoint = torch.load(FLAGS.checkpoint_path, map_location='cpu')
+        net.load_state_dict(checkpoint['model_state_dict'])
+        print('Loaded checkpoint %s (epoch: %d)'%(FLAGS.checkpoint_path, checkpoint['epoch']))
+    else:
+        print('No checkpoint given, exporting randomly initialized weights')
+    net.to(device)
+    if FLAGS.fuse_backbones:
+        net.fuse_backbones()
+    net.eval()
+    return net, num_input_channel
+
+
+def export():
+    assert pointnet2_utils.get_backend() == 'ext', 'export needs the compiled pointnet2 kernels'
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    net, num_input_channel = build_net(device)
+    model = HDNetInference(net)
+    traced_model = model
+    if FLAGS.optimize:
+        traced_model, num_folded = optimize_for_inference(model)
+        print('Folded %d batch norms' % num_folded)
+
+    point_clouds = torch.rand(FLAGS.batch_size, FLAGS.num_point, 3 + num_input_channel, device=device)
+    # The trace check reruns the model and compares the outputs, random
+    # cluster sampling draws different proposals on every run
+    with torch.no_grad():
+        traced = torch.jit.trace(traced_model, point_clouds,
+                                 check_trace=(FLAGS.cluster_sampling != 'random'))
+    if FLAGS.optimize and device.type == 'cpu':
+        # freezes the weights and fuses conv+ReLU into mkldnn kernels
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    traced.save(OUTPUT)
+    print('Saved %s' % OUTPUT)
+
+    if FLAGS.no_verify:
+        return
+    loaded = torch.jit.load(OUTPUT, map_location=device)
+    with torch.no_grad():
+        tic = time.time()
+        ref = model(point_clouds)
+        eager_time = time.time() - tic
+        tic = time.time()
+        out = loaded(point_clouds)
+        script_time = time.time() - tic
+    for key, a, b in zip(INFERENCE_OUTPUTS, ref, out):
+        print('%-28s max abs diff %g' % (key, (a.float() - b.float()).abs().max().item()))
+    print('eager %.3fs, torchscript %.3fs (first call, includes graph optimization)' % (eager_time, script_time))
+
+
+if __name__ == '__main__':
+    export()
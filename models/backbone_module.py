@@ -17,6 +17,7 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
 
 from pointnet2_modules import PointnetSAModuleVotes, PointnetSAModuleVotesWith, PointnetFPModule, PointnetPlaneVotes
+import pointnet2_utils
 
 class Pointnet2Backbone(nn.Module):
     r"""
@@ -28,8 +29,14 @@ class Pointnet2Backbone(nn.Module):
        input_feature_dim: int
             Number of input channels in the feature descriptor for each point.
             e.g. 3 for RGB.
+       max_group_elems: int
+            Memory budget of the chunked set abstraction forward, in elements
+            of the grouped activations. None runs every layer in one shot.
+            A layer is only chunked while its batch norms use the running
+            stats (eval, or frozen batch norms when fine-tuning): batch
+            statistics would differ per tile.
     """
-    def __init__(self, input_feature_dim=0):
+    def __init__(self, input_feature_dim=0, max_group_elems=None):
         super().__init__()
 
         self.sa1 = PointnetSAModuleVotes(
@@ -38,7 +45,8 @@ class Pointnet2Backbone(nn.Module):
                 nsample=64,
                 mlp=[input_feature_dim, 64, 64, 128],
                 use_xyz=True,
-                normalize_xyz=True
+                normalize_xyz=True,
+                max_group_elems=max_group_elems
             )
 
         self.sa2 = PointnetSAModuleVotes(
@@ -47,7 +55,8 @@ class Pointnet2Backbone(nn.Module):
                 nsample=32,
                 mlp=[128, 128, 128, 256],
                 use_xyz=True,
-                normalize_xyz=True
+                normalize_xyz=True,
+                max_group_elems=max_group_elems
             )
 
         self.sa3 = PointnetSAModuleVotes(
@@ -56,7 +65,8 @@ class Pointnet2Backbone(nn.Module):
                 nsample=16,
                 mlp=[256, 128, 128, 256],
                 use_xyz=True,
-                normalize_xyz=True
+                normalize_xyz=True,
+                max_group_elems=max_group_elems
             )
 
         self.sa4 = PointnetSAModuleVotes(
@@ -65,7 +75,8 @@ class Pointnet2Backbone(nn.Module):
                 nsample=16,
                 mlp=[256, 128, 128, 256],
                 use_xyz=True,
-                normalize_xyz=True
+                normalize_xyz=True,
+                max_group_elems=max_group_elems
             )
 
         self.fp1 = PointnetFPModule(mlp=[256+256,256,256])
@@ -74,13 +85,13 @@ class Pointnet2Backbone(nn.Module):
     def _break_up_pc(self, pc):
         xyz = pc[..., 0:3].contiguous()
         features = (
-            pc[..., 3:].transpose(1, 2).contiguous()
+            pc[..., 3:].transpose(-1, -2).contiguous()
             if pc.size(-1) > 3 else None
         )
 
         return xyz, features
 
-    def forward(self, pointcloud: torch.cuda.FloatTensor, end_points=None, mode=''):
+    def forward(self, pointcloud: torch.cuda.FloatTensor, end_points=None, mode='', cache=None, offsets=None):
         r"""
             Forward pass of the network
 
@@ -91,6 +102,17 @@ class Pointnet2Backbone(nn.Module):
                 Point cloud to run predicts on
                 Each point in the point-cloud MUST
                 be formated as (x, y, z, features...)
+            cache: pointnet2_utils.GeometryCache
+                Shared by backbones that run on the same pointcloud, so that
+                only the first one computes FPS, ball queries and three_nn
+            offsets: torch.IntTensor
+                (B + 1) offsets of a packed batch (see
+                pointnet2_utils.pack_point_clouds). pointcloud is then
+                (N, 3 + input_feature_dim) with scene i at rows
+                offsets[i]:offsets[i + 1], and sa1_inds index these rows.
+                Every layer after sa1 sees a regular batch. Packing stops at
+                the backbone: HDNet, the datasets and the DataLoader still
+                use fixed size (resampled) scenes.
 
             Returns
             ----------
@@ -100,9 +122,15 @@ class Pointnet2Backbone(nn.Module):
                 XXX-inds: int64 Tensor of shape (B,K) values in [0,N-1]
         """
         if not end_points: end_points = {}
-        batch_size = pointcloud.shape[0]
+        batch_size = pointcloud.shape[0] if offsets is None else offsets.shape[0] - 1
 
-        xyz, features = self._break_up_pc(pointcloud)
+        # Hand the same xyz tensor to every backbone, the cache is keyed on it
+        split_pc = cache.get(('input',), pointcloud) if cache is not None else None
+        if split_pc is None:
+            split_pc = self._break_up_pc(pointcloud)
+            if cache is not None:
+                cache.put(('input',), (pointcloud,), split_pc)
+        xyz, features = split_pc
 
         end_points['sa0_xyz'+mode] = xyz
         end_points['sa0_features'+mode] = features
@@ -110,40 +138,40 @@ class Pointnet2Backbone(nn.Module):
         # --------- 4 SET ABSTRACTION LAYERS ---------
         if mode != '':
             ### Reuse inds from point
-            xyz, features, fps_inds = self.sa1(xyz, features, inds=end_points['sa1_inds'])
+            xyz, features, fps_inds = self.sa1(xyz, features, inds=end_points['sa1_inds'], cache=cache, offsets=offsets)
         else:
-            xyz, features, fps_inds = self.sa1(xyz, features)
+            xyz, features, fps_inds = self.sa1(xyz, features, cache=cache, offsets=offsets)
         end_points['sa1_inds'+mode] = fps_inds
         end_points['sa1_xyz'+mode] = xyz
         end_points['sa1_features'+mode] = features
 
         if mode != '':
-            xyz, features, fps_inds = self.sa2(xyz, features, inds=end_points['sa2_inds']) # this fps_inds is just 0,1,...,1023
+            xyz, features, fps_inds = self.sa2(xyz, features, inds=end_points['sa2_inds'], cache=cache) # this fps_inds is just 0,1,...,1023
         else:
-            xyz, features, fps_inds = self.sa2(xyz, features) # this fps_inds is just 0,1,...,1023
+            xyz, features, fps_inds = self.sa2(xyz, features, cache=cache) # this fps_inds is just 0,1,...,1023
         end_points['sa2_inds'+mode] = fps_inds
         end_points['sa2_xyz'+mode] = xyz
         end_points['sa2_features'+mode] = features
 
         if mode != '':
-            xyz, features, fps_inds = self.sa3(xyz, features, inds=end_points['sa3_inds']) # this fps_inds is just 0,1,...,511
+            xyz, features, fps_inds = self.sa3(xyz, features, inds=end_points['sa3_inds'], cache=cache) # this fps_inds is just 0,1,...,511
         else:
-            xyz, features, fps_inds = self.sa3(xyz, features) # this fps_inds is just 0,1,...,1023
+            xyz, features, fps_inds = self.sa3(xyz, features, cache=cache) # this fps_inds is just 0,1,...,1023
         end_points['sa3_inds'+mode] = fps_inds
         end_points['sa3_xyz'+mode] = xyz
         end_points['sa3_features'+mode] = features
 
         if mode != '':
-            xyz, features, fps_inds = self.sa4(xyz, features, inds=end_points['sa4_inds']) # this fps_inds is just 0,1,...,255
+            xyz, features, fps_inds = self.sa4(xyz, features, inds=end_points['sa4_inds'], cache=cache) # this fps_inds is just 0,1,...,255
         else:
-            xyz, features, fps_inds = self.sa4(xyz, features) # this fps_inds is just 0,1,...,255
+            xyz, features, fps_inds = self.sa4(xyz, features, cache=cache) # this fps_inds is just 0,1,...,255
         end_points['sa4_inds'+mode] = fps_inds
         end_points['sa4_xyz'+mode] = xyz
         end_points['sa4_features'+mode] = features
 
         # --------- 2 FEATURE UPSAMPLING LAYERS --------
-        features = self.fp1(end_points['sa3_xyz'+mode], end_points['sa4_xyz'+mode], end_points['sa3_features'+mode], end_points['sa4_features'+mode])
-        features = self.fp2(end_points['sa2_xyz'+mode], end_points['sa3_xyz'+mode], end_points['sa2_features'+mode], features)
+        features = self.fp1(end_points['sa3_xyz'+mode], end_points['sa4_xyz'+mode], end_points['sa3_features'+mode], end_points['sa4_features'+mode], cache=cache)
+        features = self.fp2(end_points['sa2_xyz'+mode], end_points['sa3_xyz'+mode], end_points['sa2_features'+mode], features, cache=cache)
         end_points['fp2_features'+mode] = features
         end_points['fp2_xyz'+mode] = end_points['sa2_xyz'+mode]
         num_seed = end_points['fp2_xyz'+mode].shape[1]
@@ -250,14 +278,14 @@ class Pointnet2BackboneRefine(nn.Module):
         #center_matching = torch.max(matching.view(batch_size, 18, 256), dim=1)[0]
         center_matching = end_points['match_center']
 
-        center_sem = torch.cuda.FloatTensor(batch_size, 256, 18).zero_()### Need to change to config sem later
+        center_sem = torch.zeros(batch_size, 256, 18, device=pointcloud.device)### Need to change to config sem later
         center_sem.scatter_(2, matching_sem[:,:256].unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_size_cluster)
-        cue_sem = torch.cuda.FloatTensor(batch_size, 256*18, 18).zero_()
+        cue_sem = torch.zeros(batch_size, 256*18, 18, device=pointcloud.device)
         cue_sem.scatter_(2, matching_sem[:,256:].unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_size_cluster)
 
         center_feature = torch.cat(((center_points[:,:,2] - floor_height.unsqueeze(-1)).unsqueeze(1), center_matching.unsqueeze(1), center_sem.transpose(2,1).contiguous()), dim=1) ### Need to make the floor height an option
         cue_feature = torch.cat(((cue_points[:,:,2] - floor_height.unsqueeze(-1)).unsqueeze(1), matching.unsqueeze(1), cue_sem.transpose(2,1).contiguous()), dim=1)
-        other_features = torch.cat((features, torch.cuda.FloatTensor(batch_size, 19, features.shape[-1]).zero_()), dim=1)
+        other_features = torch.cat((features, torch.zeros(batch_size, 19, features.shape[-1], device=features.device)), dim=1)
         
         features = torch.cat((center_feature, cue_feature, other_features), dim=2)
         #features = torch.cat((cue_feature, other_features), dim=2)
@@ -432,6 +460,197 @@ class Pointnet2BackbonePlane(nn.Module):
         end_points['fp2_inds'+mode] = end_points['sa1_inds'+mode][:,0:num_seed] # indices among the entire input point clouds
         return end_points
     
+class _FusedSharedMLP(nn.Sequential):
+    r"""
+       SharedMLP of num_towers towers stacked into grouped 1x1 convolutions.
+       Channels are laid out tower by tower, so tower t owns the slice
+       [t*C, (t+1)*C) of every layer. With shared_input the first layer reads
+       the same input for all towers and is a plain convolution.
+    """
+    def __init__(self, args, num_towers=4, shared_input=False):
+        super().__init__()
+        self.num_towers = num_towers
+        for i in range(len(args) - 1):
+            groups = 1 if (i == 0 and shared_input) else num_towers
+            in_size = args[i] if groups == 1 else args[i] * num_towers
+            layer = nn.Sequential()
+            layer.add_module('conv', nn.Conv2d(in_size, args[i + 1] * num_towers,
+                kernel_size=(1, 1), bias=False, groups=groups))
+            layer.add_module('bn', nn.BatchNorm2d(args[i + 1] * num_towers))
+            layer.add_module('activation', nn.ReLU(inplace=True))
+            self.add_module('layer{}'.format(i), layer)
+
+    def load_tower_state_dicts(self, tower_state_dicts):
+        r"""
+            Stack the SharedMLP state_dicts of the towers (same layer names)
+        """
+        state_dict = {}
+        for key in self.state_dict().keys():
+            layer, module, name = key.split('.')
+            tower_key = '.'.join([layer, module, 'bn', name]) if module == 'bn' else key
+            if name == 'num_batches_tracked':
+                state_dict[key] = tower_state_dicts[0][tower_key]
+            else:
+                state_dict[key] = torch.cat([sd[tower_key] for sd in tower_state_dicts], dim=0)
+        self.load_state_dict(state_dict)
+
+
+class FusedPointnet2Backbone(nn.Module):
+    r"""
+       The four Pointnet2Backbone towers of HDNet executed as one network.
+
+       All towers sample and group the same points (they reuse the FPS
+       indices of the first one), so every SA/FP layer computes its geometry
+       once, gathers the features of all towers with a single grouping call
+       and runs the four MLPs as grouped convolutions. Load the weights of
+       the separate towers with load_tower_state_dict.
+
+       Parameters
+       ----------
+       input_feature_dim: int
+            Number of input channels in the feature descriptor for each point.
+       num_towers: int
+            Number of fused Pointnet2Backbone
+    """
+    MODES = ['', 'net1', 'net2', 'net3']
+    SA_CFG = [  # npoint, radius, nsample, mlp
+        (2048, 0.2, 64, [64, 64, 128]),
+        (1024, 0.4, 32, [128, 128, 256]),
+        (512, 0.8, 16, [128, 128, 256]),
+        (256, 1.2, 16, [128, 128, 256]),
+    ]
+
+    def __init__(self, input_feature_dim=0, num_towers=4):
+        super().__init__()
+        assert num_towers <= len(self.MODES)
+        self.num_towers = num_towers
+        self.modes = self.MODES[:num_towers]
+
+        in_dim = input_feature_dim
+        self.groupers = nn.ModuleList()
+        for k, (npoint, radius, nsample, mlp) in enumerate(self.SA_CFG):
+            self.add_module('sa%d' % (k + 1), _FusedSharedMLP([in_dim + 3] + mlp,
+                num_towers, shared_input=(k == 0)))
+            self.groupers.append(pointnet2_utils.QueryAndGroup(radius, nsample,
+                use_xyz=True, ret_grouped_xyz=True, normalize_xyz=True))
+            in_dim = mlp[-1]
+        self.fp1 = _FusedSharedMLP([256+256,256,256], num_towers)
+        self.fp2 = _FusedSharedMLP([256+256,256,256], num_towers)
+
+    def load_tower_state_dict(self, state_dict, prefixes=None):
+        r"""
+            Parameters
+            ----------
+            state_dict: dict
+                state_dict holding the Pointnet2Backbone towers, e.g. HDNet.state_dict()
+            prefixes: list of str
+                key prefix of each tower [default: backbone_net1. to backbone_net4.]
+        """
+        if prefixes is None:
+            prefixes = ['backbone_net%d.' % (t + 1) for t in range(self.num_towers)]
+        assert len(prefixes) == self.num_towers
+        for name, tower_name in [('sa1', 'sa1.mlp_module'), ('sa2', 'sa2.mlp_module'),
+                                 ('sa3', 'sa3.mlp_module'), ('sa4', 'sa4.mlp_module'),
+                                 ('fp1', 'fp1.mlp'), ('fp2', 'fp2.mlp')]:
+            tower_state_dicts = []
+            for prefix in prefixes:
+                p = prefix + tower_name + '.'
+                tower_state_dicts.append({k[len(p):]: v for k, v in state_dict.items() if k.startswith(p)})
+            getattr(self, name).load_tower_state_dicts(tower_state_dicts)
+
+    def _split(self, features):
+        return features.chunk(self.num_towers, dim=1)
+
+    def _sa(self, k, xyz, features):
+        npoint = self.SA_CFG[k][0]
+        grouper = self.groupers[k]
+        inds = pointnet2_utils.furthest_point_sample(xyz, npoint)
+        new_xyz = pointnet2_utils.gather_operation(
+            xyz.transpose(1, 2).contiguous(), inds
+        ).transpose(1, 2).contiguous()
+        idx, _ = grouper.query(xyz, new_xyz)
+        if k == 0:
+            # Same input for all towers
+            grouped = grouper(xyz, new_xyz, features, idx=idx)[0]  # (B, 3+C, npoint, nsample)
+        else:
+            grouped_xyz = pointnet2_utils.grouping_operation(xyz.transpose(1, 2).contiguous(), idx)
+            grouped_xyz -= new_xyz.transpose(1, 2).unsqueeze(-1)
+            grouped_xyz /= grouper.radius
+            grouped_features = pointnet2_utils.grouping_operation(features, idx)  # (B, T*C, npoint, nsample)
+            # Every tower gets its own copy of the local xyz in front of its features
+            B, _, _, nsample = grouped_features.shape
+            grouped = torch.cat([
+                grouped_xyz.unsqueeze(1).expand(B, self.num_towers, 3, npoint, nsample),
+                grouped_features.view(B, self.num_towers, -1, npoint, nsample)
+            ], dim=2).view(B, -1, npoint, nsample)  # (B, T*(3+C), npoint, nsample)
+        new_features = getattr(self, 'sa%d' % (k + 1))(grouped)
+        new_features = F.max_pool2d(new_features, kernel_size=[1, new_features.size(3)]).squeeze(-1)
+        return new_xyz, new_features, inds
+
+    def _fp(self, mlp, unknown, known, unknow_feats, known_feats):
+        dist, idx = pointnet2_utils.three_nn(unknown, known)
+        dist_recip = 1.0 / (dist + 1e-8)
+        norm = torch.sum(dist_recip, dim=2, keepdim=True)
+        weight = dist_recip / norm
+        interpolated_feats = pointnet2_utils.three_interpolate(known_feats, idx, weight)
+        B, _, n = interpolated_feats.shape
+        new_features = torch.cat([interpolated_feats.view(B, self.num_towers, -1, n),
+                                  unknow_feats.view(B, self.num_towers, -1, n)], dim=2)
+        new_features = mlp(new_features.view(B, -1, n, 1))
+        return new_features.squeeze(-1)
+
+    def _break_up_pc(self, pc):
+        xyz = pc[..., 0:3].contiguous()
+        features = (
+            pc[..., 3:].transpose(1, 2).contiguous()
+            if pc.size(-1) > 3 else None
+        )
+
+        return xyz, features
+
+    def forward(self, pointcloud: torch.cuda.FloatTensor, end_points=None):
+        r"""
+            Forward pass of the network
+
+            Parameters
+            ----------
+            pointcloud: Variable(torch.cuda.FloatTensor)
+                (B, N, 3 + input_feature_dim) tensor
+
+            Returns
+            ----------
+            end_points: the keys of Pointnet2Backbone for every tower,
+                suffixed with '', 'net1', 'net2' and 'net3'
+        """
+        if not end_points: end_points = {}
+
+        xyz, features = self._break_up_pc(pointcloud)
+        for mode in self.modes:
+            end_points['sa0_xyz'+mode] = xyz
+            end_points['sa0_features'+mode] = features
+
+        # --------- 4 SET ABSTRACTION LAYERS ---------
+        fused_features = []  # (B, num_towers*C, K) output of every SA layer
+        for k in range(len(self.SA_CFG)):
+            xyz, features, fps_inds = self._sa(k, xyz, features)
+            fused_features.append(features)
+            for mode, tower_features in zip(self.modes, self._split(features)):
+                end_points['sa%d_inds' % (k + 1) + mode] = fps_inds
+                end_points['sa%d_xyz' % (k + 1) + mode] = xyz
+                end_points['sa%d_features' % (k + 1) + mode] = tower_features
+
+        # --------- 2 FEATURE UPSAMPLING LAYERS --------
+        features = self._fp(self.fp1, end_points['sa3_xyz'], end_points['sa4_xyz'],
+                            fused_features[2], fused_features[3])
+        features = self._fp(self.fp2, end_points['sa2_xyz'], end_points['sa3_xyz'],
+                            fused_features[1], features)
+        num_seed = end_points['sa2_xyz'].shape[1]
+        for mode, tower_features in zip(self.modes, self._split(features)):
+            end_points['fp2_features'+mode] = tower_features
+            end_points['fp2_xyz'+mode] = end_points['sa2_xyz']
+            end_points['fp2_inds'+mode] = end_points['sa1_inds'][:,0:num_seed] # indices among the entire input point clouds
+        return end_points
+
 if __name__=='__main__':
     backbone_net = Pointnet2Backbone(input_feature_dim=3).cuda()
     print(backbone_net)
@@ -439,3 +658,16 @@ if __name__=='__main__':
     out = backbone_net(torch.rand(4,8192,6).cuda())
     for key in sorted(out.keys()):
         print(key, '\t', out[key].shape)
+
+    # Fused towers must match four separate backbones
+    towers = nn.ModuleDict({'backbone_net%d'%(t+1): Pointnet2Backbone(input_feature_dim=3) for t in range(4)}).cuda().eval()
+    fused = FusedPointnet2Backbone(input_feature_dim=3).cuda().eval()
+    fused.load_tower_state_dict(towers.state_dict())
+    pc = torch.rand(4,8192,6).cuda()
+    with torch.no_grad():
+        ref = towers['backbone_net1'](pc)
+        for t, mode in enumerate(['net1', 'net2', 'net3']):
+            ref = towers['backbone_net%d'%(t+2)](pc, ref, mode=mode)
+        out = fused(pc)
+    for mode in FusedPointnet2Backbone.MODES:
+        print('fp2_features'+mode, (ref['fp2_features'+mode] - out['fp2_features'+mode]).abs().max().item())
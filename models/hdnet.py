@@ -20,7 +20,8 @@ sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 import pc_util
 
-from backbone_module import Pointnet2Backbone
+from backbone_module import Pointnet2Backbone, FusedPointnet2Backbone
+from pointnet2_utils import GeometryCache
 from voting_module import VotingModule
 
 from proposal_module_refine import ProposalModuleRefine
@@ -46,10 +47,19 @@ class HDNet(nn.Module):
             Number of proposals/detections generated from the network. Each proposal is a 3D OBB with a semantic class.
         vote_factor: (default: 1)
             Number of votes generated from each seed point.
+        share_geometry: bool (default: True)
+            Compute FPS, ball queries and interpolation weights once and share them between the 4 backbone towers.
+        max_group_elems: int (default: None)
+            Memory budget of the chunked set abstraction forward of the backbones, see Pointnet2Backbone.
+            Applies at eval time and when training with freeze_backbone_bn().
     """
 
+    # Per tower backbone outputs, only fp2_* is read after the backbone
+    BACKBONE_KEYS = ['sa%d_%s' % (k, name) for k in range(5) for name in ('xyz', 'features', 'inds')]
+
     def __init__(self, num_class, num_heading_bin, num_size_cluster, mean_size_arr,
-        input_feature_dim=0, num_proposal=128, vote_factor=1, sampling='vote_fps', with_angle=False):
+        input_feature_dim=0, num_proposal=128, vote_factor=1, sampling='vote_fps', with_angle=False, share_geometry=True,
+        max_group_elems=None):
         super().__init__()
 
         self.num_class = num_class
@@ -60,12 +70,16 @@ class HDNet(nn.Module):
         self.num_proposal = num_proposal
         self.vote_factor = vote_factor
         self.sampling=sampling
+        self.share_geometry = share_geometry
 
         # Backbone point feature learning: 4 bb tower
-        self.backbone_net1 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim) ### Just xyz + height
-        self.backbone_net2 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim) ### Just xyz + height
-        self.backbone_net3 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim) ### Just xyz + height
-        self.backbone_net4 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim) ### Just xyz + height
+        self.backbone_net1 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim, max_group_elems=max_group_elems) ### Just xyz + height
+        self.backbone_net2 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim, max_group_elems=max_group_elems) ### Just xyz + height
+        self.backbone_net3 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim, max_group_elems=max_group_elems) ### Just xyz + height
+        self.backbone_net4 = Pointnet2Backbone(input_feature_dim=self.input_feature_dim, max_group_elems=max_group_elems) ### Just xyz + height
+        self.backbone_fused = None # set by fuse_backbones()
+        self.lean_inference = False # set by set_lean_inference()
+        self.frozen_backbone_bn = False # set by freeze_backbone_bn()
 
         ### Feature concatenation
         self.conv_agg1 = torch.nn.Conv1d(256*4,256*2,1) 
@@ -103,6 +117,62 @@ class HDNet(nn.Module):
         self.pnet_final = ProposalModuleRefine(num_class, num_heading_bin, num_size_cluster,
                                    mean_size_arr, num_proposal, sampling, seed_feat_dim=256, with_angle=with_angle)
         
+    def fuse_backbones(self):
+        """ Run the 4 backbone towers as one FusedPointnet2Backbone.
+
+        Copies the current tower weights, so call it after loading a checkpoint.
+        Meant for inference: the towers are kept but no longer used, and
+        state_dict() holds them plus the backbone_fused.* copy.
+        """
+        self.backbone_fused = FusedPointnet2Backbone(input_feature_dim=self.input_feature_dim)
+        self.backbone_fused.load_tower_state_dict(self.state_dict())
+        self.backbone_fused.to(self.conv_agg1.weight.device)
+        return self
+
+    def freeze_backbone_bn(self, enabled=True):
+        """ Keep the batch norms of the backbone towers in eval mode during training.
+
+        They then normalize with their running stats and stop updating them,
+        which is what lets the backbones run chunked (max_group_elems) while
+        training. Meant for fine-tuning from a trained checkpoint.
+        """
+        self.frozen_backbone_bn = enabled
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.frozen_backbone_bn:
+            for backbone in [self.backbone_net1, self.backbone_net2, self.backbone_net3, self.backbone_net4]:
+                for m in backbone.modules():
+                    if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                        m.eval()
+        return self
+
+    def set_lean_inference(self, enabled=True):
+        """ Keep only the final detections (INFERENCE_OUTPUTS) in end_points at eval time.
+
+        Backbone, voting and primitive intermediates are dropped from end_points
+        as soon as the next stage has consumed them, which lowers the peak memory
+        of a no_grad forward. get_loss and dump_results need the full dict, so
+        leave this off when computing losses or dumping results.
+        """
+        self.lean_inference = enabled
+        return self
+
+    def set_refine_pruning(self, topk=None, thresh=None):
+        """ Match and refine only the top-K proposals by initial objectness at eval time.
+
+        See ProposalModuleRefine.set_refine_pruning. The cost of the matching and
+        refinement stage scales with K instead of num_proposal; get_loss cannot
+        run on the outputs.
+        """
+        self.pnet_final.set_refine_pruning(topk, thresh)
+        return self
+
+    def _drop(self, end_points, keys):
+        for key in keys:
+            end_points.pop(key, None)
+
     def forward(self, inputs, end_points, mode=""):
         """ Forward pass of the network
 
@@ -119,11 +189,23 @@ class HDNet(nn.Module):
             end_points: dict
         """
         batch_size = inputs['point_clouds'].shape[0]
+        lean = self.lean_inference and not self.training
+        tower_modes = ['', 'net1', 'net2', 'net3']
 
-        end_points = self.backbone_net1(inputs['point_clouds'], end_points)
-        end_points = self.backbone_net2(inputs['point_clouds'], end_points, mode='net1')
-        end_points = self.backbone_net3(inputs['point_clouds'], end_points, mode='net2')
-        end_points = self.backbone_net4(inputs['point_clouds'], end_points, mode='net3')
+        if self.backbone_fused is not None:
+            end_points = self.backbone_fused(inputs['point_clouds'], end_points)
+        else:
+            # The towers see the same points, share their neighborhoods
+            cache = GeometryCache() if self.share_geometry else None
+            end_points = self.backbone_net1(inputs['point_clouds'], end_points, cache=cache)
+            for backbone, tower_mode in zip([self.backbone_net2, self.backbone_net3, self.backbone_net4], tower_modes[1:]):
+                end_points = backbone(inputs['point_clouds'], end_points, mode=tower_mode, cache=cache)
+                if lean:
+                    # sa*_inds of the first tower are reused by the next ones
+                    self._drop(end_points, [key+tower_mode for key in self.BACKBONE_KEYS])
+            cache = None
+        if lean:
+            self._drop(end_points, [key+tower_mode for key in self.BACKBONE_KEYS for tower_mode in tower_modes])
 
         ### Extract feature here
         xyz = end_points['fp2_xyz']  # (B, 1024, 3)
@@ -137,6 +219,10 @@ class HDNet(nn.Module):
         
         ### Combine the feature here
         features_hd_discriptor = torch.cat((features1, features2, features3, features4), dim=1)
+        del features1, features2, features3, features4
+        if lean:
+            self._drop(end_points, ['fp2_'+name+tower_mode for name in ('xyz', 'features', 'inds') for tower_mode in tower_modes])
+            self._drop(end_points, ['seed_features'])
         features_hd_discriptor = F.relu(self.bn_agg1(self.conv_agg1(features_hd_discriptor)))
         features_hd_discriptor = F.relu(self.bn_agg2(self.conv_agg2(features_hd_discriptor)))
 
@@ -188,7 +274,86 @@ class HDNet(nn.Module):
         center_z, feature_z, end_points = self.pnet_z(voted_z, voted_z_feature, end_points, mode='_z')
         center_xy, feature_xy, end_points = self.pnet_xy(voted_xy, voted_xy_feature, end_points, mode='_xy')
         center_line, feature_line, end_points = self.pnet_line(voted_line, voted_line_feature, end_points, mode='_line')
+        if lean:
+            del features_hd_discriptor, voted_z_feature, voted_xy_feature, voted_line_feature
+            self._drop(end_points, ['hd_feature', 'vote_features', 'vote_z_feature', 'vote_xy_feature', 'vote_line_feature',
+                                    'aggregated_feature_z', 'aggregated_feature_xy', 'aggregated_feature_line'])
 
         end_points = self.pnet_final(proposal_xyz, proposal_features, center_z, feature_z, center_xy, feature_xy, center_line, feature_line, end_points)
+        if lean:
+            self._drop(end_points, [key for key in list(end_points.keys()) if key not in INFERENCE_OUTPUTS])
+        return end_points
+
+
+# Final detections read by ap_helper.parse_predictions, in the order
+# returned by HDNetInference.
+INFERENCE_OUTPUTS = ('center'+'opt',
+                     'heading_scores'+'center', 'heading_residuals'+'center', 'heading_residuals'+'opt',
+                     'size_scores'+'center', 'size_residuals'+'opt',
+                     'sem_cls_scores'+'center', 'sem_cls_scores'+'opt',
+                     'objectness_scores'+'opt')
+
+
+class HDNetInference(nn.Module):
+    r"""
+        Export view of HDNet: takes the point cloud tensor and returns the final
+        detections as a fixed tuple of tensors (see INFERENCE_OUTPUTS) instead of
+        the end_points dict, so the model can be traced into a TorchScript archive.
+        While tracing, the pointnet2 kernels are recorded as torch.ops.pointnet2.*
+        calls; load the archive after torch.ops.load_library(<pointnet2 _ext library>).
+
+        Trace it, do not script it: HDNet passes an end_points dict with
+        computed keys and numpy constants that TorchScript cannot compile,
+        and pointnet2_utils only switches to torch.ops while
+        torch.jit.is_tracing(), a scripted graph would keep the autograd
+        Functions of _ext.
+
+        Parameters
+        ----------
+        net: HDNet
+            Trained network, in eval mode.
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, point_clouds):
+        # type: (torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
+        end_points = self.net({'point_clouds': point_clouds}, {})
+        return tuple(end_points[key] for key in INFERENCE_OUTPUTS)
+
+    @staticmethod
+    def to_end_points(outputs, end_points=None):
+        """ Map the output tuple back to end_points keys for parse_predictions. """
+        end_points = {} if end_points is None else end_points
+        for key, value in zip(INFERENCE_OUTPUTS, outputs):
+            end_points[key] = value
         return end_points
 
+
+if __name__=='__main__':
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DC = SunrgbdDatasetConfig()
+    net = HDNet(DC.num_class, DC.num_heading_bin, DC.num_size_cluster, DC.mean_size_arr,
+                input_feature_dim=1, num_proposal=256).cuda().eval()
+
+    # Standard eval batch: 8 scenes of 20000 points, xyz + height
+    pc = torch.rand(8, 20000, 4).cuda()
+    outputs = {}
+    for lean in [False, True]:
+        net.set_lean_inference(lean)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        with torch.no_grad():
+            end_points = net({'point_clouds': pc}, {})
+        peak = torch.cuda.max_memory_allocated() - base
+        held = torch.cuda.memory_allocated() - base
+        print('lean=%d: peak %.1f MB, held by end_points %.1f MB (%d keys)' % (
+            lean, peak / 2**20, held / 2**20, len(end_points)))
+        outputs[lean] = [end_points[key] for key in INFERENCE_OUTPUTS]
+        del end_points
+    for key, a, b in zip(INFERENCE_OUTPUTS, outputs[False], outputs[True]):
+        print(key, (a - b).abs().max().item())
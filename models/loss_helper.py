@@ -113,41 +113,129 @@ def compute_primitive_center_loss(end_points, mode='_z'):
     vote_loss = torch.sum(votes_dist*seed_gt_votes_mask.float())/(torch.sum(seed_gt_votes_mask.float())+1e-6)
     return vote_loss
 
-def compute_proposal_loss(end_points, mode=''):
-    """ Compute objectness loss for the initial proposal 
-    and also find the initial proposal with detected primitives
-    """ 
-    # Associate proposal and GT objects by point-to-point distances
-    gt_center = end_points['center_label'][:,:,0:3]
-    B = gt_center.shape[0]
-    K2 = gt_center.shape[1]
-    
-    aggregated_vote_xyz = end_points['aggregated_vote_xyz'+'center'] ### Vote xyz is the same for all
-    K = aggregated_vote_xyz.shape[1]
+def compute_vote_losses(end_points):
+    """ compute_vote_loss and compute_primitive_center_loss for '_z', '_xy'
+    and '_line' in one pass.
+
+    The votes of the four heads are stacked into (4,B,num_seed,vote_factor,3)
+    and their GT votes into (4,B,num_seed,GT_VOTE_FACTOR,3), the single GT
+    offset of a primitive branch is repeated, which leaves the min unchanged.
+    Every masked min-L1 loss then comes from one pairwise L1 and one min.
+
+    Args:
+        end_points: dict (read-only)
+
+    Returns:
+        vote_losses: (4,) Tensor, the vote loss and the '_z', '_xy', '_line'
+            primitive center losses (without the loss weights)
+    """
+    seed_xyz = end_points['seed_xyz']
+    batch_size, num_seed = seed_xyz.shape[0:2]
+    seed_inds = end_points['seed_inds'].long() # B,num_seed in [0,num_points-1]
+    seed_inds_expand = seed_inds.unsqueeze(-1).expand(-1,-1,3*GT_VOTE_FACTOR)
+
+    # (4, B, num_seed, vote_factor, 3)
+    vote_xyz = torch.stack([end_points[key].view(batch_size, num_seed, -1, 3)
+                            for key in ('vote_xyz', 'vote_z', 'vote_xy', 'vote_line')])
+    # GT offsets of the seed points, (B, num_seed, GT_VOTE_FACTOR*3) for every branch
+    gt_offsets = [torch.gather(end_points['vote_label'], 1, seed_inds_expand)]
+    masks = [end_points['vote_label_mask'].float()]
+    for key, mask_key in [('point_boundary_offset_z', 'point_boundary_mask_z'),
+                          ('point_boundary_offset_xy', 'point_boundary_mask_xy'),
+                          ('point_line_offset', 'point_line_mask')]:
+        gt_offsets.append(torch.gather(end_points[key], 1, seed_inds_expand[:,:,0:3]).repeat(1,1,GT_VOTE_FACTOR))
+        masks.append(end_points[mask_key].float())
+    # (4, B, num_seed, GT_VOTE_FACTOR, 3)
+    seed_gt_votes = (torch.stack(gt_offsets) + seed_xyz.repeat(1,1,GT_VOTE_FACTOR)).view(4, batch_size, num_seed, GT_VOTE_FACTOR, 3)
+    seed_gt_votes_mask = torch.gather(torch.stack(masks), 2, seed_inds.unsqueeze(0).expand(4,-1,-1)) # (4, B, num_seed)
+
+    # A predicted vote to no where is not penalized as long as there is a good vote near the GT vote.
+    votes_dist = torch.sum(torch.abs(vote_xyz.unsqueeze(4) - seed_gt_votes.unsqueeze(3)), dim=-1) # (4, B, num_seed, vote_factor, GT_VOTE_FACTOR)
+    votes_dist = votes_dist.view(4, batch_size, num_seed, -1).min(dim=-1)[0] # (4, B, num_seed)
+    return torch.sum(votes_dist*seed_gt_votes_mask, dim=(1,2))/(torch.sum(seed_gt_votes_mask, dim=(1,2))+1e-6)
 
-    dist1, ind1, dist2, _ = nn_distance(aggregated_vote_xyz, gt_center) # dist1: BxK, dist2: BxK2
+class GTAssignment(object):
+    """ Proposal to GT matching of one training step.
 
-    # Set assignment
-    object_assignment = ind1 # (B,K) with values in 0,1,...,K2-1
+    Computed once in get_loss from the initial proposals (aggregated_vote_xyzcenter,
+    the same for all stages) and shared by the loss terms: the assignment, the
+    objectness labels and masks, the GT labels gathered per proposal and the
+    GT surface/line centers. The primitive centers are taken per GT box from
+    the dataset (gt_surface_center, gt_line_center; computed here if missing)
+    and gathered per proposal, proposals assigned to the same box share them.
 
-    # Generate objectness label and mask
-    # objectness_label: 1 if pred object center is within NEAR_THRESHOLD of any GT object
-    # objectness_mask: 0 if pred object center is in gray zone (DONOTCARE), 1 otherwise
-    euclidean_dist1 = torch.sqrt(dist1+1e-6)
-    objectness_label = torch.zeros((B,K), dtype=torch.long).cuda()
-    objectness_mask = torch.zeros((B,K)).cuda()
+    Args:
+        end_points: dict (read-only)
+    """
+    def __init__(self, end_points):
+        self.end_points = end_points
+        gt_center = end_points['center_label'][:,:,0:3]
+        aggregated_vote_xyz = end_points['aggregated_vote_xyz'+'center']
+        B, K = aggregated_vote_xyz.shape[0:2]
+        self.num_gt = gt_center.shape[1]
+
+        with torch.no_grad():
+            dist1, ind1, _, _ = nn_distance(aggregated_vote_xyz, gt_center) # dist1: BxK
+        self.object_assignment = ind1 # (B,K) with values in 0,1,...,K2-1
+
+        # Generate objectness label and mask
+        # objectness_label: 1 if pred object center is within NEAR_THRESHOLD of any GT object
+        # objectness_mask: 0 if pred object center is in gray zone (DONOTCARE), 1 otherwise
+        euclidean_dist1 = torch.sqrt(dist1+1e-6)
+        self.objectness_label = torch.zeros((B,K), dtype=torch.long, device=aggregated_vote_xyz.device)
+        self.objectness_mask = torch.zeros((B,K), device=aggregated_vote_xyz.device)
+        self.objectness_label[euclidean_dist1<NEAR_THRESHOLD] = 1
+        self.objectness_mask[euclidean_dist1<NEAR_THRESHOLD] = 1
+        self.objectness_mask[euclidean_dist1>FAR_THRESHOLD] = 1
+
+        # GT primitives of every GT box, (B, 6*K2, 3), (B, 12*K2, 3). The datasets
+        # emit them per box as (B, K2, 6, 3), (B, K2, 12, 3); reorder surface-major
+        if 'gt_surface_center' in end_points:
+            self.gt_surface_center = end_points['gt_surface_center'].transpose(1,2).reshape(B, 6*self.num_gt, 3)
+            self.gt_line_center = end_points['gt_line_center'].transpose(1,2).reshape(B, 12*self.num_gt, 3)
+        else:
+            self.gt_surface_center, self.gt_line_center = get_surface_line_points_batch_pytorch(
+                end_points['size_label'], end_points['heading_label'], gt_center)
+        self._labels = {}
+
+    def label(self, key):
+        """ end_points[key] (B,K2) or (B,K2,C) gathered per proposal, cached """
+        if key not in self._labels:
+            x = self.end_points[key]
+            inds = self.object_assignment
+            if x.dim() == 3:
+                inds = inds.unsqueeze(-1).expand(-1,-1,x.shape[2])
+            self._labels[key] = torch.gather(x, 1, inds) # select (B,K) from (B,K2)
+        return self._labels[key]
+
+    def per_proposal(self, x, num):
+        """ (B, num*K2, ...) primitive values of the GT boxes -> (B, num*K, ...)
+        for the proposals, in the layout of get_surface_line_points_batch_pytorch """
+        B, K = self.object_assignment.shape
+        rest = x.shape[2:]
+        inds = self.object_assignment.view((B, 1, K) + (1,)*len(rest)).expand((B, num, K) + rest)
+        return torch.gather(x.view((B, num, self.num_gt) + rest), 2, inds).view((B, num*K) + rest)
+
+
+def compute_proposal_loss(end_points, assignment, mode=''):
+    """ Compute objectness loss for the initial proposal 
+    and also find the initial proposal with detected primitives
+    """ 
+    object_assignment = assignment.object_assignment # (B,K) with values in 0,1,...,K2-1
+    objectness_label = assignment.objectness_label
+    objectness_mask = assignment.objectness_mask
+    B, K = object_assignment.shape
+    aggregated_vote_xyz = end_points['aggregated_vote_xyz'+'center']
     
     ### Get the corresponding proposal with detected object proposal
     if mode == 'opt':
-        obj_center = torch.gather(end_points['center_label'], 1, object_assignment.unsqueeze(-1).repeat(1,1,3))
-        gt_size = torch.gather(end_points['size_label'], 1, object_assignment.unsqueeze(-1).repeat(1,1,3)) # select (B,K) from (B,K2)
-        gt_heading = torch.gather(end_points['heading_label'], 1, object_assignment) # select (B,K) from (B,K2)
-        gt_sem = torch.gather(end_points['sem_cls_label'], 1, object_assignment) # select (B,K) from (B,K2)
+        gt_sem = assignment.label('sem_cls_label') # select (B,K) from (B,K2)
         end_points['selected_sem'] = gt_sem
         
         ### gt for primitive matching
         # (B, 6*N, 3), (B, 12*N, 3)
-        obj_surface_center, obj_line_center = get_surface_line_points_batch_pytorch(gt_size, gt_heading, obj_center)
+        obj_surface_center = assignment.per_proposal(assignment.gt_surface_center, 6)
+        obj_line_center = assignment.per_proposal(assignment.gt_line_center, 12)
 
         # (B, 2*1024, 3), (B, 1024, 3)
         pred_surface_center = end_points['surface_center_pred']
@@ -162,8 +250,11 @@ def compute_proposal_loss(end_points, mode=''):
         line_sem = torch.argmax(end_points['line_sem_pred'], dim=2).float()
 
         # GT primitives & predicted primitives (GT primitive到最近的predicted primitive距离)
-        dist_surface, surface_ind, _, _ = nn_distance(obj_surface_center, pred_surface_center)
-        dist_line, line_ind, _, _ = nn_distance(obj_line_center, pred_line_center)
+        # searched once per GT box, (B, 6*K2) and (B, 12*K2), then gathered per proposal
+        dist_surface, surface_ind, _, _ = nn_distance(assignment.gt_surface_center, pred_surface_center)
+        dist_line, line_ind, _, _ = nn_distance(assignment.gt_line_center, pred_line_center)
+        dist_surface, surface_ind = assignment.per_proposal(dist_surface, 6), assignment.per_proposal(surface_ind, 6)
+        dist_line, line_ind = assignment.per_proposal(dist_line, 12), assignment.per_proposal(line_ind, 12)
 
         # (B, 6*N, 3) 选出的predicted primitive都是距离某个GT primitive最近的点
         surface_sel = torch.gather(pred_surface_center, 1, surface_ind.unsqueeze(-1).repeat(1,1,3))
@@ -182,22 +273,17 @@ def compute_proposal_loss(end_points, mode=''):
         
         euclidean_dist_surface = torch.sqrt(dist_surface+1e-6)
         euclidean_dist_line = torch.sqrt(dist_line+1e-6)
-        objectness_label_surface = torch.zeros((B,K*6), dtype=torch.long).cuda()
-        objectness_mask_surface = torch.zeros((B,K*6)).cuda()
-        objectness_label_line = torch.zeros((B,K*12), dtype=torch.long).cuda()
-        objectness_mask_line = torch.zeros((B,K*12)).cuda()
-        objectness_label_surface_sem = torch.zeros((B,K*6), dtype=torch.long).cuda()
-        objectness_label_line_sem = torch.zeros((B,K*12), dtype=torch.long).cuda()
+        objectness_label_surface = torch.zeros((B,K*6), dtype=torch.long, device=aggregated_vote_xyz.device)
+        objectness_mask_surface = torch.zeros((B,K*6), device=aggregated_vote_xyz.device)
+        objectness_label_line = torch.zeros((B,K*12), dtype=torch.long, device=aggregated_vote_xyz.device)
+        objectness_mask_line = torch.zeros((B,K*12), device=aggregated_vote_xyz.device)
+        objectness_label_surface_sem = torch.zeros((B,K*6), dtype=torch.long, device=aggregated_vote_xyz.device)
+        objectness_label_line_sem = torch.zeros((B,K*12), dtype=torch.long, device=aggregated_vote_xyz.device)
 
         # proposal primitives & pridicted primitives
         euclidean_dist_obj_surface = torch.sqrt(torch.sum((pred_obj_surface_center - surface_sel)**2, dim=-1)+1e-6)
         euclidean_dist_obj_line = torch.sqrt(torch.sum((pred_obj_line_center - line_sel)**2, dim=-1)+1e-6)
 
-    ### Objectness score just with centers
-    objectness_label[euclidean_dist1<NEAR_THRESHOLD] = 1 
-    objectness_mask[euclidean_dist1<NEAR_THRESHOLD] = 1
-    objectness_mask[euclidean_dist1>FAR_THRESHOLD] = 1
-
     if mode == 'opt':
         objectness_label_surface_obj = objectness_label.repeat(1,6)
         objectness_mask_surface_obj = objectness_mask.repeat(1,6)
@@ -222,12 +308,12 @@ def compute_proposal_loss(end_points, mode=''):
         temp_objectness_label = torch.cat((objectness_label_surface, objectness_label_line), 1)
         temp_objectness_label_sem = torch.cat((objectness_label_surface_sem, objectness_label_line_sem), 1)
         temp_objectness_mask = torch.cat((objectness_mask_surface, objectness_mask_line), 1)
-        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS_REFINE).cuda(), reduction='none')
+        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS_REFINE).to(aggregated_vote_xyz.device), reduction='none')
         objectness_loss = criterion(objectness_scores.transpose(2,1), temp_objectness_label)
         objectness_loss = torch.sum(objectness_loss * temp_objectness_mask)/(torch.sum(temp_objectness_mask)+1e-6)
 
         objectness_scores_sem = end_points["match_scores_sem"]#match scores for the semantics of primitives
-        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS_REFINE).cuda(), reduction='none')
+        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS_REFINE).to(aggregated_vote_xyz.device), reduction='none')
         objectness_loss_sem = criterion(objectness_scores_sem.transpose(2,1), temp_objectness_label_sem)
         objectness_loss_sem = torch.sum(objectness_loss_sem * temp_objectness_mask)/(torch.sum(temp_objectness_mask)+1e-6)
 
@@ -249,7 +335,7 @@ def compute_proposal_loss(end_points, mode=''):
         objectness_scores = end_points['objectness_scores'+mode]
         objectness_match_mask = (torch.sum(temp_objectness_label.view(B, 18, K), dim=1) >= 1).float()
         
-        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS).cuda(), reduction='none')
+        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS).to(aggregated_vote_xyz.device), reduction='none')
         objectness_loss_refine = criterion(objectness_scores.transpose(2,1), objectness_label)
         objectness_loss_refine1 = torch.sum(objectness_loss_refine * objectness_match_mask)/(torch.sum(objectness_match_mask)+1e-6)
         objectness_loss_refine2 = torch.sum(objectness_loss_refine * objectness_mask)/(torch.sum(objectness_mask)+1e-6)
@@ -258,17 +344,18 @@ def compute_proposal_loss(end_points, mode=''):
         
     else:
         objectness_scores = end_points['objectness_scores'+mode]
-        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS).cuda(), reduction='none')
+        criterion = nn.CrossEntropyLoss(torch.Tensor(OBJECTNESS_CLS_WEIGHTS).to(aggregated_vote_xyz.device), reduction='none')
         objectness_loss = criterion(objectness_scores.transpose(2,1), objectness_label)
         objectness_loss = torch.sum(objectness_loss * objectness_mask)/(torch.sum(objectness_mask)+1e-6)
 
         return objectness_loss, objectness_label, objectness_mask, object_assignment
 
-def compute_box_and_sem_cls_loss(end_points, config, mode=''):
+def compute_box_and_sem_cls_loss(end_points, config, assignment, mode=''):
     """ Compute 3D bounding box and semantic classification loss.
 
     Args:
         end_points: dict (read-only)
+        assignment: GTAssignment of the step
 
     Returns:
         center_loss
@@ -284,11 +371,7 @@ def compute_box_and_sem_cls_loss(end_points, config, mode=''):
     num_class = config.num_class
     mean_size_arr = config.mean_size_arr
 
-    if mode != 'refine':
-        object_assignment = end_points['object_assignment'+'center']
-    else:
-        object_assignment = end_points['object_assignment'+mode]
-        #object_assignment = end_points['object_assignment'+'center']
+    object_assignment = assignment.object_assignment
     batch_size = object_assignment.shape[0]
 
     # Compute center loss
@@ -296,11 +379,7 @@ def compute_box_and_sem_cls_loss(end_points, config, mode=''):
     gt_center = end_points['center_label'][:,:,0:3]
     dist1, ind1, dist2, _ = nn_distance(pred_center, gt_center) # dist1: BxK, dist2: BxK2
     box_label_mask = end_points['box_label_mask']
-    if mode != 'refine':
-        objectness_label = end_points['objectness_label'+'center'].float()
-    else:
-        objectness_label = end_points['objectness_label'+mode].float()
-        #objectness_label = end_points['objectness_label'+'center'].float()
+    objectness_label = assignment.objectness_label.float()
     centroid_reg_loss1 = \
         torch.sum(dist1*objectness_label)/(torch.sum(objectness_label)+1e-6)
     centroid_reg_loss2 = \
@@ -308,47 +387,47 @@ def compute_box_and_sem_cls_loss(end_points, config, mode=''):
     center_loss = centroid_reg_loss1 + centroid_reg_loss2
 
     # Compute heading loss
-    heading_class_label = torch.gather(end_points['heading_class_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    heading_class_label = assignment.label('heading_class_label') # select (B,K) from (B,K2)
     criterion_heading_class = nn.CrossEntropyLoss(reduction='none')
     heading_class_loss = criterion_heading_class(end_points['heading_scores'+mode].transpose(2,1), heading_class_label) # (B,K)
     heading_class_loss = torch.sum(heading_class_loss * objectness_label)/(torch.sum(objectness_label)+1e-6)
 
-    heading_residual_label = torch.gather(end_points['heading_residual_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    heading_residual_label = assignment.label('heading_residual_label') # select (B,K) from (B,K2)
     heading_residual_normalized_label = heading_residual_label / (np.pi/num_heading_bin)
 
     # Ref: https://discuss.pytorch.org/t/convert-int-into-one-hot-format/507/3
-    heading_label_one_hot = torch.cuda.FloatTensor(batch_size, heading_class_label.shape[1], num_heading_bin).zero_()
+    heading_label_one_hot = torch.zeros(batch_size, heading_class_label.shape[1], num_heading_bin, device=heading_class_label.device)
     heading_label_one_hot.scatter_(2, heading_class_label.unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_heading_bin)
     heading_residual_normalized_loss = huber_loss(torch.sum(end_points['heading_residuals_normalized'+mode]*heading_label_one_hot, -1) - heading_residual_normalized_label, delta=1.0) # (B,K)
     heading_residual_normalized_loss = torch.sum(heading_residual_normalized_loss*objectness_label)/(torch.sum(objectness_label)+1e-6)
 
     # Compute size loss
-    size_class_label = torch.gather(end_points['size_class_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    size_class_label = assignment.label('size_class_label') # select (B,K) from (B,K2)
     criterion_size_class = nn.CrossEntropyLoss(reduction='none')
     size_class_loss = criterion_size_class(end_points['size_scores'+mode].transpose(2,1), size_class_label) # (B,K)
     size_class_loss = torch.sum(size_class_loss * objectness_label)/(torch.sum(objectness_label)+1e-6)
 
-    size_residual_label = torch.gather(end_points['size_residual_label'], 1, object_assignment.unsqueeze(-1).repeat(1,1,3)) # select (B,K,3) from (B,K2,3)
-    size_label_one_hot = torch.cuda.FloatTensor(batch_size, size_class_label.shape[1], num_size_cluster).zero_()
+    size_residual_label = assignment.label('size_residual_label') # select (B,K,3) from (B,K2,3)
+    size_label_one_hot = torch.zeros(batch_size, size_class_label.shape[1], num_size_cluster, device=size_class_label.device)
     size_label_one_hot.scatter_(2, size_class_label.unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_size_cluster)
     size_label_one_hot_tiled = size_label_one_hot.unsqueeze(-1).repeat(1,1,1,3) # (B,K,num_size_cluster,3)
     predicted_size_residual_normalized = torch.sum(end_points['size_residuals_normalized'+mode]*size_label_one_hot_tiled, 2) # (B,K,3)
 
-    mean_size_arr_expanded = torch.from_numpy(mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0) # (1,1,num_size_cluster,3) 
+    mean_size_arr_expanded = torch.from_numpy(mean_size_arr.astype(np.float32)).to(size_class_label.device).unsqueeze(0).unsqueeze(0) # (1,1,num_size_cluster,3) 
     mean_size_label = torch.sum(size_label_one_hot_tiled * mean_size_arr_expanded, 2) # (B,K,3)
     size_residual_label_normalized = size_residual_label / mean_size_label # (B,K,3)
     size_residual_normalized_loss = torch.mean(huber_loss(predicted_size_residual_normalized - size_residual_label_normalized, delta=1.0), -1) # (B,K,3) -> (B,K)
     size_residual_normalized_loss = torch.sum(size_residual_normalized_loss*objectness_label)/(torch.sum(objectness_label)+1e-6)
 
     # 3.4 Semantic cls loss
-    sem_cls_label = torch.gather(end_points['sem_cls_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    sem_cls_label = assignment.label('sem_cls_label') # select (B,K) from (B,K2)
     criterion_sem_cls = nn.CrossEntropyLoss(reduction='none')
     sem_cls_loss = criterion_sem_cls(end_points['sem_cls_scores'+mode].transpose(2,1), sem_cls_label) # (B,K)
     sem_cls_loss = torch.sum(sem_cls_loss * objectness_label)/(torch.sum(objectness_label)+1e-6)
 
     return center_loss, heading_class_loss, heading_residual_normalized_loss, size_class_loss, size_residual_normalized_loss, sem_cls_loss
 
-def compute_matching_potential_loss(end_points, config, mode=''):
+def compute_matching_potential_loss(end_points, config, assignment, mode=''):
     """ Compute potential function loss with computed object proposals
     """
 
@@ -357,7 +436,7 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     num_class = config.num_class
     mean_size_arr = config.mean_size_arr
 
-    object_assignment = end_points['object_assignment'+mode]
+    object_assignment = assignment.object_assignment
     batch_size = object_assignment.shape[0]
 
     # Compute center loss
@@ -385,7 +464,7 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     size_residual_normalized = end_points['size_residuals_normalized'+mode]
     pred_size_class = torch.argmax(end_points['size_scores'+'center'].contiguous(), -1).detach()
     pred_size_residual = torch.gather(size_residual, 2, pred_size_class.unsqueeze(-1).unsqueeze(-1).repeat(1,1,1,3))
-    mean_size_class_batched = torch.ones_like(size_residual) * torch.from_numpy(config.mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0)
+    mean_size_class_batched = torch.ones_like(size_residual) * torch.from_numpy(config.mean_size_arr.astype(np.float32)).to(size_residual.device).unsqueeze(0).unsqueeze(0)
     pred_size_avg = torch.gather(mean_size_class_batched, 2, pred_size_class.unsqueeze(-1).unsqueeze(-1).repeat(1,1,1,3)).detach()
     
     obj_size = pred_size_avg.squeeze(2) + pred_size_residual.squeeze(2)# + size_residual_opt
@@ -394,10 +473,8 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     # (B, 6*N, 3)
     # (B, 12*N, 3)
     # proposal primitives
-    pred_obj_surface_center, pred_obj_line_center = get_surface_line_points_batch_pytorch(obj_size, pred_heading, obj_center)
-
     # (B, 6*N+12*N, 3)
-    source_point = torch.cat((pred_obj_surface_center, pred_obj_line_center), 1)
+    source_point = get_surface_line_points_batch_pytorch(obj_size, pred_heading, obj_center, fused=True)
 
     surface_target = end_points["surface_sel"]  # 对应GT的surface center point
     line_target = end_points["line_sel"]  # 对应GT的line center point
@@ -409,7 +486,7 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     gt_center = end_points['center_label'][:,:,0:3]
     dist1, ind1, dist2, _ = nn_distance(pred_center, gt_center) # dist1: BxK, dist2: BxK2
     box_label_mask = end_points['box_label_mask']
-    objectness_label = end_points['objectness_label'+mode].float()
+    objectness_label = assignment.objectness_label.float()
     centroid_reg_loss1 = torch.sum(dist1*objectness_label)/(torch.sum(objectness_label)+1e-6)
     centroid_reg_loss2 = torch.sum(dist2*box_label_mask)/(torch.sum(box_label_mask)+1e-6)
     dist_match = torch.sqrt(torch.sum((source_point - target_point)**2, dim=-1)+1e-6)
@@ -417,17 +494,17 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     center_loss = centroid_reg_loss1 + centroid_reg_loss2 + centroid_reg_loss3
     
     # Compute heading loss
-    heading_class_label = torch.gather(end_points['heading_class_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    heading_class_label = assignment.label('heading_class_label') # select (B,K) from (B,K2)
     criterion_heading_class = nn.CrossEntropyLoss(reduction='none')
     heading_class_loss = criterion_heading_class(end_points['heading_scores'+mode].transpose(2,1), heading_class_label) # (B,K)
     heading_class_loss = torch.sum(heading_class_loss * objectness_label)/(torch.sum(objectness_label)+1e-6)
     #heading_class_loss = torch.tensor(0)
     
-    heading_residual_label = torch.gather(end_points['heading_residual_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    heading_residual_label = assignment.label('heading_residual_label') # select (B,K) from (B,K2)
     heading_residual_normalized_label = heading_residual_label / (np.pi/num_heading_bin)
 
     # Ref: https://discuss.pytorch.org/t/convert-int-into-one-hot-format/507/3
-    heading_label_one_hot = torch.cuda.FloatTensor(batch_size, heading_class_label.shape[1], num_heading_bin).zero_()
+    heading_label_one_hot = torch.zeros(batch_size, heading_class_label.shape[1], num_heading_bin, device=heading_class_label.device)
     heading_label_one_hot.scatter_(2, heading_class_label.unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_heading_bin)
     if False:#mode == 'opt':
         heading_residual_normalized_loss = huber_loss(torch.sum(end_points['heading_residuals_normalized'+'center']*heading_label_one_hot, -1) - heading_residual_normalized_label, delta=1.0) # (B,K)
@@ -438,15 +515,15 @@ def compute_matching_potential_loss(end_points, config, mode=''):
     
     ### Compute the original size loss
     # Compute size loss
-    size_class_label = torch.gather(end_points['size_class_label'], 1, object_assignment) # select (B,K) from (B,K2)
+    size_class_label = assignment.label('size_class_label') # select (B,K) from (B,K2)
     
-    size_residual_label = torch.gather(end_points['size_residual_label'], 1, object_assignment.unsqueeze(-1).repeat(1,1,3)) # select (B,K,3) from (B,K2,3)
-    size_label_one_hot = torch.cuda.FloatTensor(batch_size, size_class_label.shape[1], num_size_cluster).zero_()
+    size_residual_label = assignment.label('size_residual_label') # select (B,K,3) from (B,K2,3)
+    size_label_one_hot = torch.zeros(batch_size, size_class_label.shape[1], num_size_cluster, device=size_class_label.device)
     size_label_one_hot.scatter_(2, size_class_label.unsqueeze(-1), 1) # src==1 so it's *one-hot* (B,K,num_size_cluster)
     size_label_one_hot_tiled = size_label_one_hot.unsqueeze(-1).repeat(1,1,1,3) # (B,K,num_size_cluster,3)
     predicted_size_residual_normalized = torch.sum(size_residual_normalized*size_label_one_hot_tiled, 2) # (B,K,3)
 
-    mean_size_arr_expanded = torch.from_numpy(mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0) # (1,1,num_size_cluster,3) 
+    mean_size_arr_expanded = torch.from_numpy(mean_size_arr.astype(np.float32)).to(size_class_label.device).unsqueeze(0).unsqueeze(0) # (1,1,num_size_cluster,3) 
     mean_size_label = torch.sum(size_label_one_hot_tiled * mean_size_arr_expanded, 2) # (B,K,3)
     size_residual_label_normalized = size_residual_label / mean_size_label # (B,K,3)
 
@@ -578,7 +655,7 @@ def compute_flag_loss(end_points, mode):
 
     pred_flag = end_points['pred_flag'+mode]
     
-    criterion = nn.CrossEntropyLoss(torch.Tensor(SEM_CLS_WEIGHTS).cuda(), reduction='none')
+    criterion = nn.CrossEntropyLoss(torch.Tensor(SEM_CLS_WEIGHTS).to(pred_flag.device), reduction='none')
     sem_loss = criterion(pred_flag, sem_cls_label.long())
     sem_loss = torch.mean(sem_loss.float())
 
@@ -607,6 +684,12 @@ def get_loss(inputs, end_points, config):
         loss: pytorch scalar tensor
         end_points: dict
     """
+    # Network outputs produced under autocast are brought back to float32,
+    # the matching and the losses are computed in full precision.
+    for key in end_points:
+        if torch.is_tensor(end_points[key]) and end_points[key].dtype in (torch.float16, torch.bfloat16):
+            end_points[key] = end_points[key].float()
+
     ### Geometric Primitive Prediction
 
     ### Existence flag pred
@@ -622,13 +705,15 @@ def get_loss(inputs, end_points, config):
     end_points['flag_loss_line'] = flag_loss_line
 
     ### vote regression -> compute_primitive_center_loss ~ from seed point to predicted primitive center
-    vote_loss_z = compute_primitive_center_loss(end_points, mode='_z')*10
+    ### computed together with the object center vote loss by compute_vote_losses
+    vote_losses = compute_vote_losses(end_points)
+    vote_loss_z = vote_losses[1]*10
     end_points['vote_loss_z'] = vote_loss_z
 
-    vote_loss_xy = compute_primitive_center_loss(end_points, mode='_xy')*10
+    vote_loss_xy = vote_losses[2]*10
     end_points['vote_loss_xy'] = vote_loss_xy
 
-    vote_loss_line = compute_primitive_center_loss(end_points, mode='_line')*10
+    vote_loss_line = vote_losses[3]*10
     end_points['vote_loss_line'] = vote_loss_line
 
     # 从predicted primitive center再regress一次，计算center_loss, size_loss, sem_loss
@@ -655,21 +740,24 @@ def get_loss(inputs, end_points, config):
         
     ### Init Proposal loss
     # Vote loss
-    vote_loss = compute_vote_loss(end_points)
+    vote_loss = vote_losses[0]
     end_points['vote_loss'] = vote_loss
 
+    # Proposal to GT matching, shared by the proposal, box and potential losses
+    assignment = GTAssignment(end_points)
+
     # Obj loss
-    objectness_loss, objectness_label, objectness_mask, object_assignment = compute_proposal_loss(end_points, mode='center')
+    objectness_loss, objectness_label, objectness_mask, object_assignment = compute_proposal_loss(end_points, assignment, mode='center')
     end_points['objectness_loss'+'center'] = objectness_loss
     end_points['objectness_label'+'center'] = objectness_label
     end_points['objectness_mask'+'center'] = objectness_mask
     end_points['object_assignment'+'center'] = object_assignment
     total_num_proposal = objectness_label.shape[0]*objectness_label.shape[1]
-    end_points['pos_ratio'] = torch.sum(objectness_label.float().cuda())/float(total_num_proposal)
+    end_points['pos_ratio'] = torch.sum(objectness_label.float())/float(total_num_proposal)
     end_points['neg_ratio'] = torch.sum(objectness_mask.float())/float(total_num_proposal) - end_points['pos_ratio']
 
     objectness_loss_opt, objectness_label_opt, objectness_mask_opt, objectness_label_match, objectness_label_match_sem, objectness_mask_match, object_assignment_opt, objectness_loss_cue, objectness_loss_sem = \
-        compute_proposal_loss(end_points, mode='opt')
+        compute_proposal_loss(end_points, assignment, mode='opt')
     end_points['objectness_loss'+'opt'] = objectness_loss_opt
     end_points['objectness_loss'+'_cue'] = objectness_loss_cue
     end_points['objectness_loss'+'_sem'] = objectness_loss_sem
@@ -683,18 +771,15 @@ def get_loss(inputs, end_points, config):
     
     end_points['object_assignment'+'opt'] = object_assignment_opt
     total_num_proposal_opt = objectness_label_match.shape[0]*objectness_label_match.shape[1]
-    end_points['cover_ratio_opt'] = torch.sum(objectness_mask_match.float().cuda())/float(total_num_proposal_opt)
-    end_points['pos_ratio_opt'] = torch.sum(objectness_label_match.float().cuda())/float(total_num_proposal_opt)#torch.sum(objectness_mask_match.float().cuda())
-    end_points['pos_obj_ratio_opt'] = torch.sum(((torch.max(objectness_label_match.float().view(objectness_label.shape[0], 18, objectness_label.shape[1]), dim=1)[0])*objectness_label.float()).cuda())/torch.sum(objectness_label.float().cuda())
+    end_points['cover_ratio_opt'] = torch.sum(objectness_mask_match.float())/float(total_num_proposal_opt)
+    end_points['pos_ratio_opt'] = torch.sum(objectness_label_match.float())/float(total_num_proposal_opt)#torch.sum(objectness_mask_match.float())
+    end_points['pos_obj_ratio_opt'] = torch.sum(((torch.max(objectness_label_match.float().view(objectness_label.shape[0], 18, objectness_label.shape[1]), dim=1)[0])*objectness_label.float()))/torch.sum(objectness_label.float())
 
     end_points['neg_ratio_opt'] = torch.sum(objectness_mask_match.float())/float(total_num_proposal_opt) - end_points['pos_ratio_opt']
-    end_points['sem_ratio_opt'] = torch.sum(objectness_label_match_sem.float().cuda())/torch.sum(objectness_label_match.float().cuda())
-    assert(np.array_equal(objectness_label.detach().cpu().numpy(), objectness_label_opt.detach().cpu().numpy()))
-    assert(np.array_equal(objectness_mask.detach().cpu().numpy(), objectness_mask_opt.detach().cpu().numpy()))
-    assert(np.array_equal(object_assignment.detach().cpu().numpy(), object_assignment_opt.detach().cpu().numpy()))
+    end_points['sem_ratio_opt'] = torch.sum(objectness_label_match_sem.float())/torch.sum(objectness_label_match.float())
     
     # Box loss and sem cls loss for initial proposal
-    center_loss, heading_cls_loss, heading_reg_loss, size_cls_loss, size_reg_loss, sem_cls_loss = compute_box_and_sem_cls_loss(end_points, config, mode='center')
+    center_loss, heading_cls_loss, heading_reg_loss, size_cls_loss, size_reg_loss, sem_cls_loss = compute_box_and_sem_cls_loss(end_points, config, assignment, mode='center')
     end_points['center_loss'] = center_loss
     end_points['heading_cls_loss'] = heading_cls_loss
     end_points['heading_reg_loss'] = heading_reg_loss
@@ -704,7 +789,7 @@ def get_loss(inputs, end_points, config):
     box_loss = center_loss + 0.1*heading_cls_loss + heading_reg_loss + 0.1*size_cls_loss + size_reg_loss + 0.1*sem_cls_loss
     end_points['box_loss'] = box_loss
 
-    potential_loss = compute_matching_potential_loss(end_points, config, mode='opt')
+    potential_loss = compute_matching_potential_loss(end_points, config, assignment, mode='opt')
     end_points['potential_loss'] = potential_loss
 
     proposalloss = vote_loss + 0.5*objectness_loss + box_loss + 0.5*objectness_loss_opt + potential_loss
@@ -731,3 +816,28 @@ def get_loss(inputs, end_points, config):
     end_points['obj_acc_match_sem'] = obj_acc
 
     return loss, end_points
+
+
+if __name__=='__main__':
+    # compute_vote_losses against the per-branch losses, values and gradients
+    torch.manual_seed(0)
+    B, num_point, num_seed, vote_factor = 2, 2000, 256, 2
+    end_points = {'seed_xyz': torch.rand(B, num_seed, 3),
+                  'seed_inds': torch.randint(0, num_point, (B, num_seed)),
+                  'vote_label': torch.rand(B, num_point, 3*GT_VOTE_FACTOR),
+                  'vote_label_mask': torch.randint(0, 2, (B, num_point)),
+                  'point_line_offset': torch.rand(B, num_point, 3),
+                  'point_line_mask': torch.randint(0, 2, (B, num_point)).float()}
+    for mode in ['_z', '_xy']:
+        end_points['point_boundary_offset'+mode] = torch.rand(B, num_point, 3)
+        end_points['point_boundary_mask'+mode] = torch.randint(0, 2, (B, num_point)).float()
+    votes = [torch.rand(B, num_seed*vote_factor, 3, requires_grad=True) for _ in range(4)]
+    for key, vote in zip(['vote_xyz', 'vote_z', 'vote_xy', 'vote_line'], votes):
+        end_points[key] = vote
+    ref = torch.stack([compute_vote_loss(end_points)] + [compute_primitive_center_loss(end_points, mode) for mode in ['_z', '_xy', '_line']])
+    grads_ref = torch.autograd.grad(ref.sum(), votes)
+    out = compute_vote_losses(end_points)
+    grads = torch.autograd.grad(out.sum(), votes)
+    print('vote losses', ref.tolist(), out.tolist())
+    print('max abs diff: losses %g, grads %g' % ((ref - out).abs().max().item(),
+                                                max((a - b).abs().max().item() for a, b in zip(grads_ref, grads))))
@@ -41,6 +41,8 @@ MASK_LINE_THRESHOLD = 0.3
 LABEL_LINE_THRESHOLD = 0.3
 
 def decode_scores(net, end_points, num_class, num_heading_bin, num_size_cluster, mean_size_arr, mode=''):
+    if isinstance(mean_size_arr, np.ndarray):
+        mean_size_arr = torch.from_numpy(mean_size_arr.astype(np.float32)).to(net.device)
     net_transposed = net.transpose(2,1) # (batch_size, 1024, ..)
     batch_size = net_transposed.shape[0]
     num_proposal = net_transposed.shape[1]
@@ -70,13 +72,13 @@ def decode_scores(net, end_points, num_class, num_heading_bin, num_size_cluster,
         size_residuals_normalized = net_transposed[:,:,start+3+num_heading_bin*2+num_size_cluster:start+3+num_heading_bin*2+num_size_cluster*4].view([batch_size, num_proposal, num_size_cluster, 3]) # Bxnum_proposalxnum_size_clusterx3
         end_points['size_scores'+mode] = size_scores
         end_points['size_residuals_normalized'+mode] = size_residuals_normalized
-        end_points['size_residuals'+mode] = size_residuals_normalized * torch.from_numpy(mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0)
+        end_points['size_residuals'+mode] = size_residuals_normalized * mean_size_arr.unsqueeze(0).unsqueeze(0)
     else:
         size_scores = net_transposed[:,:,start+3+num_heading_bin*2:start+3+num_heading_bin*2+num_size_cluster]
         size_residuals_normalized = net_transposed[:,:,start+3+num_heading_bin*2+num_size_cluster:start+3+num_heading_bin*2+num_size_cluster*4].view([batch_size, num_proposal, num_size_cluster, 3]) # Bxnum_proposalxnum_size_clusterx3
         end_points['size_scores'+mode] = size_scores
         end_points['size_residuals_normalized'+mode] = size_residuals_normalized
-        end_points['size_residuals'+mode] = size_residuals_normalized * torch.from_numpy(mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0)
+        end_points['size_residuals'+mode] = size_residuals_normalized * mean_size_arr.unsqueeze(0).unsqueeze(0)
 
     if mode == 'opt':
         sem_cls_scores = net_transposed[:,:,start+3+num_heading_bin*2:start+3+num_heading_bin*2+num_size_cluster] # Bxnum_proposalx10
@@ -103,6 +105,8 @@ class ProposalModuleRefine(nn.Module):
         self.sampling = sampling
         self.seed_feat_dim = seed_feat_dim
         self.with_angle = with_angle
+        self.refine_topk = None # set by set_refine_pruning()
+        self.refine_thresh = None
         self.vote_aggregation_corner = []
         self.vote_aggregation_plane = []
 
@@ -180,7 +184,52 @@ class ProposalModuleRefine(nn.Module):
         self.bn_refine3 = torch.nn.BatchNorm1d(128)
         
         self.softmax_normal = torch.nn.Softmax(dim=1)
-        
+
+        # Mean sizes, moved to the input's device in forward and expanded to
+        # the batch on use. A plain attribute, so checkpoints are unchanged.
+        self.mean_size = torch.from_numpy(mean_size_arr.astype(np.float32))  # (num_size_cluster, 3)
+
+    def _pack_targets(self, sets, keeps):
+        # (B, n_j, C) sets and (B, n_j) keep masks -> (M, C) kept rows, one
+        # cloud per set and scene, and the (2B + 1) int32 cloud offsets
+        counts = torch.cat([keep.sum(1) for keep in keeps])
+        offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0))).int()
+        return torch.cat([x[keep] for x, keep in zip(sets, keeps)], dim=0).contiguous(), offsets
+
+    def set_refine_pruning(self, topk=None, thresh=None):
+        """ Match and refine only the most likely proposals at eval time.
+
+        The proposals are ranked by their initial objectness (objectness_scorescenter);
+        the top topk, or those above thresh (the most confident one at least), go
+        through primitive matching and refinement, the others keep their initial
+        estimate in the *opt outputs. With both set, the smaller count wins. The
+        refined proposal indices are stored as end_points['refine_inds'] (B, K).
+        The matching outputs then only cover K proposals, so get_loss cannot run
+        on the result. topk=None and thresh=None refine every proposal.
+        """
+        self.refine_topk = topk
+        self.refine_thresh = thresh
+        return self
+
+    def _refine_keep_inds(self, end_points):
+        # (B, K) indices of the proposals to refine, None to refine all of them
+        if self.training or (self.refine_topk is None and self.refine_thresh is None):
+            return None
+        objectness = F.softmax(end_points['objectness_scores'+'center'].detach().float(), dim=-1)[:,:,1]  # (B, N)
+        num_keep = objectness.shape[1]
+        if self.refine_topk is not None:
+            num_keep = min(num_keep, self.refine_topk)
+        if self.refine_thresh is not None:
+            # one K for the batch: the largest count above the threshold
+            num_keep = min(num_keep, max(1, int((objectness > self.refine_thresh).sum(1).max())))
+        if num_keep == objectness.shape[1]:
+            return None
+        return torch.topk(objectness, num_keep, dim=1)[1]
+
+    def _gather_proposals(self, x, inds):
+        # (B, N, ...) -> (B, K, ...)
+        return torch.gather(x, 1, inds.view(inds.shape + (1,)*(x.dim()-2)).expand(inds.shape + x.shape[2:]))
+
     def forward(self, xyz, features, center_z, z_feature, center_xy, xy_feature, center_line, line_feature, end_points):
         """
         Args:
@@ -189,6 +238,7 @@ class ProposalModuleRefine(nn.Module):
         Returns:
             scores: (B,num_proposal,2+3+NH*2+NS*4) 
         """
+        mean_size = self.mean_size.to(xyz.device)
         if self.sampling == 'vote_fps':
             original_features = features
             xyz, features, fps_inds = self.vote_aggregation(xyz, features)
@@ -201,7 +251,7 @@ class ProposalModuleRefine(nn.Module):
         elif self.sampling == 'random':
             # Random sampling from the votes
             num_seed = end_points['seed_xyz'].shape[1]
-            sample_inds = torch.randint(0, num_seed, (batch_size, self.num_proposal), dtype=torch.int).cuda()
+            sample_inds = torch.randint(0, num_seed, (xyz.shape[0], self.num_proposal), dtype=torch.int, device=xyz.device)
             xyz, features, _ = self.vote_aggregation(xyz, features, sample_inds)
         else:
             log_string('Unknown sampling strategy: %s. Exiting!'%(self.sampling))
@@ -217,7 +267,7 @@ class ProposalModuleRefine(nn.Module):
         net = self.conv3(net) # (batch_size, 2+3+num_heading_bin*2+num_size_cluster*4, num_proposal)
 
         final_feature = net
-        center_vote, size_vote, sizescore_vote, end_points = decode_scores(net, end_points, self.num_class, self.num_heading_bin, self.num_size_cluster, self.mean_size_arr, mode='center')
+        center_vote, size_vote, sizescore_vote, end_points = decode_scores(net, end_points, self.num_class, self.num_heading_bin, self.num_size_cluster, mean_size, mode='center')
     
         ### Create surface center here
         ### Extract surface points and features here
@@ -239,7 +289,7 @@ class ProposalModuleRefine(nn.Module):
         end_points['surface_center_pred'] = surface_center_pred  # (B, 2*1024, 3)
         end_points['surface_sem_pred'] = torch.cat((z_sem, xy_sem), dim=1)  # (B, 2*1024, C)
         surface_center_feature_pred = torch.cat((z_feature, xy_feature), dim=2)  # (B, 128, 2*1024)
-        surface_center_feature_pred = torch.cat((torch.zeros((batch_size, 6, surface_center_feature_pred.shape[2])).cuda(), surface_center_feature_pred), dim=1)  # (B, 6+128, 2*1024)
+        surface_keep = torch.cat((z_sel, xy_sel), dim=1) == 0  # (B, 2*1024)
 
         ### Extract line points and features here
         ind_normal_line = self.softmax_normal(end_points["pred_flag_line"])  # (B, 2, 1024)
@@ -247,6 +297,7 @@ class ProposalModuleRefine(nn.Module):
         line_sel = (ind_normal_line[:,1,:] <= SURFACE_THRESH).detach().float()  # (B, 1024)
         offset = torch.ones_like(center_line) * UPPER_THRESH  # (B, 1024, 3)
         line_center = center_line + offset*line_sel.unsqueeze(-1)  # (B, 1024, 3)
+        line_keep = line_sel == 0  # (B, 1024)
         end_points['line_center_pred'] = line_center
         end_points['line_sem_pred'] = end_points["sem_cls_scores_line"]
 
@@ -257,7 +308,7 @@ class ProposalModuleRefine(nn.Module):
         size_residual = size_vote.contiguous()
         pred_size_class = torch.argmax(sizescore_vote.contiguous(), -1)
         pred_size_residual = torch.gather(size_vote.contiguous(), 2, pred_size_class.unsqueeze(-1).unsqueeze(-1).repeat(1,1,1,3))
-        mean_size_class_batched = torch.ones_like(size_residual) * torch.from_numpy(self.mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0)
+        mean_size_class_batched = mean_size.unsqueeze(0).unsqueeze(0).expand_as(size_residual)
         pred_size_avg = torch.gather(mean_size_class_batched, 2, pred_size_class.unsqueeze(-1).unsqueeze(-1).repeat(1,1,1,3))
         obj_size = (pred_size_avg.squeeze(2) + pred_size_residual.squeeze(2)).detach()
 
@@ -273,72 +324,42 @@ class ProposalModuleRefine(nn.Module):
             config = SunrgbdDatasetConfig()
             pred_heading = pred_heading_class.float()*(2*np.pi/float(config.num_heading_bin)) + pred_heading_residual 
 
+        # Refine pruning: only the K kept proposals are matched and refined
+        keep_inds = self._refine_keep_inds(end_points)
+        if keep_inds is not None:
+            object_proposal = keep_inds.shape[1]
+            obj_center = self._gather_proposals(obj_center, keep_inds)
+            obj_size = self._gather_proposals(obj_size, keep_inds)
+            pred_heading = self._gather_proposals(pred_heading, keep_inds)
+            original_feature = torch.gather(original_feature, 2,
+                keep_inds.unsqueeze(1).expand(-1, original_feature.shape[1], -1)).contiguous()
+
         # Projection here: project object center to face centers(1 -> 6) and edge centers(1 -> 12)
         # (B, 6*N, 3), (B, 12*N, 3)
         obj_surface_center, obj_line_center = get_surface_line_points_batch_pytorch(obj_size, pred_heading, obj_center)
-        obj_surface_feature = original_feature.repeat(1,1,6)  # (B, 128, 6*N)
         end_points['surface_center_object'] = obj_surface_center  # (B, 6*N, 3)
-        # Add an indicator for different surfaces
-        obj_upper_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()  # (B, N, 6)
-        obj_upper_indicator[:,:,0] = 1
-        obj_lower_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()
-        obj_lower_indicator[:,:,1] = 1
-        obj_front_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()
-        obj_front_indicator[:,:,2] = 1
-        obj_back_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()
-        obj_back_indicator[:,:,3] = 1
-        obj_left_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()
-        obj_left_indicator[:,:,4] = 1
-        obj_right_indicator = torch.zeros((batch_size, object_proposal, 6)).cuda()
-        obj_right_indicator[:,:,5] = 1
-        # (B, 6, 6*N)
-        obj_surface_indicator = torch.cat((obj_upper_indicator, obj_lower_indicator, obj_front_indicator, obj_back_indicator, obj_left_indicator, obj_right_indicator), dim=1).transpose(2,1).contiguous()
-        # (B, 6+128, 6*N)
-        obj_surface_feature = torch.cat((obj_surface_indicator, obj_surface_feature), dim=1)
-        
-        obj_line_feature = original_feature.repeat(1,1,12)  # (B, 128, 12*N)
-        end_points['line_center_object'] = obj_line_center
-        # Add an indicator for different lines
-        obj_line_indicator0 = torch.zeros((batch_size, 12, object_proposal)).cuda()  # (B, 12, N)
-        obj_line_indicator0[:,0,:] = 1
-        obj_line_indicator1 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator1[:,1,:] = 1
-        obj_line_indicator2 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator2[:,2,:] = 1
-        obj_line_indicator3 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator3[:,3,:] = 1
-        
-        obj_line_indicator4 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator4[:,4,:] = 1
-        obj_line_indicator5 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator5[:,5,:] = 1
-        obj_line_indicator6 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator6[:,6,:] = 1
-        obj_line_indicator7 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator7[:,7,:] = 1
-
-        obj_line_indicator8 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator8[:,8,:] = 1
-        obj_line_indicator9 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator9[:,9,:] = 1
-        obj_line_indicator10 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator10[:,10,:] = 1
-        obj_line_indicator11 = torch.zeros((batch_size, 12, object_proposal)).cuda()
-        obj_line_indicator11[:,11,:] = 1
-
-        # (B, 12, 12*N)
-        obj_line_indicator = torch.cat((obj_line_indicator0, obj_line_indicator1, obj_line_indicator2, obj_line_indicator3, obj_line_indicator4, obj_line_indicator5, obj_line_indicator6, obj_line_indicator7, obj_line_indicator8, obj_line_indicator9, obj_line_indicator10, obj_line_indicator11), dim=2)
-        # (B, 12+128, 12*N)
-        obj_line_feature = torch.cat((obj_line_indicator, obj_line_feature), dim=1)
-
-        # input: (B, 6*N+2*1024, 3), (B, 6+128, 6*N+2*1024)
+        end_points['line_center_object'] = obj_line_center  # (B, 12*N, 3)
+
+        # Pack the selected surface and line centers of every scene into one
+        # target array, clouds 0..B-1 are the surfaces and B..2B-1 the lines.
+        # Unselected centers are dropped instead of matched against, except
+        # the first one of each set: an empty ball falls back to index 0, as
+        # with the padded sets.
+        surface_keep[:,0] = True
+        line_keep[:,0] = True
+        target_xyz, target_offsets = self._pack_targets(
+            [surface_center_pred, line_center], [surface_keep, line_keep])
+        target_feature, _ = self._pack_targets(
+            [surface_center_feature_pred.transpose(1,2), line_feature.transpose(1,2)], [surface_keep, line_keep])
+        target_feature = target_feature.t().contiguous()  # (128, M)
+
+        # The indicators of the targets are zero, the matching MLPs read 6+128 and 12+128 channels
         # output: (B, 6*N, 3), (B, 32, 6*N)
-        surface_xyz, surface_features, _ = self.match_surface_center(torch.cat((obj_surface_center, surface_center_pred), dim=1), torch.cat((obj_surface_feature, surface_center_feature_pred), dim=2))
-        # (B, 12+128, 1024)
-        line_feature = torch.cat((torch.zeros((batch_size, 12, line_feature.shape[2])).cuda(), line_feature), dim=1)
-        # input: (B, 12*N+1024, 3), (B, 12+128, 12*N+1024)
+        surface_xyz, surface_features = self.match_surface_center.forward_packed(
+            obj_surface_center, target_xyz, target_offsets[:batch_size+1], target_feature, pad_channels=6)
         # output: (B, 12*N, 3), (B, 32, 12*N)
-        line_xyz, line_features, _ = self.match_line_center(torch.cat((obj_line_center, line_center), dim=1), torch.cat((obj_line_feature, line_feature), dim=2))
+        line_xyz, line_features = self.match_line_center.forward_packed(
+            obj_line_center, target_xyz, target_offsets[batch_size:], target_feature, pad_channels=12)
 
         # (B, 32, 6*N+12*N)
         combine_features = torch.cat((surface_features.contiguous(), line_features.contiguous()), dim=2)
@@ -377,6 +398,20 @@ class ProposalModuleRefine(nn.Module):
         net = F.relu(self.bn_refine3(self.conv_refine3(net)))
         net = self.conv_refine4(net) # (batch_size, 2+3+num_heading_bin*2+num_size_cluster*4, num_proposal)
 
-        end_points = decode_scores(net, end_points, self.num_class, self.num_heading_bin, self.num_size_cluster, self.mean_size_arr, mode='opt')
+        if keep_inds is None:
+            end_points = decode_scores(net, end_points, self.num_class, self.num_heading_bin, self.num_size_cluster, mean_size, mode='opt')
+            return end_points
+
+        # Decode the K refined proposals and scatter them over the initial
+        # estimates, the pruned proposals pass through unrefined
+        refined = {'aggregated_vote_xyzopt': self._gather_proposals(xyz, keep_inds)}
+        refined = decode_scores(net, refined, self.num_class, self.num_heading_bin, self.num_size_cluster, mean_size, mode='opt')
+        for key, value in refined.items():
+            if key == 'aggregated_vote_xyzopt':
+                continue
+            initial = end_points[key[:-len('opt')]+'center']
+            inds = keep_inds.view(keep_inds.shape + (1,)*(value.dim()-2)).expand_as(value)
+            end_points[key] = initial.scatter(1, inds, value.to(initial.dtype))
+        end_points['refine_inds'] = keep_inds
         return end_points
 
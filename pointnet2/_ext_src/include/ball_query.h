@@ -8,3 +8,8 @@
 
 at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                       const int nsample);
+at::Tensor ball_query_grid(at::Tensor new_xyz, at::Tensor xyz,
+                           const float radius, const int nsample);
+at::Tensor ball_query_packed(at::Tensor new_xyz, at::Tensor xyz,
+                             at::Tensor offsets, const float radius,
+                             const int nsample);
@@ -0,0 +1,22 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#pragma once
+#include <torch/extension.h>
+
+// Uniform grid over every cloud of a (b, n, 3) batch. Points are sorted by
+// (cell, index), so each cell lists its points in increasing index order.
+struct PointGrid {
+  at::Tensor lo;          // (b, 3) min corner of each cloud
+  at::Tensor cell_start;  // (b, ncell) offset of each cell in sorted_idx
+  at::Tensor cell_count;  // (b, ncell) number of points in each cell
+  at::Tensor sorted_idx;  // (b * n) point indices grouped by cell
+  int dims[3];
+  float cell;
+};
+
+// Cells start at `cell` wide (or 1/1024 of the largest extent if cell <= 0)
+// and are coarsened until the grid has at most max_cells cells per cloud.
+PointGrid build_point_grid(at::Tensor xyz, float cell, double max_cells);
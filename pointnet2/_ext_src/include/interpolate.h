@@ -9,6 +9,9 @@
 #include <vector>
 
 std::vector<at::Tensor> three_nn(at::Tensor unknowns, at::Tensor knows);
+std::vector<at::Tensor> three_nn_grid(at::Tensor unknowns, at::Tensor knows);
+std::vector<at::Tensor> three_nn_packed(at::Tensor unknowns,
+                                        at::Tensor offsets, at::Tensor knows);
 at::Tensor three_interpolate(at::Tensor points, at::Tensor idx,
                              at::Tensor weight);
 at::Tensor three_interpolate_grad(at::Tensor grad_out, at::Tensor idx,
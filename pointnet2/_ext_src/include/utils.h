@@ -4,27 +4,68 @@
 // LICENSE file in the root directory of this source tree.
 
 #pragma once
+#ifdef WITH_CUDA
 #include <ATen/cuda/CUDAContext.h>
+#endif
 #include <torch/extension.h>
 
-#define CHECK_CUDA(x)                                          \
-  do {                                                         \
-    AT_CHECK(x.type().is_cuda(), #x " must be a CUDA tensor"); \
+#define CHECK_CUDA(x)                                      \
+  do {                                                     \
+    TORCH_CHECK(x.is_cuda(), #x " must be a CUDA tensor"); \
   } while (0)
 
-#define CHECK_CONTIGUOUS(x)                                         \
-  do {                                                              \
-    AT_CHECK(x.is_contiguous(), #x " must be a contiguous tensor"); \
+#define CHECK_CONTIGUOUS(x)                                            \
+  do {                                                                 \
+    TORCH_CHECK(x.is_contiguous(), #x " must be a contiguous tensor"); \
   } while (0)
 
-#define CHECK_IS_INT(x)                              \
-  do {                                               \
-    AT_CHECK(x.scalar_type() == at::ScalarType::Int, \
-             #x " must be an int tensor");           \
+#define CHECK_IS_INT(x)                                 \
+  do {                                                  \
+    TORCH_CHECK(x.scalar_type() == at::ScalarType::Int, \
+                #x " must be an int tensor");           \
   } while (0)
 
-#define CHECK_IS_FLOAT(x)                              \
-  do {                                                 \
-    AT_CHECK(x.scalar_type() == at::ScalarType::Float, \
-             #x " must be a float tensor");            \
+#define CHECK_IS_FLOAT(x)                                 \
+  do {                                                    \
+    TORCH_CHECK(x.scalar_type() == at::ScalarType::Float, \
+                #x " must be a float tensor");            \
   } while (0)
+
+// Size of the largest cloud of a packed batch, where cloud i spans
+// offsets[i]:offsets[i + 1]. Every cloud must have at least one point.
+inline int packed_max_count(at::Tensor offsets) {
+  const int b = offsets.size(0) - 1;
+  if (b <= 0) return 0;
+  at::Tensor counts = offsets.narrow(0, 1, b) - offsets.narrow(0, 0, b);
+  TORCH_CHECK(counts.min().item<int>() > 0, "packed batch has an empty cloud");
+  return counts.max().item<int>();
+}
+
+#define CHECK_IS_FLOATING(x)                                     \
+  do {                                                           \
+    TORCH_CHECK(x.scalar_type() == at::ScalarType::Float ||      \
+                x.scalar_type() == at::ScalarType::Half ||       \
+                x.scalar_type() == at::ScalarType::BFloat16,     \
+                #x " must be a float, half or bfloat16 tensor"); \
+  } while (0)
+
+// Calls the lambda with scalar_t bound to the C++ type of a float, half or
+// bfloat16 tensor. Only the gathers and the interpolation, which move
+// features, have reduced precision kernels; geometry ops stay in float32.
+#define DISPATCH_FLOATING_TYPES(TYPE, ...)                   \
+  [&] {                                                      \
+    switch (TYPE) {                                          \
+      case at::ScalarType::Half: {                           \
+        using scalar_t = at::Half;                           \
+        return __VA_ARGS__();                                \
+      }                                                      \
+      case at::ScalarType::BFloat16: {                       \
+        using scalar_t = at::BFloat16;                       \
+        return __VA_ARGS__();                                \
+      }                                                      \
+      default: {                                             \
+        using scalar_t = float;                              \
+        return __VA_ARGS__();                                \
+      }                                                      \
+    }                                                        \
+  }()
@@ -4,11 +4,29 @@
 // LICENSE file in the root directory of this source tree.
 
 #include "ball_query.h"
+#include "grid.h"
 #include "utils.h"
 
 void query_ball_point_kernel_wrapper(int b, int n, int m, float radius,
                                      int nsample, const float *new_xyz,
-                                     const float *xyz, int *idx);
+                                     const float *xyz, const int *offsets,
+                                     int *idx);
+
+void query_ball_point_cpu_kernel_wrapper(int b, int n, int m, float radius,
+                                         int nsample, const float *new_xyz,
+                                         const float *xyz, const int *offsets,
+                                         int *idx);
+
+void query_ball_point_grid_kernel_wrapper(
+    int b, int n, int m, float radius, int nsample, int dx, int dy, int dz,
+    float cell, const float *lo, const float *new_xyz, const float *xyz,
+    const int *cell_start, const int *cell_count, const int *sorted_idx,
+    int *idx);
+void query_ball_point_grid_cpu_kernel_wrapper(
+    int b, int n, int m, float radius, int nsample, int dx, int dy, int dz,
+    float cell, const float *lo, const float *new_xyz, const float *xyz,
+    const int *cell_start, const int *cell_count, const int *sorted_idx,
+    int *idx);
 
 at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                       const int nsample) {
@@ -17,7 +35,7 @@ at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
   CHECK_IS_FLOAT(new_xyz);
   CHECK_IS_FLOAT(xyz);
 
-  if (new_xyz.type().is_cuda()) {
+  if (new_xyz.is_cuda()) {
     CHECK_CUDA(xyz);
   }
 
@@ -25,12 +43,108 @@ at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
       torch::zeros({new_xyz.size(0), new_xyz.size(1), nsample},
                    at::device(new_xyz.device()).dtype(at::ScalarType::Int));
 
-  if (new_xyz.type().is_cuda()) {
+  if (new_xyz.is_cuda()) {
+#ifdef WITH_CUDA
     query_ball_point_kernel_wrapper(xyz.size(0), xyz.size(1), new_xyz.size(1),
-                                    radius, nsample, new_xyz.data<float>(),
-                                    xyz.data<float>(), idx.data<int>());
+                                    radius, nsample, new_xyz.data_ptr<float>(),
+                                    xyz.data_ptr<float>(), nullptr, idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    query_ball_point_cpu_kernel_wrapper(xyz.size(0), xyz.size(1), new_xyz.size(1),
+                                        radius, nsample, new_xyz.data_ptr<float>(),
+                                        xyz.data_ptr<float>(), nullptr, idx.data_ptr<int>());
+  }
+
+  return idx;
+}
+
+// Ball query on a packed batch: the clouds are concatenated in xyz (N, 3) and
+// cloud i spans offsets[i]:offsets[i + 1]. new_xyz (b, m, 3) holds the
+// centers of every cloud. Returns (b, m, nsample) indices into xyz.
+at::Tensor ball_query_packed(at::Tensor new_xyz, at::Tensor xyz,
+                             at::Tensor offsets, const float radius,
+                             const int nsample) {
+  CHECK_CONTIGUOUS(new_xyz);
+  CHECK_CONTIGUOUS(xyz);
+  CHECK_CONTIGUOUS(offsets);
+  CHECK_IS_FLOAT(new_xyz);
+  CHECK_IS_FLOAT(xyz);
+  CHECK_IS_INT(offsets);
+
+  if (new_xyz.is_cuda()) {
+    CHECK_CUDA(xyz);
+    CHECK_CUDA(offsets);
+  }
+
+  const int b = new_xyz.size(0), m = new_xyz.size(1);
+  TORCH_CHECK(offsets.size(0) == b + 1, "offsets must have b + 1 entries");
+  const int max_n = packed_max_count(offsets);
+  at::Tensor idx =
+      torch::zeros({b, m, nsample},
+                   at::device(new_xyz.device()).dtype(at::ScalarType::Int));
+
+  if (new_xyz.is_cuda()) {
+#ifdef WITH_CUDA
+    query_ball_point_kernel_wrapper(b, max_n, m, radius, nsample,
+                                    new_xyz.data_ptr<float>(), xyz.data_ptr<float>(),
+                                    offsets.data_ptr<int>(), idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    query_ball_point_cpu_kernel_wrapper(b, max_n, m, radius, nsample,
+                                        new_xyz.data_ptr<float>(), xyz.data_ptr<float>(),
+                                        offsets.data_ptr<int>(), idx.data_ptr<int>());
+  }
+
+  return idx + offsets.narrow(0, 0, b).view({b, 1, 1});
+}
+
+// Same result as ball_query, but the points are first binned into a uniform
+// grid with cells at least radius wide, so every ball only scans the 3x3x3
+// cells around its center. The grid spans the bounding box of each cloud and
+// is coarsened if it would have more than 4 * n cells.
+at::Tensor ball_query_grid(at::Tensor new_xyz, at::Tensor xyz,
+                           const float radius, const int nsample) {
+  CHECK_CONTIGUOUS(new_xyz);
+  CHECK_CONTIGUOUS(xyz);
+  CHECK_IS_FLOAT(new_xyz);
+  CHECK_IS_FLOAT(xyz);
+
+  if (new_xyz.is_cuda()) {
+    CHECK_CUDA(xyz);
+  }
+
+  const int b = xyz.size(0), n = xyz.size(1), m = new_xyz.size(1);
+  at::Tensor idx =
+      torch::zeros({b, m, nsample},
+                   at::device(new_xyz.device()).dtype(at::ScalarType::Int));
+  if (n == 0 || m == 0 || nsample <= 0 || !(radius > 0)) {
+    return idx;
+  }
+
+  PointGrid grid = build_point_grid(xyz, radius * 1.0001f, 4.0 * n);
+
+  if (new_xyz.is_cuda()) {
+#ifdef WITH_CUDA
+    query_ball_point_grid_kernel_wrapper(
+        b, n, m, radius, nsample, grid.dims[0], grid.dims[1], grid.dims[2],
+        grid.cell, grid.lo.data_ptr<float>(), new_xyz.data_ptr<float>(),
+        xyz.data_ptr<float>(), grid.cell_start.data_ptr<int>(),
+        grid.cell_count.data_ptr<int>(), grid.sorted_idx.data_ptr<int>(),
+        idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    query_ball_point_grid_cpu_kernel_wrapper(
+        b, n, m, radius, nsample, grid.dims[0], grid.dims[1], grid.dims[2],
+        grid.cell, grid.lo.data_ptr<float>(), new_xyz.data_ptr<float>(),
+        xyz.data_ptr<float>(), grid.cell_start.data_ptr<int>(),
+        grid.cell_count.data_ptr<int>(), grid.sorted_idx.data_ptr<int>(),
+        idx.data_ptr<int>());
   }
 
   return idx;
@@ -0,0 +1,118 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <algorithm>
+#include <cmath>
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3)
+// output: idx(b, m, nsample)
+// With offsets (b + 1), xyz holds the clouds back to back and cloud i spans
+// offsets[i]:offsets[i + 1], idx is then local to the cloud.
+void query_ball_point_cpu_kernel_wrapper(int b, int n, int m, float radius,
+                                         int nsample, const float *new_xyz,
+                                         const float *xyz, const int *offsets,
+                                         int *idx) {
+  const float radius2 = radius * radius;
+#pragma omp parallel for
+  for (int bj = 0; bj < b * m; ++bj) {
+    const int i = bj / m;
+    const int start = offsets ? offsets[i] : i * n;
+    const int count = offsets ? offsets[i + 1] - start : n;
+    const float *batch_xyz = xyz + start * 3;
+    const float new_x = new_xyz[bj * 3 + 0];
+    const float new_y = new_xyz[bj * 3 + 1];
+    const float new_z = new_xyz[bj * 3 + 2];
+    int *idx_row = idx + bj * nsample;
+    for (int k = 0, cnt = 0; k < count && cnt < nsample; ++k) {
+      const float x = batch_xyz[k * 3 + 0];
+      const float y = batch_xyz[k * 3 + 1];
+      const float z = batch_xyz[k * 3 + 2];
+      const float d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) +
+                       (new_z - z) * (new_z - z);
+      if (d2 < radius2) {
+        if (cnt == 0) {
+          for (int l = 0; l < nsample; ++l) {
+            idx_row[l] = k;
+          }
+        }
+        idx_row[cnt] = k;
+        ++cnt;
+      }
+    }
+  }
+}
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, n)
+// output: idx(b, m, nsample)
+// Same 27-cell merge as query_ball_point_grid_kernel.
+void query_ball_point_grid_cpu_kernel_wrapper(
+    int b, int n, int m, float radius, int nsample, int dx, int dy, int dz,
+    float cell, const float *lo, const float *new_xyz, const float *xyz,
+    const int *cell_start, const int *cell_count, const int *sorted_idx,
+    int *idx) {
+  const float radius2 = radius * radius;
+  const int ncell = dx * dy * dz;
+#pragma omp parallel for
+  for (int bj = 0; bj < b * m; ++bj) {
+    const int i = bj / m;
+    const float *batch_xyz = xyz + i * n * 3;
+    const float *batch_lo = lo + i * 3;
+    const int *batch_start = cell_start + i * ncell;
+    const int *batch_count = cell_count + i * ncell;
+    const float new_x = new_xyz[bj * 3 + 0];
+    const float new_y = new_xyz[bj * 3 + 1];
+    const float new_z = new_xyz[bj * 3 + 2];
+    const int cx = (int)std::floor(
+        std::min(std::max((new_x - batch_lo[0]) / cell, -1.f), (float)dx));
+    const int cy = (int)std::floor(
+        std::min(std::max((new_y - batch_lo[1]) / cell, -1.f), (float)dy));
+    const int cz = (int)std::floor(
+        std::min(std::max((new_z - batch_lo[2]) / cell, -1.f), (float)dz));
+    int *idx_row = idx + bj * nsample;
+
+    int ptr[27], end[27];
+    int nlist = 0;
+    for (int x = std::max(cx - 1, 0); x <= std::min(cx + 1, dx - 1); ++x) {
+      for (int y = std::max(cy - 1, 0); y <= std::min(cy + 1, dy - 1); ++y) {
+        for (int z = std::max(cz - 1, 0); z <= std::min(cz + 1, dz - 1); ++z) {
+          const int c = (x * dy + y) * dz + z;
+          if (batch_count[c] > 0) {
+            ptr[nlist] = batch_start[c];
+            end[nlist] = batch_start[c] + batch_count[c];
+            ++nlist;
+          }
+        }
+      }
+    }
+
+    for (int cnt = 0; cnt < nsample;) {
+      int best = -1, k = n;
+      for (int l = 0; l < nlist; ++l) {
+        if (ptr[l] < end[l] && sorted_idx[ptr[l]] < k) {
+          k = sorted_idx[ptr[l]];
+          best = l;
+        }
+      }
+      if (best < 0) break;
+      ++ptr[best];
+
+      const float x = batch_xyz[k * 3 + 0];
+      const float y = batch_xyz[k * 3 + 1];
+      const float z = batch_xyz[k * 3 + 2];
+      const float d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) +
+                       (new_z - z) * (new_z - z);
+      if (d2 < radius2) {
+        if (cnt == 0) {
+          for (int l = 0; l < nsample; ++l) {
+            idx_row[l] = k;
+          }
+        }
+        idx_row[cnt] = k;
+        ++cnt;
+      }
+    }
+  }
+}
@@ -11,13 +11,17 @@
 
 // input: new_xyz(b, m, 3) xyz(b, n, 3)
 // output: idx(b, m, nsample)
+// With offsets (b + 1), cloud i of xyz spans offsets[i]:offsets[i + 1].
 __global__ void query_ball_point_kernel(int b, int n, int m, float radius,
                                         int nsample,
                                         const float *__restrict__ new_xyz,
                                         const float *__restrict__ xyz,
+                                        const int *__restrict__ offsets,
                                         int *__restrict__ idx) {
   int batch_index = blockIdx.x;
-  xyz += batch_index * n * 3;
+  const int start = offsets ? offsets[batch_index] : batch_index * n;
+  if (offsets) n = offsets[batch_index + 1] - start;
+  xyz += start * 3;
   new_xyz += batch_index * m * 3;
   idx += m * nsample * batch_index;
 
@@ -50,10 +54,101 @@ __global__ void query_ball_point_kernel(int b, int n, int m, float radius,
 
 void query_ball_point_kernel_wrapper(int b, int n, int m, float radius,
                                      int nsample, const float *new_xyz,
-                                     const float *xyz, int *idx) {
+                                     const float *xyz, const int *offsets,
+                                     int *idx) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
   query_ball_point_kernel<<<b, opt_n_threads(m), 0, stream>>>(
-      b, n, m, radius, nsample, new_xyz, xyz, idx);
+      b, n, m, radius, nsample, new_xyz, xyz, offsets, idx);
+
+  CUDA_CHECK_ERRORS();
+}
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, n)
+// output: idx(b, m, nsample)
+// Points of every cell are listed in increasing index order, merging the
+// lists of the 27 cells around the center visits candidates in the same
+// order as the brute-force scan.
+__global__ void query_ball_point_grid_kernel(
+    int b, int n, int m, float radius, int nsample, int dx, int dy, int dz,
+    float cell, const float *__restrict__ lo,
+    const float *__restrict__ new_xyz, const float *__restrict__ xyz,
+    const int *__restrict__ cell_start, const int *__restrict__ cell_count,
+    const int *__restrict__ sorted_idx, int *__restrict__ idx) {
+  int batch_index = blockIdx.x;
+  const int ncell = dx * dy * dz;
+  xyz += batch_index * n * 3;
+  new_xyz += batch_index * m * 3;
+  idx += m * nsample * batch_index;
+  lo += batch_index * 3;
+  cell_start += batch_index * ncell;
+  cell_count += batch_index * ncell;
+
+  int index = threadIdx.x;
+  int stride = blockDim.x;
+
+  float radius2 = radius * radius;
+  for (int j = index; j < m; j += stride) {
+    float new_x = new_xyz[j * 3 + 0];
+    float new_y = new_xyz[j * 3 + 1];
+    float new_z = new_xyz[j * 3 + 2];
+    int cx = (int)floorf(fminf(fmaxf((new_x - lo[0]) / cell, -1.f), dx));
+    int cy = (int)floorf(fminf(fmaxf((new_y - lo[1]) / cell, -1.f), dy));
+    int cz = (int)floorf(fminf(fmaxf((new_z - lo[2]) / cell, -1.f), dz));
+
+    int ptr[27], end[27];
+    int nlist = 0;
+    for (int x = max(cx - 1, 0); x <= min(cx + 1, dx - 1); ++x) {
+      for (int y = max(cy - 1, 0); y <= min(cy + 1, dy - 1); ++y) {
+        for (int z = max(cz - 1, 0); z <= min(cz + 1, dz - 1); ++z) {
+          int c = (x * dy + y) * dz + z;
+          if (cell_count[c] > 0) {
+            ptr[nlist] = cell_start[c];
+            end[nlist] = cell_start[c] + cell_count[c];
+            ++nlist;
+          }
+        }
+      }
+    }
+
+    for (int cnt = 0; cnt < nsample;) {
+      int best = -1, k = n;
+      for (int l = 0; l < nlist; ++l) {
+        if (ptr[l] < end[l] && sorted_idx[ptr[l]] < k) {
+          k = sorted_idx[ptr[l]];
+          best = l;
+        }
+      }
+      if (best < 0) break;
+      ++ptr[best];
+
+      float x = xyz[k * 3 + 0];
+      float y = xyz[k * 3 + 1];
+      float z = xyz[k * 3 + 2];
+      float d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) +
+                 (new_z - z) * (new_z - z);
+      if (d2 < radius2) {
+        if (cnt == 0) {
+          for (int l = 0; l < nsample; ++l) {
+            idx[j * nsample + l] = k;
+          }
+        }
+        idx[j * nsample + cnt] = k;
+        ++cnt;
+      }
+    }
+  }
+}
+
+void query_ball_point_grid_kernel_wrapper(
+    int b, int n, int m, float radius, int nsample, int dx, int dy, int dz,
+    float cell, const float *lo, const float *new_xyz, const float *xyz,
+    const int *cell_start, const int *cell_count, const int *sorted_idx,
+    int *idx) {
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+  query_ball_point_grid_kernel<<<b, opt_n_threads(m), 0, stream>>>(
+      b, n, m, radius, nsample, dx, dy, dz, cell, lo, new_xyz, xyz,
+      cell_start, cell_count, sorted_idx, idx);
 
   CUDA_CHECK_ERRORS();
 }
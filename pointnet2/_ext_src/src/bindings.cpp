@@ -6,18 +6,25 @@
 #include "ball_query.h"
 #include "group_points.h"
 #include "interpolate.h"
+#include "knn_query.h"
 #include "sampling.h"
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("gather_points", &gather_points);
   m.def("gather_points_grad", &gather_points_grad);
   m.def("furthest_point_sampling", &furthest_point_sampling);
+  m.def("furthest_point_sampling_packed", &furthest_point_sampling_packed);
 
   m.def("three_nn", &three_nn);
+  m.def("three_nn_grid", &three_nn_grid);
+  m.def("three_nn_packed", &three_nn_packed);
   m.def("three_interpolate", &three_interpolate);
   m.def("three_interpolate_grad", &three_interpolate_grad);
 
   m.def("ball_query", &ball_query);
+  m.def("ball_query_grid", &ball_query_grid);
+  m.def("ball_query_packed", &ball_query_packed);
+  m.def("knn_query", &knn_query);
 
   m.def("group_points", &group_points);
   m.def("group_points_grad", &group_points_grad);
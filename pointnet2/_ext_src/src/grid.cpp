@@ -0,0 +1,58 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include "grid.h"
+#include "utils.h"
+
+PointGrid build_point_grid(at::Tensor xyz, float cell, double max_cells) {
+  const int b = xyz.size(0), n = xyz.size(1);
+  PointGrid grid;
+
+  grid.lo = std::get<0>(xyz.min(1)).contiguous();  // (b, 3)
+  at::Tensor hi = std::get<0>(xyz.max(1));
+  at::Tensor extent = std::get<0>((hi - grid.lo).max(0)).cpu();
+  auto e = extent.accessor<float, 1>();
+
+  if (!(cell > 0)) {
+    const float max_extent = std::max(e[0], std::max(e[1], e[2]));
+    cell = max_extent > 0 ? max_extent / 1024 : 1.f;
+  }
+  while (true) {
+    double ncell = 1;
+    for (int a = 0; a < 3; ++a) {
+      ncell *= std::floor(e[a] / cell) + 1;
+    }
+    if (ncell <= std::max(max_cells, 1.0)) break;
+    cell *= 1.25f;
+  }
+  for (int a = 0; a < 3; ++a) {
+    grid.dims[a] = static_cast<int>(std::floor(e[a] / cell)) + 1;
+  }
+  grid.cell = cell;
+  const int64_t ncell =
+      static_cast<int64_t>(grid.dims[0]) * grid.dims[1] * grid.dims[2];
+
+  at::Tensor rel = (xyz - grid.lo.unsqueeze(1)) / cell;
+  at::Tensor cx =
+      rel.select(2, 0).floor().clamp(0, grid.dims[0] - 1).to(at::kLong);
+  at::Tensor cy =
+      rel.select(2, 1).floor().clamp(0, grid.dims[1] - 1).to(at::kLong);
+  at::Tensor cz =
+      rel.select(2, 2).floor().clamp(0, grid.dims[2] - 1).to(at::kLong);
+  at::Tensor batch =
+      at::arange(b, xyz.options().dtype(at::kLong)).unsqueeze(1);
+  at::Tensor cell_key =
+      batch * ncell + (cx * grid.dims[1] + cy) * grid.dims[2] + cz;  // (b, n)
+  at::Tensor keys =
+      cell_key * n + at::arange(n, xyz.options().dtype(at::kLong)).unsqueeze(0);
+  at::Tensor perm = std::get<1>(keys.view(-1).sort());
+  grid.sorted_idx = perm.remainder(n).to(at::kInt).contiguous();
+
+  at::Tensor counts = at::bincount(cell_key.view(-1), {}, b * ncell);
+  grid.cell_start = (counts.cumsum(0) - counts).to(at::kInt).contiguous();
+  grid.cell_count = counts.to(at::kInt).contiguous();
+
+  return grid;
+}
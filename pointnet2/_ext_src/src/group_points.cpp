@@ -6,35 +6,54 @@
 #include "group_points.h"
 #include "utils.h"
 
+template <typename scalar_t>
 void group_points_kernel_wrapper(int b, int c, int n, int npoints, int nsample,
-                                 const float *points, const int *idx,
-                                 float *out);
+                                 const scalar_t *points, const int *idx,
+                                 scalar_t *out);
 
+template <typename scalar_t>
 void group_points_grad_kernel_wrapper(int b, int c, int n, int npoints,
-                                      int nsample, const float *grad_out,
+                                      int nsample, const scalar_t *grad_out,
                                       const int *idx, float *grad_points);
 
+template <typename scalar_t>
+void group_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                     int nsample, const scalar_t *points,
+                                     const int *idx, scalar_t *out);
+template <typename scalar_t>
+void group_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                          int nsample, const scalar_t *grad_out,
+                                          const int *idx, float *grad_points);
+
 at::Tensor group_points(at::Tensor points, at::Tensor idx) {
   CHECK_CONTIGUOUS(points);
   CHECK_CONTIGUOUS(idx);
-  CHECK_IS_FLOAT(points);
+  CHECK_IS_FLOATING(points);
   CHECK_IS_INT(idx);
 
-  if (points.type().is_cuda()) {
+  if (points.is_cuda()) {
     CHECK_CUDA(idx);
   }
 
   at::Tensor output =
       torch::zeros({points.size(0), points.size(1), idx.size(1), idx.size(2)},
-                   at::device(points.device()).dtype(at::ScalarType::Float));
+                   at::device(points.device()).dtype(points.scalar_type()));
 
-  if (points.type().is_cuda()) {
-    group_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
-                                idx.size(1), idx.size(2), points.data<float>(),
-                                idx.data<int>(), output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
+  DISPATCH_FLOATING_TYPES(points.scalar_type(), [&] {
+    if (points.is_cuda()) {
+#ifdef WITH_CUDA
+      group_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
+                                  idx.size(1), idx.size(2), points.data_ptr<scalar_t>(),
+                                  idx.data_ptr<int>(), output.data_ptr<scalar_t>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      group_points_cpu_kernel_wrapper(points.size(0), points.size(1), points.size(2),
+                                      idx.size(1), idx.size(2), points.data_ptr<scalar_t>(),
+                                      idx.data_ptr<int>(), output.data_ptr<scalar_t>());
+    }
+  });
 
   return output;
 }
@@ -42,24 +61,33 @@ at::Tensor group_points(at::Tensor points, at::Tensor idx) {
 at::Tensor group_points_grad(at::Tensor grad_out, at::Tensor idx, const int n) {
   CHECK_CONTIGUOUS(grad_out);
   CHECK_CONTIGUOUS(idx);
-  CHECK_IS_FLOAT(grad_out);
+  CHECK_IS_FLOATING(grad_out);
   CHECK_IS_INT(idx);
 
-  if (grad_out.type().is_cuda()) {
+  if (grad_out.is_cuda()) {
     CHECK_CUDA(idx);
   }
 
+  // Accumulated in float32, many grad_out entries can land on one point
   at::Tensor output =
       torch::zeros({grad_out.size(0), grad_out.size(1), n},
                    at::device(grad_out.device()).dtype(at::ScalarType::Float));
 
-  if (grad_out.type().is_cuda()) {
-    group_points_grad_kernel_wrapper(
-        grad_out.size(0), grad_out.size(1), n, idx.size(1), idx.size(2),
-        grad_out.data<float>(), idx.data<int>(), output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
+  DISPATCH_FLOATING_TYPES(grad_out.scalar_type(), [&] {
+    if (grad_out.is_cuda()) {
+#ifdef WITH_CUDA
+      group_points_grad_kernel_wrapper(
+          grad_out.size(0), grad_out.size(1), n, idx.size(1), idx.size(2),
+          grad_out.data_ptr<scalar_t>(), idx.data_ptr<int>(), output.data_ptr<float>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      group_points_grad_cpu_kernel_wrapper(
+          grad_out.size(0), grad_out.size(1), n, idx.size(1), idx.size(2),
+          grad_out.data_ptr<scalar_t>(), idx.data_ptr<int>(), output.data_ptr<float>());
+    }
+  });
 
-  return output;
+  return output.to(grad_out.scalar_type());
 }
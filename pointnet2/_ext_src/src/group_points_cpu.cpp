@@ -0,0 +1,51 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/ATen.h>
+
+// input: points(b, c, n) idx(b, npoints, nsample)
+// output: out(b, c, npoints, nsample)
+template <typename scalar_t>
+void group_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                     int nsample, const scalar_t *points,
+                                     const int *idx, scalar_t *out) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *points_row = points + bc * n;
+    const int *batch_idx = idx + i * npoints * nsample;
+    scalar_t *out_row = out + bc * npoints * nsample;
+    for (int j = 0; j < npoints * nsample; ++j) {
+      out_row[j] = points_row[batch_idx[j]];
+    }
+  }
+}
+
+// input: grad_out(b, c, npoints, nsample), idx(b, npoints, nsample)
+// output: grad_points(b, c, n)
+template <typename scalar_t>
+void group_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                          int nsample, const scalar_t *grad_out,
+                                          const int *idx, float *grad_points) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *grad_out_row = grad_out + bc * npoints * nsample;
+    const int *batch_idx = idx + i * npoints * nsample;
+    float *grad_points_row = grad_points + bc * n;
+    for (int j = 0; j < npoints * nsample; ++j) {
+      grad_points_row[batch_idx[j]] += static_cast<float>(grad_out_row[j]);
+    }
+  }
+}
+
+#define INSTANTIATE(scalar_t)                                              \
+  template void group_points_cpu_kernel_wrapper<scalar_t>(                 \
+      int, int, int, int, int, const scalar_t *, const int *, scalar_t *); \
+  template void group_points_grad_cpu_kernel_wrapper<scalar_t>(            \
+      int, int, int, int, int, const scalar_t *, const int *, float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
@@ -10,11 +10,12 @@
 
 // input: points(b, c, n) idx(b, npoints, nsample)
 // output: out(b, c, npoints, nsample)
+template <typename scalar_t>
 __global__ void group_points_kernel(int b, int c, int n, int npoints,
                                     int nsample,
-                                    const float *__restrict__ points,
+                                    const scalar_t *__restrict__ points,
                                     const int *__restrict__ idx,
-                                    float *__restrict__ out) {
+                                    scalar_t *__restrict__ out) {
   int batch_index = blockIdx.x;
   points += batch_index * n * c;
   idx += batch_index * npoints * nsample;
@@ -32,12 +33,13 @@ __global__ void group_points_kernel(int b, int c, int n, int npoints,
   }
 }
 
+template <typename scalar_t>
 void group_points_kernel_wrapper(int b, int c, int n, int npoints, int nsample,
-                                 const float *points, const int *idx,
-                                 float *out) {
+                                 const scalar_t *points, const int *idx,
+                                 scalar_t *out) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
 
-  group_points_kernel<<<b, opt_block_config(npoints, c), 0, stream>>>(
+  group_points_kernel<scalar_t><<<b, opt_block_config(npoints, c), 0, stream>>>(
       b, c, n, npoints, nsample, points, idx, out);
 
   CUDA_CHECK_ERRORS();
@@ -45,9 +47,10 @@ void group_points_kernel_wrapper(int b, int c, int n, int npoints, int nsample,
 
 // input: grad_out(b, c, npoints, nsample), idx(b, npoints, nsample)
 // output: grad_points(b, c, n)
+template <typename scalar_t>
 __global__ void group_points_grad_kernel(int b, int c, int n, int npoints,
                                          int nsample,
-                                         const float *__restrict__ grad_out,
+                                         const scalar_t *__restrict__ grad_out,
                                          const int *__restrict__ idx,
                                          float *__restrict__ grad_points) {
   int batch_index = blockIdx.x;
@@ -63,18 +66,29 @@ __global__ void group_points_grad_kernel(int b, int c, int n, int npoints,
     for (int k = 0; k < nsample; ++k) {
       int ii = idx[j * nsample + k];
       atomicAdd(grad_points + l * n + ii,
-                grad_out[(l * npoints + j) * nsample + k]);
+                static_cast<float>(grad_out[(l * npoints + j) * nsample + k]));
     }
   }
 }
 
+template <typename scalar_t>
 void group_points_grad_kernel_wrapper(int b, int c, int n, int npoints,
-                                      int nsample, const float *grad_out,
+                                      int nsample, const scalar_t *grad_out,
                                       const int *idx, float *grad_points) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
 
-  group_points_grad_kernel<<<b, opt_block_config(npoints, c), 0, stream>>>(
-      b, c, n, npoints, nsample, grad_out, idx, grad_points);
+  group_points_grad_kernel<scalar_t>
+      <<<b, opt_block_config(npoints, c), 0, stream>>>(
+          b, c, n, npoints, nsample, grad_out, idx, grad_points);
 
   CUDA_CHECK_ERRORS();
 }
+
+#define INSTANTIATE(scalar_t)                                              \
+  template void group_points_kernel_wrapper<scalar_t>(                     \
+      int, int, int, int, int, const scalar_t *, const int *, scalar_t *); \
+  template void group_points_grad_kernel_wrapper<scalar_t>(                \
+      int, int, int, int, int, const scalar_t *, const int *, float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
@@ -3,26 +3,58 @@
 // This source code is licensed under the MIT license found in the
 // LICENSE file in the root directory of this source tree.
 
+#include "grid.h"
 #include "interpolate.h"
 #include "utils.h"
 
 void three_nn_kernel_wrapper(int b, int n, int m, const float *unknown,
-                             const float *known, float *dist2, int *idx);
+                             const int *offsets, const float *known,
+                             float *dist2, int *idx);
+template <typename scalar_t>
 void three_interpolate_kernel_wrapper(int b, int c, int m, int n,
-                                      const float *points, const int *idx,
-                                      const float *weight, float *out);
+                                      const scalar_t *points, const int *idx,
+                                      const float *weight, scalar_t *out);
+template <typename scalar_t>
 void three_interpolate_grad_kernel_wrapper(int b, int c, int n, int m,
-                                           const float *grad_out,
+                                           const scalar_t *grad_out,
                                            const int *idx, const float *weight,
                                            float *grad_points);
 
+void three_nn_cpu_kernel_wrapper(int b, int n, int m, const float *unknown,
+                                 const int *offsets, const float *known,
+                                 float *dist2, int *idx);
+template <typename scalar_t>
+void three_interpolate_cpu_kernel_wrapper(int b, int c, int m, int n,
+                                          const scalar_t *points, const int *idx,
+                                          const float *weight, scalar_t *out);
+template <typename scalar_t>
+void three_interpolate_grad_cpu_kernel_wrapper(int b, int c, int n, int m,
+                                               const scalar_t *grad_out,
+                                               const int *idx,
+                                               const float *weight,
+                                               float *grad_points);
+
+void three_nn_grid_kernel_wrapper(int b, int n, int m, int dx, int dy, int dz,
+                                  float cell, const float *lo,
+                                  const float *unknown, const float *known,
+                                  const int *cell_start, const int *cell_count,
+                                  const int *sorted_idx, float *dist2,
+                                  int *idx);
+void three_nn_grid_cpu_kernel_wrapper(int b, int n, int m, int dx, int dy,
+                                      int dz, float cell, const float *lo,
+                                      const float *unknown, const float *known,
+                                      const int *cell_start,
+                                      const int *cell_count,
+                                      const int *sorted_idx, float *dist2,
+                                      int *idx);
+
 std::vector<at::Tensor> three_nn(at::Tensor unknowns, at::Tensor knows) {
   CHECK_CONTIGUOUS(unknowns);
   CHECK_CONTIGUOUS(knows);
   CHECK_IS_FLOAT(unknowns);
   CHECK_IS_FLOAT(knows);
 
-  if (unknowns.type().is_cuda()) {
+  if (unknowns.is_cuda()) {
     CHECK_CUDA(knows);
   }
 
@@ -33,12 +65,109 @@ std::vector<at::Tensor> three_nn(at::Tensor unknowns, at::Tensor knows) {
       torch::zeros({unknowns.size(0), unknowns.size(1), 3},
                    at::device(unknowns.device()).dtype(at::ScalarType::Float));
 
-  if (unknowns.type().is_cuda()) {
+  if (unknowns.is_cuda()) {
+#ifdef WITH_CUDA
     three_nn_kernel_wrapper(unknowns.size(0), unknowns.size(1), knows.size(1),
-                            unknowns.data<float>(), knows.data<float>(),
-                            dist2.data<float>(), idx.data<int>());
+                            unknowns.data_ptr<float>(), nullptr, knows.data_ptr<float>(),
+                            dist2.data_ptr<float>(), idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    three_nn_cpu_kernel_wrapper(unknowns.size(0), unknowns.size(1), knows.size(1),
+                                unknowns.data_ptr<float>(), nullptr, knows.data_ptr<float>(),
+                                dist2.data_ptr<float>(), idx.data_ptr<int>());
+  }
+
+  return {dist2, idx};
+}
+
+// three_nn for a packed batch of unknowns: the clouds are concatenated in
+// unknowns (N, 3) and cloud i spans offsets[i]:offsets[i + 1]. knows (b, m, 3)
+// is a regular batch. Returns dist2 and idx (N, 3), idx into knows[i].
+std::vector<at::Tensor> three_nn_packed(at::Tensor unknowns,
+                                        at::Tensor offsets, at::Tensor knows) {
+  CHECK_CONTIGUOUS(unknowns);
+  CHECK_CONTIGUOUS(offsets);
+  CHECK_CONTIGUOUS(knows);
+  CHECK_IS_FLOAT(unknowns);
+  CHECK_IS_INT(offsets);
+  CHECK_IS_FLOAT(knows);
+
+  if (unknowns.is_cuda()) {
+    CHECK_CUDA(offsets);
+    CHECK_CUDA(knows);
+  }
+
+  const int b = knows.size(0);
+  TORCH_CHECK(offsets.size(0) == b + 1, "offsets must have b + 1 entries");
+  const int max_n = packed_max_count(offsets);
+  at::Tensor idx =
+      torch::zeros({unknowns.size(0), 3},
+                   at::device(unknowns.device()).dtype(at::ScalarType::Int));
+  at::Tensor dist2 =
+      torch::zeros({unknowns.size(0), 3},
+                   at::device(unknowns.device()).dtype(at::ScalarType::Float));
+
+  if (unknowns.is_cuda()) {
+#ifdef WITH_CUDA
+    three_nn_kernel_wrapper(b, max_n, knows.size(1), unknowns.data_ptr<float>(),
+                            offsets.data_ptr<int>(), knows.data_ptr<float>(),
+                            dist2.data_ptr<float>(), idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    three_nn_cpu_kernel_wrapper(b, max_n, knows.size(1), unknowns.data_ptr<float>(),
+                                offsets.data_ptr<int>(), knows.data_ptr<float>(),
+                                dist2.data_ptr<float>(), idx.data_ptr<int>());
+  }
+
+  return {dist2, idx};
+}
+
+// Same result as three_nn, searching a uniform grid over the known points
+// with about two points per cell instead of scanning all of them.
+std::vector<at::Tensor> three_nn_grid(at::Tensor unknowns, at::Tensor knows) {
+  CHECK_CONTIGUOUS(unknowns);
+  CHECK_CONTIGUOUS(knows);
+  CHECK_IS_FLOAT(unknowns);
+  CHECK_IS_FLOAT(knows);
+
+  if (unknowns.is_cuda()) {
+    CHECK_CUDA(knows);
+  }
+
+  const int b = unknowns.size(0), n = unknowns.size(1), m = knows.size(1);
+  if (m == 0 || n == 0) {
+    return three_nn(unknowns, knows);
+  }
+
+  at::Tensor idx =
+      torch::zeros({b, n, 3},
+                   at::device(unknowns.device()).dtype(at::ScalarType::Int));
+  at::Tensor dist2 =
+      torch::zeros({b, n, 3},
+                   at::device(unknowns.device()).dtype(at::ScalarType::Float));
+
+  PointGrid grid = build_point_grid(knows, 0, m / 2.0);
+
+  if (unknowns.is_cuda()) {
+#ifdef WITH_CUDA
+    three_nn_grid_kernel_wrapper(
+        b, n, m, grid.dims[0], grid.dims[1], grid.dims[2], grid.cell,
+        grid.lo.data_ptr<float>(), unknowns.data_ptr<float>(), knows.data_ptr<float>(),
+        grid.cell_start.data_ptr<int>(), grid.cell_count.data_ptr<int>(),
+        grid.sorted_idx.data_ptr<int>(), dist2.data_ptr<float>(), idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    three_nn_grid_cpu_kernel_wrapper(
+        b, n, m, grid.dims[0], grid.dims[1], grid.dims[2], grid.cell,
+        grid.lo.data_ptr<float>(), unknowns.data_ptr<float>(), knows.data_ptr<float>(),
+        grid.cell_start.data_ptr<int>(), grid.cell_count.data_ptr<int>(),
+        grid.sorted_idx.data_ptr<int>(), dist2.data_ptr<float>(), idx.data_ptr<int>());
   }
 
   return {dist2, idx};
@@ -49,27 +178,36 @@ at::Tensor three_interpolate(at::Tensor points, at::Tensor idx,
   CHECK_CONTIGUOUS(points);
   CHECK_CONTIGUOUS(idx);
   CHECK_CONTIGUOUS(weight);
-  CHECK_IS_FLOAT(points);
+  CHECK_IS_FLOATING(points);
   CHECK_IS_INT(idx);
   CHECK_IS_FLOAT(weight);
 
-  if (points.type().is_cuda()) {
+  if (points.is_cuda()) {
     CHECK_CUDA(idx);
     CHECK_CUDA(weight);
   }
 
   at::Tensor output =
       torch::zeros({points.size(0), points.size(1), idx.size(1)},
-                   at::device(points.device()).dtype(at::ScalarType::Float));
-
-  if (points.type().is_cuda()) {
-    three_interpolate_kernel_wrapper(
-        points.size(0), points.size(1), points.size(2), idx.size(1),
-        points.data<float>(), idx.data<int>(), weight.data<float>(),
-        output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
+                   at::device(points.device()).dtype(points.scalar_type()));
+
+  DISPATCH_FLOATING_TYPES(points.scalar_type(), [&] {
+    if (points.is_cuda()) {
+#ifdef WITH_CUDA
+      three_interpolate_kernel_wrapper(
+          points.size(0), points.size(1), points.size(2), idx.size(1),
+          points.data_ptr<scalar_t>(), idx.data_ptr<int>(), weight.data_ptr<float>(),
+          output.data_ptr<scalar_t>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      three_interpolate_cpu_kernel_wrapper(
+          points.size(0), points.size(1), points.size(2), idx.size(1),
+          points.data_ptr<scalar_t>(), idx.data_ptr<int>(), weight.data_ptr<float>(),
+          output.data_ptr<scalar_t>());
+    }
+  });
 
   return output;
 }
@@ -78,27 +216,37 @@ at::Tensor three_interpolate_grad(at::Tensor grad_out, at::Tensor idx,
   CHECK_CONTIGUOUS(grad_out);
   CHECK_CONTIGUOUS(idx);
   CHECK_CONTIGUOUS(weight);
-  CHECK_IS_FLOAT(grad_out);
+  CHECK_IS_FLOATING(grad_out);
   CHECK_IS_INT(idx);
   CHECK_IS_FLOAT(weight);
 
-  if (grad_out.type().is_cuda()) {
+  if (grad_out.is_cuda()) {
     CHECK_CUDA(idx);
     CHECK_CUDA(weight);
   }
 
+  // Accumulated in float32, every known point receives many contributions
   at::Tensor output =
       torch::zeros({grad_out.size(0), grad_out.size(1), m},
                    at::device(grad_out.device()).dtype(at::ScalarType::Float));
 
-  if (grad_out.type().is_cuda()) {
-    three_interpolate_kernel_wrapper(
-        grad_out.size(0), grad_out.size(1), grad_out.size(2), m,
-        grad_out.data<float>(), idx.data<int>(), weight.data<float>(),
-        output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
-
-  return output;
+  DISPATCH_FLOATING_TYPES(grad_out.scalar_type(), [&] {
+    if (grad_out.is_cuda()) {
+#ifdef WITH_CUDA
+      three_interpolate_grad_kernel_wrapper(
+          grad_out.size(0), grad_out.size(1), grad_out.size(2), m,
+          grad_out.data_ptr<scalar_t>(), idx.data_ptr<int>(), weight.data_ptr<float>(),
+          output.data_ptr<float>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      three_interpolate_grad_cpu_kernel_wrapper(
+          grad_out.size(0), grad_out.size(1), grad_out.size(2), m,
+          grad_out.data_ptr<scalar_t>(), idx.data_ptr<int>(), weight.data_ptr<float>(),
+          output.data_ptr<float>());
+    }
+  });
+
+  return output.to(grad_out.scalar_type());
 }
@@ -0,0 +1,222 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/ATen.h>
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+
+// input: unknown(b, n, 3) known(b, m, 3)
+// output: dist2(b, n, 3), idx(b, n, 3)
+// With offsets (b + 1), unknown, dist2 and idx hold the clouds back to back
+// and cloud i spans offsets[i]:offsets[i + 1].
+void three_nn_cpu_kernel_wrapper(int b, int n, int m, const float *unknown,
+                                 const int *offsets, const float *known,
+                                 float *dist2, int *idx) {
+  const int total = offsets ? offsets[b] : b * n;
+#pragma omp parallel for
+  for (int bj = 0; bj < total; ++bj) {
+    const int i =
+        offsets ? (int)(std::upper_bound(offsets, offsets + b + 1, bj) -
+                        offsets) - 1
+                : bj / n;
+    const float *batch_known = known + i * m * 3;
+    const float ux = unknown[bj * 3 + 0];
+    const float uy = unknown[bj * 3 + 1];
+    const float uz = unknown[bj * 3 + 2];
+
+    double best1 = 1e40, best2 = 1e40, best3 = 1e40;
+    int besti1 = 0, besti2 = 0, besti3 = 0;
+    for (int k = 0; k < m; ++k) {
+      const float x = batch_known[k * 3 + 0];
+      const float y = batch_known[k * 3 + 1];
+      const float z = batch_known[k * 3 + 2];
+      const float d =
+          (ux - x) * (ux - x) + (uy - y) * (uy - y) + (uz - z) * (uz - z);
+      if (d < best1) {
+        best3 = best2;
+        besti3 = besti2;
+        best2 = best1;
+        besti2 = besti1;
+        best1 = d;
+        besti1 = k;
+      } else if (d < best2) {
+        best3 = best2;
+        besti3 = besti2;
+        best2 = d;
+        besti2 = k;
+      } else if (d < best3) {
+        best3 = d;
+        besti3 = k;
+      }
+    }
+    dist2[bj * 3 + 0] = best1;
+    dist2[bj * 3 + 1] = best2;
+    dist2[bj * 3 + 2] = best3;
+
+    idx[bj * 3 + 0] = besti1;
+    idx[bj * 3 + 1] = besti2;
+    idx[bj * 3 + 2] = besti3;
+  }
+}
+
+// Keeps the three smallest (d, k) pairs, ties broken by index like the
+// sequential scan in three_nn.
+static inline void three_nn_push(float d, int k, double *best, int *besti) {
+  if (d < best[0] || (d == best[0] && k < besti[0])) {
+    best[2] = best[1];
+    besti[2] = besti[1];
+    best[1] = best[0];
+    besti[1] = besti[0];
+    best[0] = d;
+    besti[0] = k;
+  } else if (d < best[1] || (d == best[1] && k < besti[1])) {
+    best[2] = best[1];
+    besti[2] = besti[1];
+    best[1] = d;
+    besti[1] = k;
+  } else if (d < best[2] || (d == best[2] && k < besti[2])) {
+    best[2] = d;
+    besti[2] = k;
+  }
+}
+
+static inline int cell_coord(float v, float lo, float cell) {
+  return (int)std::floor(std::min(std::max((v - lo) / cell, -1e6f), 1e6f));
+}
+
+static inline int cells_outside(int q, int d) {
+  return q < 0 ? -q : (q >= d ? q - d + 1 : 0);
+}
+
+// input: unknown(b, n, 3) known(b, m, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, m)
+// output: dist2(b, n, 3), idx(b, n, 3)
+// Visits the cells of the grid in rings of growing Chebyshev distance around
+// the cell of the unknown point, and stops once the third neighbor is closer
+// than anything in the next ring can be.
+void three_nn_grid_cpu_kernel_wrapper(int b, int n, int m, int dx, int dy,
+                                      int dz, float cell, const float *lo,
+                                      const float *unknown, const float *known,
+                                      const int *cell_start,
+                                      const int *cell_count,
+                                      const int *sorted_idx, float *dist2,
+                                      int *idx) {
+  const int ncell = dx * dy * dz;
+#pragma omp parallel for
+  for (int bj = 0; bj < b * n; ++bj) {
+    const int i = bj / n;
+    const float *batch_known = known + i * m * 3;
+    const float *batch_lo = lo + i * 3;
+    const int *batch_start = cell_start + i * ncell;
+    const int *batch_count = cell_count + i * ncell;
+    const float ux = unknown[bj * 3 + 0];
+    const float uy = unknown[bj * 3 + 1];
+    const float uz = unknown[bj * 3 + 2];
+    const int qx = cell_coord(ux, batch_lo[0], cell);
+    const int qy = cell_coord(uy, batch_lo[1], cell);
+    const int qz = cell_coord(uz, batch_lo[2], cell);
+    const int r0 = std::max(cells_outside(qx, dx),
+                            std::max(cells_outside(qy, dy),
+                                     cells_outside(qz, dz)));
+    const int rmax = std::max(std::max(std::max(qx, dx - 1 - qx),
+                                       std::max(qy, dy - 1 - qy)),
+                              std::max(qz, dz - 1 - qz));
+
+    double best[3] = {1e40, 1e40, 1e40};
+    int besti[3] = {0, 0, 0};
+    for (int r = r0; r <= rmax; ++r) {
+      for (int x = std::max(qx - r, 0); x <= std::min(qx + r, dx - 1); ++x) {
+        for (int y = std::max(qy - r, 0); y <= std::min(qy + r, dy - 1); ++y) {
+          const bool shell = std::abs(x - qx) == r || std::abs(y - qy) == r;
+          const int zstep = shell ? 1 : std::max(2 * r, 1);
+          for (int z = qz - r; z <= qz + r; z += zstep) {
+            if (z < 0 || z >= dz) continue;
+            const int c = (x * dy + y) * dz + z;
+            const int *cell_idx = sorted_idx + batch_start[c];
+            for (int p = 0; p < batch_count[c]; ++p) {
+              const int k = cell_idx[p];
+              const float x2 = batch_known[k * 3 + 0];
+              const float y2 = batch_known[k * 3 + 1];
+              const float z2 = batch_known[k * 3 + 2];
+              const float d = (ux - x2) * (ux - x2) + (uy - y2) * (uy - y2) +
+                              (uz - z2) * (uz - z2);
+              three_nn_push(d, k, best, besti);
+            }
+          }
+        }
+      }
+      // Points beyond ring r are more than r cells away along some axis.
+      const double bound = 0.999 * (double)r * cell * r * cell;
+      if (best[2] < bound) break;
+    }
+    dist2[bj * 3 + 0] = best[0];
+    dist2[bj * 3 + 1] = best[1];
+    dist2[bj * 3 + 2] = best[2];
+
+    idx[bj * 3 + 0] = besti[0];
+    idx[bj * 3 + 1] = besti[1];
+    idx[bj * 3 + 2] = besti[2];
+  }
+}
+
+// input: points(b, c, m), idx(b, n, 3), weight(b, n, 3)
+// output: out(b, c, n)
+template <typename scalar_t>
+void three_interpolate_cpu_kernel_wrapper(int b, int c, int m, int n,
+                                          const scalar_t *points, const int *idx,
+                                          const float *weight, scalar_t *out) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *points_row = points + bc * m;
+    const int *batch_idx = idx + i * n * 3;
+    const float *batch_weight = weight + i * n * 3;
+    scalar_t *out_row = out + bc * n;
+    for (int j = 0; j < n; ++j) {
+      const float p1 = static_cast<float>(points_row[batch_idx[j * 3 + 0]]);
+      const float p2 = static_cast<float>(points_row[batch_idx[j * 3 + 1]]);
+      const float p3 = static_cast<float>(points_row[batch_idx[j * 3 + 2]]);
+      out_row[j] = static_cast<scalar_t>(p1 * batch_weight[j * 3 + 0] +
+                                         p2 * batch_weight[j * 3 + 1] +
+                                         p3 * batch_weight[j * 3 + 2]);
+    }
+  }
+}
+
+// input: grad_out(b, c, n), idx(b, n, 3), weight(b, n, 3)
+// output: grad_points(b, c, m)
+template <typename scalar_t>
+void three_interpolate_grad_cpu_kernel_wrapper(int b, int c, int n, int m,
+                                               const scalar_t *grad_out,
+                                               const int *idx,
+                                               const float *weight,
+                                               float *grad_points) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *grad_out_row = grad_out + bc * n;
+    const int *batch_idx = idx + i * n * 3;
+    const float *batch_weight = weight + i * n * 3;
+    float *grad_points_row = grad_points + bc * m;
+    for (int j = 0; j < n; ++j) {
+      const float g = static_cast<float>(grad_out_row[j]);
+      grad_points_row[batch_idx[j * 3 + 0]] += g * batch_weight[j * 3 + 0];
+      grad_points_row[batch_idx[j * 3 + 1]] += g * batch_weight[j * 3 + 1];
+      grad_points_row[batch_idx[j * 3 + 2]] += g * batch_weight[j * 3 + 2];
+    }
+  }
+}
+
+#define INSTANTIATE(scalar_t)                                          \
+  template void three_interpolate_cpu_kernel_wrapper<scalar_t>(        \
+      int, int, int, int, const scalar_t *, const int *, const float *, \
+      scalar_t *);                                                     \
+  template void three_interpolate_grad_cpu_kernel_wrapper<scalar_t>(   \
+      int, int, int, int, const scalar_t *, const int *, const float *, \
+      float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
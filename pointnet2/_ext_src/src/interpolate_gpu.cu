@@ -11,16 +11,21 @@
 
 // input: unknown(b, n, 3) known(b, m, 3)
 // output: dist2(b, n, 3), idx(b, n, 3)
+// With offsets (b + 1), cloud i of unknown, dist2 and idx spans
+// offsets[i]:offsets[i + 1].
 __global__ void three_nn_kernel(int b, int n, int m,
                                 const float *__restrict__ unknown,
+                                const int *__restrict__ offsets,
                                 const float *__restrict__ known,
                                 float *__restrict__ dist2,
                                 int *__restrict__ idx) {
   int batch_index = blockIdx.x;
-  unknown += batch_index * n * 3;
+  const int start = offsets ? offsets[batch_index] : batch_index * n;
+  if (offsets) n = offsets[batch_index + 1] - start;
+  unknown += start * 3;
   known += batch_index * m * 3;
-  dist2 += batch_index * n * 3;
-  idx += batch_index * n * 3;
+  dist2 += start * 3;
+  idx += start * 3;
 
   int index = threadIdx.x;
   int stride = blockDim.x;
@@ -64,21 +69,132 @@ __global__ void three_nn_kernel(int b, int n, int m,
 }
 
 void three_nn_kernel_wrapper(int b, int n, int m, const float *unknown,
-                             const float *known, float *dist2, int *idx) {
+                             const int *offsets, const float *known,
+                             float *dist2, int *idx) {
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+  three_nn_kernel<<<b, opt_n_threads(n), 0, stream>>>(b, n, m, unknown,
+                                                      offsets, known, dist2,
+                                                      idx);
+
+  CUDA_CHECK_ERRORS();
+}
+
+// Keeps the three smallest (d, k) pairs, ties broken by index like the
+// sequential scan in three_nn.
+__device__ inline void three_nn_push(float d, int k, double *best, int *besti) {
+  if (d < best[0] || (d == best[0] && k < besti[0])) {
+    best[2] = best[1];
+    besti[2] = besti[1];
+    best[1] = best[0];
+    besti[1] = besti[0];
+    best[0] = d;
+    besti[0] = k;
+  } else if (d < best[1] || (d == best[1] && k < besti[1])) {
+    best[2] = best[1];
+    besti[2] = besti[1];
+    best[1] = d;
+    besti[1] = k;
+  } else if (d < best[2] || (d == best[2] && k < besti[2])) {
+    best[2] = d;
+    besti[2] = k;
+  }
+}
+
+__device__ inline int cell_coord(float v, float lo, float cell) {
+  return (int)floorf(fminf(fmaxf((v - lo) / cell, -1e6f), 1e6f));
+}
+
+__device__ inline int cells_outside(int q, int d) {
+  return q < 0 ? -q : (q >= d ? q - d + 1 : 0);
+}
+
+// input: unknown(b, n, 3) known(b, m, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, m)
+// output: dist2(b, n, 3), idx(b, n, 3)
+// Ring search of three_nn_grid_cpu_kernel_wrapper, one thread per point.
+__global__ void three_nn_grid_kernel(
+    int b, int n, int m, int dx, int dy, int dz, float cell,
+    const float *__restrict__ lo, const float *__restrict__ unknown,
+    const float *__restrict__ known, const int *__restrict__ cell_start,
+    const int *__restrict__ cell_count, const int *__restrict__ sorted_idx,
+    float *__restrict__ dist2, int *__restrict__ idx) {
+  const int ncell = dx * dy * dz;
+  const int i = blockIdx.x;
+  for (int bj = i * n + threadIdx.x; bj < (i + 1) * n; bj += blockDim.x) {
+    const float *batch_known = known + i * m * 3;
+    const float *batch_lo = lo + i * 3;
+    const int *batch_start = cell_start + i * ncell;
+    const int *batch_count = cell_count + i * ncell;
+    const float ux = unknown[bj * 3 + 0];
+    const float uy = unknown[bj * 3 + 1];
+    const float uz = unknown[bj * 3 + 2];
+    const int qx = cell_coord(ux, batch_lo[0], cell);
+    const int qy = cell_coord(uy, batch_lo[1], cell);
+    const int qz = cell_coord(uz, batch_lo[2], cell);
+    const int r0 = max(cells_outside(qx, dx),
+                       max(cells_outside(qy, dy), cells_outside(qz, dz)));
+    const int rmax = max(max(max(qx, dx - 1 - qx), max(qy, dy - 1 - qy)),
+                         max(qz, dz - 1 - qz));
+
+    double best[3] = {1e40, 1e40, 1e40};
+    int besti[3] = {0, 0, 0};
+    for (int r = r0; r <= rmax; ++r) {
+      for (int x = max(qx - r, 0); x <= min(qx + r, dx - 1); ++x) {
+        for (int y = max(qy - r, 0); y <= min(qy + r, dy - 1); ++y) {
+          const bool shell = abs(x - qx) == r || abs(y - qy) == r;
+          const int zstep = shell ? 1 : max(2 * r, 1);
+          for (int z = qz - r; z <= qz + r; z += zstep) {
+            if (z < 0 || z >= dz) continue;
+            const int c = (x * dy + y) * dz + z;
+            const int *cell_idx = sorted_idx + batch_start[c];
+            for (int p = 0; p < batch_count[c]; ++p) {
+              const int k = cell_idx[p];
+              const float x2 = batch_known[k * 3 + 0];
+              const float y2 = batch_known[k * 3 + 1];
+              const float z2 = batch_known[k * 3 + 2];
+              const float d = (ux - x2) * (ux - x2) + (uy - y2) * (uy - y2) +
+                              (uz - z2) * (uz - z2);
+              three_nn_push(d, k, best, besti);
+            }
+          }
+        }
+      }
+      // Points beyond ring r are more than r cells away along some axis.
+      const double bound = 0.999 * (double)r * cell * r * cell;
+      if (best[2] < bound) break;
+    }
+    dist2[bj * 3 + 0] = best[0];
+    dist2[bj * 3 + 1] = best[1];
+    dist2[bj * 3 + 2] = best[2];
+
+    idx[bj * 3 + 0] = besti[0];
+    idx[bj * 3 + 1] = besti[1];
+    idx[bj * 3 + 2] = besti[2];
+  }
+}
+
+void three_nn_grid_kernel_wrapper(int b, int n, int m, int dx, int dy, int dz,
+                                  float cell, const float *lo,
+                                  const float *unknown, const float *known,
+                                  const int *cell_start, const int *cell_count,
+                                  const int *sorted_idx, float *dist2,
+                                  int *idx) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-  three_nn_kernel<<<b, opt_n_threads(n), 0, stream>>>(b, n, m, unknown, known,
-                                                      dist2, idx);
+  three_nn_grid_kernel<<<b, opt_n_threads(n), 0, stream>>>(
+      b, n, m, dx, dy, dz, cell, lo, unknown, known, cell_start, cell_count,
+      sorted_idx, dist2, idx);
 
   CUDA_CHECK_ERRORS();
 }
 
 // input: points(b, c, m), idx(b, n, 3), weight(b, n, 3)
 // output: out(b, c, n)
+template <typename scalar_t>
 __global__ void three_interpolate_kernel(int b, int c, int m, int n,
-                                         const float *__restrict__ points,
+                                         const scalar_t *__restrict__ points,
                                          const int *__restrict__ idx,
                                          const float *__restrict__ weight,
-                                         float *__restrict__ out) {
+                                         scalar_t *__restrict__ out) {
   int batch_index = blockIdx.x;
   points += batch_index * m * c;
 
@@ -100,16 +216,18 @@ __global__ void three_interpolate_kernel(int b, int c, int m, int n,
     int i2 = idx[j * 3 + 1];
     int i3 = idx[j * 3 + 2];
 
-    out[i] = points[l * m + i1] * w1 + points[l * m + i2] * w2 +
-             points[l * m + i3] * w3;
+    out[i] = static_cast<scalar_t>(static_cast<float>(points[l * m + i1]) * w1 +
+                                   static_cast<float>(points[l * m + i2]) * w2 +
+                                   static_cast<float>(points[l * m + i3]) * w3);
   }
 }
 
+template <typename scalar_t>
 void three_interpolate_kernel_wrapper(int b, int c, int m, int n,
-                                      const float *points, const int *idx,
-                                      const float *weight, float *out) {
+                                      const scalar_t *points, const int *idx,
+                                      const float *weight, scalar_t *out) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-  three_interpolate_kernel<<<b, opt_block_config(n, c), 0, stream>>>(
+  three_interpolate_kernel<scalar_t><<<b, opt_block_config(n, c), 0, stream>>>(
       b, c, m, n, points, idx, weight, out);
 
   CUDA_CHECK_ERRORS();
@@ -118,8 +236,9 @@ void three_interpolate_kernel_wrapper(int b, int c, int m, int n,
 // input: grad_out(b, c, n), idx(b, n, 3), weight(b, n, 3)
 // output: grad_points(b, c, m)
 
+template <typename scalar_t>
 __global__ void three_interpolate_grad_kernel(
-    int b, int c, int n, int m, const float *__restrict__ grad_out,
+    int b, int c, int n, int m, const scalar_t *__restrict__ grad_out,
     const int *__restrict__ idx, const float *__restrict__ weight,
     float *__restrict__ grad_points) {
   int batch_index = blockIdx.x;
@@ -141,19 +260,33 @@ __global__ void three_interpolate_grad_kernel(
     int i2 = idx[j * 3 + 1];
     int i3 = idx[j * 3 + 2];
 
-    atomicAdd(grad_points + l * m + i1, grad_out[i] * w1);
-    atomicAdd(grad_points + l * m + i2, grad_out[i] * w2);
-    atomicAdd(grad_points + l * m + i3, grad_out[i] * w3);
+    const float g = static_cast<float>(grad_out[i]);
+    atomicAdd(grad_points + l * m + i1, g * w1);
+    atomicAdd(grad_points + l * m + i2, g * w2);
+    atomicAdd(grad_points + l * m + i3, g * w3);
   }
 }
 
+template <typename scalar_t>
 void three_interpolate_grad_kernel_wrapper(int b, int c, int n, int m,
-                                           const float *grad_out,
+                                           const scalar_t *grad_out,
                                            const int *idx, const float *weight,
                                            float *grad_points) {
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-  three_interpolate_grad_kernel<<<b, opt_block_config(n, c), 0, stream>>>(
-      b, c, n, m, grad_out, idx, weight, grad_points);
+  three_interpolate_grad_kernel<scalar_t>
+      <<<b, opt_block_config(n, c), 0, stream>>>(b, c, n, m, grad_out, idx,
+                                                 weight, grad_points);
 
   CUDA_CHECK_ERRORS();
 }
+
+#define INSTANTIATE(scalar_t)                                          \
+  template void three_interpolate_kernel_wrapper<scalar_t>(            \
+      int, int, int, int, const scalar_t *, const int *, const float *, \
+      scalar_t *);                                                     \
+  template void three_interpolate_grad_kernel_wrapper<scalar_t>(       \
+      int, int, int, int, const scalar_t *, const int *, const float *, \
+      float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
@@ -0,0 +1,69 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include "grid.h"
+#include "knn_query.h"
+#include "utils.h"
+
+void knn_query_kernel_wrapper(int b, int n, int m, int nsample, int dx, int dy,
+                              int dz, float cell, const float *lo,
+                              const float *new_xyz, const float *xyz,
+                              const int *cell_start, const int *cell_count,
+                              const int *sorted_idx, float *dist2, int *idx);
+void knn_query_cpu_kernel_wrapper(int b, int n, int m, int nsample, int dx,
+                                  int dy, int dz, float cell, const float *lo,
+                                  const float *new_xyz, const float *xyz,
+                                  const int *cell_start, const int *cell_count,
+                                  const int *sorted_idx, float *dist2,
+                                  int *idx);
+
+// The nsample nearest points of xyz to every center of new_xyz, sorted by
+// (distance, index). The points are binned into a uniform grid with a few
+// neighbors per cell, which is searched in rings around each center like
+// three_nn_grid. Clouds with fewer than nsample points repeat the nearest one.
+std::vector<at::Tensor> knn_query(at::Tensor new_xyz, at::Tensor xyz,
+                                  const int nsample) {
+  CHECK_CONTIGUOUS(new_xyz);
+  CHECK_CONTIGUOUS(xyz);
+  CHECK_IS_FLOAT(new_xyz);
+  CHECK_IS_FLOAT(xyz);
+
+  if (new_xyz.is_cuda()) {
+    CHECK_CUDA(xyz);
+  }
+
+  const int b = xyz.size(0), n = xyz.size(1), m = new_xyz.size(1);
+  at::Tensor idx =
+      torch::zeros({b, m, nsample},
+                   at::device(new_xyz.device()).dtype(at::ScalarType::Int));
+  at::Tensor dist2 =
+      torch::zeros({b, m, nsample},
+                   at::device(new_xyz.device()).dtype(at::ScalarType::Float));
+  if (n == 0 || m == 0 || nsample <= 0) {
+    return {dist2, idx};
+  }
+
+  PointGrid grid = build_point_grid(xyz, 0, 4.0 * n / nsample);
+
+  if (new_xyz.is_cuda()) {
+#ifdef WITH_CUDA
+    knn_query_kernel_wrapper(
+        b, n, m, nsample, grid.dims[0], grid.dims[1], grid.dims[2], grid.cell,
+        grid.lo.data_ptr<float>(), new_xyz.data_ptr<float>(), xyz.data_ptr<float>(),
+        grid.cell_start.data_ptr<int>(), grid.cell_count.data_ptr<int>(),
+        grid.sorted_idx.data_ptr<int>(), dist2.data_ptr<float>(), idx.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    knn_query_cpu_kernel_wrapper(
+        b, n, m, nsample, grid.dims[0], grid.dims[1], grid.dims[2], grid.cell,
+        grid.lo.data_ptr<float>(), new_xyz.data_ptr<float>(), xyz.data_ptr<float>(),
+        grid.cell_start.data_ptr<int>(), grid.cell_count.data_ptr<int>(),
+        grid.sorted_idx.data_ptr<int>(), dist2.data_ptr<float>(), idx.data_ptr<int>());
+  }
+
+  return {dist2, idx};
+}
@@ -0,0 +1,102 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <utility>
+#include <vector>
+
+static inline int cell_coord(float v, float lo, float cell) {
+  return (int)std::floor(std::min(std::max((v - lo) / cell, -1e6f), 1e6f));
+}
+
+static inline int cells_outside(int q, int d) {
+  return q < 0 ? -q : (q >= d ? q - d + 1 : 0);
+}
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, n)
+// output: dist2(b, m, nsample), idx(b, m, nsample)
+// Ring search of three_nn_grid_cpu_kernel_wrapper, keeping the nsample
+// smallest (d, k) pairs in a max-heap.
+void knn_query_cpu_kernel_wrapper(int b, int n, int m, int nsample, int dx,
+                                  int dy, int dz, float cell, const float *lo,
+                                  const float *new_xyz, const float *xyz,
+                                  const int *cell_start, const int *cell_count,
+                                  const int *sorted_idx, float *dist2,
+                                  int *idx) {
+  const int ncell = dx * dy * dz;
+  const int kmax = std::min(nsample, n);
+#pragma omp parallel
+  {
+    std::vector<std::pair<float, int>> heap;
+    heap.reserve(kmax);
+#pragma omp for
+    for (int bj = 0; bj < b * m; ++bj) {
+      const int i = bj / m;
+      const float *batch_xyz = xyz + i * n * 3;
+      const float *batch_lo = lo + i * 3;
+      const int *batch_start = cell_start + i * ncell;
+      const int *batch_count = cell_count + i * ncell;
+      const float new_x = new_xyz[bj * 3 + 0];
+      const float new_y = new_xyz[bj * 3 + 1];
+      const float new_z = new_xyz[bj * 3 + 2];
+      const int qx = cell_coord(new_x, batch_lo[0], cell);
+      const int qy = cell_coord(new_y, batch_lo[1], cell);
+      const int qz = cell_coord(new_z, batch_lo[2], cell);
+      const int r0 = std::max(cells_outside(qx, dx),
+                              std::max(cells_outside(qy, dy),
+                                       cells_outside(qz, dz)));
+      const int rmax = std::max(std::max(std::max(qx, dx - 1 - qx),
+                                         std::max(qy, dy - 1 - qy)),
+                                std::max(qz, dz - 1 - qz));
+
+      heap.clear();
+      for (int r = r0; r <= rmax; ++r) {
+        for (int x = std::max(qx - r, 0); x <= std::min(qx + r, dx - 1); ++x) {
+          for (int y = std::max(qy - r, 0); y <= std::min(qy + r, dy - 1);
+               ++y) {
+            const bool shell = std::abs(x - qx) == r || std::abs(y - qy) == r;
+            const int zstep = shell ? 1 : std::max(2 * r, 1);
+            for (int z = qz - r; z <= qz + r; z += zstep) {
+              if (z < 0 || z >= dz) continue;
+              const int c = (x * dy + y) * dz + z;
+              const int *cell_idx = sorted_idx + batch_start[c];
+              for (int p = 0; p < batch_count[c]; ++p) {
+                const int k = cell_idx[p];
+                const float x2 = batch_xyz[k * 3 + 0];
+                const float y2 = batch_xyz[k * 3 + 1];
+                const float z2 = batch_xyz[k * 3 + 2];
+                const float d = (new_x - x2) * (new_x - x2) +
+                                (new_y - y2) * (new_y - y2) +
+                                (new_z - z2) * (new_z - z2);
+                const std::pair<float, int> item(d, k);
+                if ((int)heap.size() < kmax) {
+                  heap.push_back(item);
+                  std::push_heap(heap.begin(), heap.end());
+                } else if (item < heap.front()) {
+                  std::pop_heap(heap.begin(), heap.end());
+                  heap.back() = item;
+                  std::push_heap(heap.begin(), heap.end());
+                }
+              }
+            }
+          }
+        }
+        // Points beyond ring r are more than r cells away along some axis.
+        const double bound = 0.999 * (double)r * cell * r * cell;
+        if ((int)heap.size() == kmax && heap.front().first < bound) break;
+      }
+
+      std::sort_heap(heap.begin(), heap.end());
+      for (int l = 0; l < nsample; ++l) {
+        const std::pair<float, int> &item = heap[l < kmax ? l : 0];
+        dist2[bj * nsample + l] = item.first;
+        idx[bj * nsample + l] = item.second;
+      }
+    }
+  }
+}
@@ -0,0 +1,115 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "cuda_utils.h"
+
+__device__ inline int cell_coord(float v, float lo, float cell) {
+  return (int)floorf(fminf(fmaxf((v - lo) / cell, -1e6f), 1e6f));
+}
+
+__device__ inline int cells_outside(int q, int d) {
+  return q < 0 ? -q : (q >= d ? q - d + 1 : 0);
+}
+
+// Insertion into the sorted (d, k) list dist[0:cnt], idx[0:cnt] of at most
+// kmax entries.
+__device__ inline void knn_push(float d, int k, int kmax, int &cnt,
+                                float *dist, int *idx) {
+  if (cnt == kmax && !(d < dist[kmax - 1] ||
+                       (d == dist[kmax - 1] && k < idx[kmax - 1]))) {
+    return;
+  }
+  int p = cnt < kmax ? cnt++ : kmax - 1;
+  while (p > 0 && (d < dist[p - 1] || (d == dist[p - 1] && k < idx[p - 1]))) {
+    dist[p] = dist[p - 1];
+    idx[p] = idx[p - 1];
+    --p;
+  }
+  dist[p] = d;
+  idx[p] = k;
+}
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3) lo(b, 3)
+//        cell_start(b, ncell) cell_count(b, ncell) sorted_idx(b, n)
+// output: dist2(b, m, nsample), idx(b, m, nsample)
+// Ring search of knn_query_cpu_kernel_wrapper, one thread per center, which
+// keeps its neighbors sorted in its own rows of the outputs.
+__global__ void knn_query_kernel(
+    int b, int n, int m, int nsample, int dx, int dy, int dz, float cell,
+    const float *__restrict__ lo, const float *__restrict__ new_xyz,
+    const float *__restrict__ xyz, const int *__restrict__ cell_start,
+    const int *__restrict__ cell_count, const int *__restrict__ sorted_idx,
+    float *__restrict__ dist2, int *__restrict__ idx) {
+  const int ncell = dx * dy * dz;
+  const int kmax = min(nsample, n);
+  const int i = blockIdx.x;
+  for (int bj = i * m + threadIdx.x; bj < (i + 1) * m; bj += blockDim.x) {
+    const float *batch_xyz = xyz + i * n * 3;
+    const float *batch_lo = lo + i * 3;
+    const int *batch_start = cell_start + i * ncell;
+    const int *batch_count = cell_count + i * ncell;
+    const float new_x = new_xyz[bj * 3 + 0];
+    const float new_y = new_xyz[bj * 3 + 1];
+    const float new_z = new_xyz[bj * 3 + 2];
+    const int qx = cell_coord(new_x, batch_lo[0], cell);
+    const int qy = cell_coord(new_y, batch_lo[1], cell);
+    const int qz = cell_coord(new_z, batch_lo[2], cell);
+    const int r0 = max(cells_outside(qx, dx),
+                       max(cells_outside(qy, dy), cells_outside(qz, dz)));
+    const int rmax = max(max(max(qx, dx - 1 - qx), max(qy, dy - 1 - qy)),
+                         max(qz, dz - 1 - qz));
+    float *dist_row = dist2 + bj * nsample;
+    int *idx_row = idx + bj * nsample;
+
+    int cnt = 0;
+    for (int r = r0; r <= rmax; ++r) {
+      for (int x = max(qx - r, 0); x <= min(qx + r, dx - 1); ++x) {
+        for (int y = max(qy - r, 0); y <= min(qy + r, dy - 1); ++y) {
+          const bool shell = abs(x - qx) == r || abs(y - qy) == r;
+          const int zstep = shell ? 1 : max(2 * r, 1);
+          for (int z = qz - r; z <= qz + r; z += zstep) {
+            if (z < 0 || z >= dz) continue;
+            const int c = (x * dy + y) * dz + z;
+            const int *cell_idx = sorted_idx + batch_start[c];
+            for (int p = 0; p < batch_count[c]; ++p) {
+              const int k = cell_idx[p];
+              const float x2 = batch_xyz[k * 3 + 0];
+              const float y2 = batch_xyz[k * 3 + 1];
+              const float z2 = batch_xyz[k * 3 + 2];
+              const float d = (new_x - x2) * (new_x - x2) +
+                              (new_y - y2) * (new_y - y2) +
+                              (new_z - z2) * (new_z - z2);
+              knn_push(d, k, kmax, cnt, dist_row, idx_row);
+            }
+          }
+        }
+      }
+      // Points beyond ring r are more than r cells away along some axis.
+      const double bound = 0.999 * (double)r * cell * r * cell;
+      if (cnt == kmax && dist_row[kmax - 1] < bound) break;
+    }
+    for (int l = kmax; l < nsample; ++l) {
+      dist_row[l] = dist_row[0];
+      idx_row[l] = idx_row[0];
+    }
+  }
+}
+
+void knn_query_kernel_wrapper(int b, int n, int m, int nsample, int dx, int dy,
+                              int dz, float cell, const float *lo,
+                              const float *new_xyz, const float *xyz,
+                              const int *cell_start, const int *cell_count,
+                              const int *sorted_idx, float *dist2, int *idx) {
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+  knn_query_kernel<<<b, opt_n_threads(m), 0, stream>>>(
+      b, n, m, nsample, dx, dy, dz, cell, lo, new_xyz, xyz, cell_start,
+      cell_count, sorted_idx, dist2, idx);
+
+  CUDA_CHECK_ERRORS();
+}
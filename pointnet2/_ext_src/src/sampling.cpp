@@ -6,38 +6,63 @@
 #include "sampling.h"
 #include "utils.h"
 
+template <typename scalar_t>
 void gather_points_kernel_wrapper(int b, int c, int n, int npoints,
-                                  const float *points, const int *idx,
-                                  float *out);
+                                  const scalar_t *points, const int *idx,
+                                  scalar_t *out);
+template <typename scalar_t>
 void gather_points_grad_kernel_wrapper(int b, int c, int n, int npoints,
-                                       const float *grad_out, const int *idx,
+                                       const scalar_t *grad_out, const int *idx,
                                        float *grad_points);
 
 void furthest_point_sampling_kernel_wrapper(int b, int n, int m,
-                                            const float *dataset, float *temp,
+                                            const float *dataset,
+                                            const int *offsets, float *temp,
                                             int *idxs);
 
+template <typename scalar_t>
+void gather_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                      const scalar_t *points, const int *idx,
+                                      scalar_t *out);
+template <typename scalar_t>
+void gather_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                           const scalar_t *grad_out,
+                                           const int *idx,
+                                           float *grad_points);
+void furthest_point_sampling_cpu_kernel_wrapper(int b, int n, int m,
+                                                const float *dataset,
+                                                const int *offsets,
+                                                float *temp, int *idxs);
+
 at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
   CHECK_CONTIGUOUS(points);
   CHECK_CONTIGUOUS(idx);
-  CHECK_IS_FLOAT(points);
+  CHECK_IS_FLOATING(points);
   CHECK_IS_INT(idx);
 
-  if (points.type().is_cuda()) {
+  if (points.is_cuda()) {
     CHECK_CUDA(idx);
   }
 
   at::Tensor output =
       torch::zeros({points.size(0), points.size(1), idx.size(1)},
-                   at::device(points.device()).dtype(at::ScalarType::Float));
-
-  if (points.type().is_cuda()) {
-    gather_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
-                                 idx.size(1), points.data<float>(),
-                                 idx.data<int>(), output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
+                   at::device(points.device()).dtype(points.scalar_type()));
+
+  DISPATCH_FLOATING_TYPES(points.scalar_type(), [&] {
+    if (points.is_cuda()) {
+#ifdef WITH_CUDA
+      gather_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
+                                   idx.size(1), points.data_ptr<scalar_t>(),
+                                   idx.data_ptr<int>(), output.data_ptr<scalar_t>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      gather_points_cpu_kernel_wrapper(points.size(0), points.size(1), points.size(2),
+                                       idx.size(1), points.data_ptr<scalar_t>(),
+                                       idx.data_ptr<int>(), output.data_ptr<scalar_t>());
+    }
+  });
 
   return output;
 }
@@ -46,26 +71,35 @@ at::Tensor gather_points_grad(at::Tensor grad_out, at::Tensor idx,
                               const int n) {
   CHECK_CONTIGUOUS(grad_out);
   CHECK_CONTIGUOUS(idx);
-  CHECK_IS_FLOAT(grad_out);
+  CHECK_IS_FLOATING(grad_out);
   CHECK_IS_INT(idx);
 
-  if (grad_out.type().is_cuda()) {
+  if (grad_out.is_cuda()) {
     CHECK_CUDA(idx);
   }
 
+  // Accumulated in float32, an index can be picked several times
   at::Tensor output =
       torch::zeros({grad_out.size(0), grad_out.size(1), n},
                    at::device(grad_out.device()).dtype(at::ScalarType::Float));
 
-  if (grad_out.type().is_cuda()) {
-    gather_points_grad_kernel_wrapper(grad_out.size(0), grad_out.size(1), n,
-                                      idx.size(1), grad_out.data<float>(),
-                                      idx.data<int>(), output.data<float>());
-  } else {
-    AT_CHECK(false, "CPU not supported");
-  }
-
-  return output;
+  DISPATCH_FLOATING_TYPES(grad_out.scalar_type(), [&] {
+    if (grad_out.is_cuda()) {
+#ifdef WITH_CUDA
+      gather_points_grad_kernel_wrapper(grad_out.size(0), grad_out.size(1), n,
+                                        idx.size(1), grad_out.data_ptr<scalar_t>(),
+                                        idx.data_ptr<int>(), output.data_ptr<float>());
+#else
+      TORCH_CHECK(false, "CUDA not supported");
+#endif
+    } else {
+      gather_points_grad_cpu_kernel_wrapper(grad_out.size(0), grad_out.size(1), n,
+                                            idx.size(1), grad_out.data_ptr<scalar_t>(),
+                                            idx.data_ptr<int>(), output.data_ptr<float>());
+    }
+  });
+
+  return output.to(grad_out.scalar_type());
 }
 at::Tensor furthest_point_sampling(at::Tensor points, const int nsamples) {
   CHECK_CONTIGUOUS(points);
@@ -79,13 +113,61 @@ at::Tensor furthest_point_sampling(at::Tensor points, const int nsamples) {
       torch::full({points.size(0), points.size(1)}, 1e10,
                   at::device(points.device()).dtype(at::ScalarType::Float));
 
-  if (points.type().is_cuda()) {
+  if (points.is_cuda()) {
+#ifdef WITH_CUDA
     furthest_point_sampling_kernel_wrapper(
-        points.size(0), points.size(1), nsamples, points.data<float>(),
-        tmp.data<float>(), output.data<int>());
+        points.size(0), points.size(1), nsamples, points.data_ptr<float>(),
+        nullptr, tmp.data_ptr<float>(), output.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    furthest_point_sampling_cpu_kernel_wrapper(
+        points.size(0), points.size(1), nsamples, points.data_ptr<float>(),
+        nullptr, tmp.data_ptr<float>(), output.data_ptr<int>());
   }
 
   return output;
 }
+
+// FPS on a packed batch: the clouds are concatenated in points (N, 3) and
+// cloud i spans offsets[i]:offsets[i + 1]. Returns (b, nsamples) indices
+// into points.
+at::Tensor furthest_point_sampling_packed(at::Tensor points,
+                                          at::Tensor offsets,
+                                          const int nsamples) {
+  CHECK_CONTIGUOUS(points);
+  CHECK_CONTIGUOUS(offsets);
+  CHECK_IS_FLOAT(points);
+  CHECK_IS_INT(offsets);
+
+  if (points.is_cuda()) {
+    CHECK_CUDA(offsets);
+  }
+
+  const int b = offsets.size(0) - 1;
+  const int max_n = packed_max_count(offsets);
+  at::Tensor output =
+      torch::zeros({b, nsamples},
+                   at::device(points.device()).dtype(at::ScalarType::Int));
+
+  at::Tensor tmp =
+      torch::full({points.size(0)}, 1e10,
+                  at::device(points.device()).dtype(at::ScalarType::Float));
+
+  if (points.is_cuda()) {
+#ifdef WITH_CUDA
+    furthest_point_sampling_kernel_wrapper(
+        b, max_n, nsamples, points.data_ptr<float>(), offsets.data_ptr<int>(),
+        tmp.data_ptr<float>(), output.data_ptr<int>());
+#else
+    TORCH_CHECK(false, "CUDA not supported");
+#endif
+  } else {
+    furthest_point_sampling_cpu_kernel_wrapper(
+        b, max_n, nsamples, points.data_ptr<float>(), offsets.data_ptr<int>(),
+        tmp.data_ptr<float>(), output.data_ptr<int>());
+  }
+
+  return output + offsets.narrow(0, 0, b).unsqueeze(1);
+}
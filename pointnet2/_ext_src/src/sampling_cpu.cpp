@@ -0,0 +1,104 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+// 
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/ATen.h>
+#include <algorithm>
+
+// input: points(b, c, n) idx(b, m)
+// output: out(b, c, m)
+template <typename scalar_t>
+void gather_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                      const scalar_t *points, const int *idx,
+                                      scalar_t *out) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *points_row = points + bc * n;
+    const int *idx_row = idx + i * npoints;
+    scalar_t *out_row = out + bc * npoints;
+    for (int j = 0; j < npoints; ++j) {
+      out_row[j] = points_row[idx_row[j]];
+    }
+  }
+}
+
+// input: grad_out(b, c, m) idx(b, m)
+// output: grad_points(b, c, n)
+// Every (b, c) row only scatters into its own output row, so the rows can be
+// processed in parallel without atomics.
+template <typename scalar_t>
+void gather_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                           const scalar_t *grad_out,
+                                           const int *idx,
+                                           float *grad_points) {
+#pragma omp parallel for
+  for (int bc = 0; bc < b * c; ++bc) {
+    const int i = bc / c;
+    const scalar_t *grad_out_row = grad_out + bc * npoints;
+    const int *idx_row = idx + i * npoints;
+    float *grad_points_row = grad_points + bc * n;
+    for (int j = 0; j < npoints; ++j) {
+      grad_points_row[idx_row[j]] += static_cast<float>(grad_out_row[j]);
+    }
+  }
+}
+
+#define INSTANTIATE(scalar_t)                                         \
+  template void gather_points_cpu_kernel_wrapper<scalar_t>(           \
+      int, int, int, int, const scalar_t *, const int *, scalar_t *); \
+  template void gather_points_grad_cpu_kernel_wrapper<scalar_t>(      \
+      int, int, int, int, const scalar_t *, const int *, float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
+
+// Input dataset: (b, n, 3), tmp: (b, n)
+// Ouput idxs (b, m)
+// With offsets (b + 1), dataset and tmp hold the clouds back to back and
+// cloud i spans offsets[i]:offsets[i + 1], idxs are then local to the cloud.
+// FPS is sequential in m, so the batch is the unit of parallelism. Points
+// close to the origin (padding) are skipped exactly as in the CUDA kernel.
+void furthest_point_sampling_cpu_kernel_wrapper(int b, int n, int m,
+                                                const float *dataset,
+                                                const int *offsets,
+                                                float *temp, int *idxs) {
+  if (m <= 0) return;
+#pragma omp parallel for
+  for (int i = 0; i < b; ++i) {
+    const int start = offsets ? offsets[i] : i * n;
+    const int count = offsets ? offsets[i + 1] - start : n;
+    const float *batch_dataset = dataset + start * 3;
+    float *batch_temp = temp + start;
+    int *batch_idxs = idxs + i * m;
+
+    int old = 0;
+    batch_idxs[0] = old;
+    for (int j = 1; j < m; ++j) {
+      int besti = 0;
+      float best = -1;
+      const float x1 = batch_dataset[old * 3 + 0];
+      const float y1 = batch_dataset[old * 3 + 1];
+      const float z1 = batch_dataset[old * 3 + 2];
+      for (int k = 0; k < count; ++k) {
+        const float x2 = batch_dataset[k * 3 + 0];
+        const float y2 = batch_dataset[k * 3 + 1];
+        const float z2 = batch_dataset[k * 3 + 2];
+        const float mag = (x2 * x2) + (y2 * y2) + (z2 * z2);
+        if (mag <= 1e-3) continue;
+
+        const float d = (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1) +
+                        (z2 - z1) * (z2 - z1);
+        const float d2 = std::min(d, batch_temp[k]);
+        batch_temp[k] = d2;
+        if (d2 > best) {
+          best = d2;
+          besti = k;
+        }
+      }
+      old = besti;
+      batch_idxs[j] = old;
+    }
+  }
+}
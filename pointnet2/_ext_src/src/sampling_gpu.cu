@@ -10,10 +10,11 @@
 
 // input: points(b, c, n) idx(b, m)
 // output: out(b, c, m)
+template <typename scalar_t>
 __global__ void gather_points_kernel(int b, int c, int n, int m,
-                                     const float *__restrict__ points,
+                                     const scalar_t *__restrict__ points,
                                      const int *__restrict__ idx,
-                                     float *__restrict__ out) {
+                                     scalar_t *__restrict__ out) {
   for (int i = blockIdx.x; i < b; i += gridDim.x) {
     for (int l = blockIdx.y; l < c; l += gridDim.y) {
       for (int j = threadIdx.x; j < m; j += blockDim.x) {
@@ -24,20 +25,22 @@ __global__ void gather_points_kernel(int b, int c, int n, int m,
   }
 }
 
+template <typename scalar_t>
 void gather_points_kernel_wrapper(int b, int c, int n, int npoints,
-                                  const float *points, const int *idx,
-                                  float *out) {
-  gather_points_kernel<<<dim3(b, c, 1), opt_n_threads(npoints), 0,
-                         at::cuda::getCurrentCUDAStream()>>>(b, c, n, npoints,
-                                                             points, idx, out);
+                                  const scalar_t *points, const int *idx,
+                                  scalar_t *out) {
+  gather_points_kernel<scalar_t><<<dim3(b, c, 1), opt_n_threads(npoints), 0,
+                                   at::cuda::getCurrentCUDAStream()>>>(
+      b, c, n, npoints, points, idx, out);
 
   CUDA_CHECK_ERRORS();
 }
 
 // input: grad_out(b, c, m) idx(b, m)
 // output: grad_points(b, c, n)
+template <typename scalar_t>
 __global__ void gather_points_grad_kernel(int b, int c, int n, int m,
-                                          const float *__restrict__ grad_out,
+                                          const scalar_t *__restrict__ grad_out,
                                           const int *__restrict__ idx,
                                           float *__restrict__ grad_points) {
   for (int i = blockIdx.x; i < b; i += gridDim.x) {
@@ -45,22 +48,32 @@ __global__ void gather_points_grad_kernel(int b, int c, int n, int m,
       for (int j = threadIdx.x; j < m; j += blockDim.x) {
         int a = idx[i * m + j];
         atomicAdd(grad_points + (i * c + l) * n + a,
-                  grad_out[(i * c + l) * m + j]);
+                  static_cast<float>(grad_out[(i * c + l) * m + j]));
       }
     }
   }
 }
 
+template <typename scalar_t>
 void gather_points_grad_kernel_wrapper(int b, int c, int n, int npoints,
-                                       const float *grad_out, const int *idx,
+                                       const scalar_t *grad_out, const int *idx,
                                        float *grad_points) {
-  gather_points_grad_kernel<<<dim3(b, c, 1), opt_n_threads(npoints), 0,
-                              at::cuda::getCurrentCUDAStream()>>>(
+  gather_points_grad_kernel<scalar_t><<<dim3(b, c, 1), opt_n_threads(npoints),
+                                        0, at::cuda::getCurrentCUDAStream()>>>(
       b, c, n, npoints, grad_out, idx, grad_points);
 
   CUDA_CHECK_ERRORS();
 }
 
+#define INSTANTIATE(scalar_t)                                         \
+  template void gather_points_kernel_wrapper<scalar_t>(               \
+      int, int, int, int, const scalar_t *, const int *, scalar_t *); \
+  template void gather_points_grad_kernel_wrapper<scalar_t>(          \
+      int, int, int, int, const scalar_t *, const int *, float *);
+INSTANTIATE(float)
+INSTANTIATE(at::Half)
+INSTANTIATE(at::BFloat16)
+
 __device__ void __update(float *__restrict__ dists, int *__restrict__ dists_i,
                          int idx1, int idx2) {
   const float v1 = dists[idx1], v2 = dists[idx2];
@@ -74,14 +87,17 @@ __device__ void __update(float *__restrict__ dists, int *__restrict__ dists_i,
 template <unsigned int block_size>
 __global__ void furthest_point_sampling_kernel(
     int b, int n, int m, const float *__restrict__ dataset,
-    float *__restrict__ temp, int *__restrict__ idxs) {
+    const int *__restrict__ offsets, float *__restrict__ temp,
+    int *__restrict__ idxs) {
   if (m <= 0) return;
   __shared__ float dists[block_size];
   __shared__ int dists_i[block_size];
 
   int batch_index = blockIdx.x;
-  dataset += batch_index * n * 3;
-  temp += batch_index * n;
+  const int start = offsets ? offsets[batch_index] : batch_index * n;
+  if (offsets) n = offsets[batch_index + 1] - start;
+  dataset += start * 3;
+  temp += start;
   idxs += batch_index * m;
 
   int tid = threadIdx.x;
@@ -177,8 +193,10 @@ __global__ void furthest_point_sampling_kernel(
   }
 }
 
+// With offsets, n is the size of the largest cloud.
 void furthest_point_sampling_kernel_wrapper(int b, int n, int m,
-                                            const float *dataset, float *temp,
+                                            const float *dataset,
+                                            const int *offsets, float *temp,
                                             int *idxs) {
   unsigned int n_threads = opt_n_threads(n);
 
@@ -187,47 +205,47 @@ void furthest_point_sampling_kernel_wrapper(int b, int n, int m,
   switch (n_threads) {
     case 512:
       furthest_point_sampling_kernel<512>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 256:
       furthest_point_sampling_kernel<256>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 128:
       furthest_point_sampling_kernel<128>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 64:
       furthest_point_sampling_kernel<64>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 32:
       furthest_point_sampling_kernel<32>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 16:
       furthest_point_sampling_kernel<16>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 8:
       furthest_point_sampling_kernel<8>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 4:
       furthest_point_sampling_kernel<4>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 2:
       furthest_point_sampling_kernel<2>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     case 1:
       furthest_point_sampling_kernel<1>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
       break;
     default:
       furthest_point_sampling_kernel<512>
-          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, temp, idxs);
+          <<<b, n_threads, 0, stream>>>(b, n, m, dataset, offsets, temp, idxs);
   }
 
   CUDA_CHECK_ERRORS();
@@ -0,0 +1,90 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+// Registers the forward kernels as torch.ops.pointnet2.*, so traced and
+// scripted graphs can hold them and a saved archive only needs the shared
+// library (torch.ops.load_library) instead of the Python package. The
+// schemas take int64_t / double scalars and return tuples, as the
+// TorchScript type system requires. Gradients stay on the pybind path.
+
+#include <torch/script.h>
+
+#include "ball_query.h"
+#include "group_points.h"
+#include "interpolate.h"
+#include "knn_query.h"
+#include "sampling.h"
+
+namespace {
+
+at::Tensor furthest_point_sampling_op(at::Tensor points, int64_t nsamples) {
+  return furthest_point_sampling(points, nsamples);
+}
+
+at::Tensor furthest_point_sampling_packed_op(at::Tensor points,
+                                             at::Tensor offsets,
+                                             int64_t nsamples) {
+  return furthest_point_sampling_packed(points, offsets, nsamples);
+}
+
+at::Tensor ball_query_op(at::Tensor new_xyz, at::Tensor xyz, double radius,
+                         int64_t nsample) {
+  return ball_query(new_xyz, xyz, radius, nsample);
+}
+
+at::Tensor ball_query_grid_op(at::Tensor new_xyz, at::Tensor xyz,
+                              double radius, int64_t nsample) {
+  return ball_query_grid(new_xyz, xyz, radius, nsample);
+}
+
+at::Tensor ball_query_packed_op(at::Tensor new_xyz, at::Tensor xyz,
+                                at::Tensor offsets, double radius,
+                                int64_t nsample) {
+  return ball_query_packed(new_xyz, xyz, offsets, radius, nsample);
+}
+
+std::tuple<at::Tensor, at::Tensor> knn_query_op(at::Tensor new_xyz,
+                                                at::Tensor xyz,
+                                                int64_t nsample) {
+  std::vector<at::Tensor> out = knn_query(new_xyz, xyz, nsample);
+  return std::make_tuple(out[0], out[1]);
+}
+
+std::tuple<at::Tensor, at::Tensor> three_nn_op(at::Tensor unknowns,
+                                               at::Tensor knows) {
+  std::vector<at::Tensor> out = three_nn(unknowns, knows);
+  return std::make_tuple(out[0], out[1]);
+}
+
+std::tuple<at::Tensor, at::Tensor> three_nn_grid_op(at::Tensor unknowns,
+                                                    at::Tensor knows) {
+  std::vector<at::Tensor> out = three_nn_grid(unknowns, knows);
+  return std::make_tuple(out[0], out[1]);
+}
+
+std::tuple<at::Tensor, at::Tensor> three_nn_packed_op(at::Tensor unknowns,
+                                                      at::Tensor offsets,
+                                                      at::Tensor knows) {
+  std::vector<at::Tensor> out = three_nn_packed(unknowns, offsets, knows);
+  return std::make_tuple(out[0], out[1]);
+}
+
+}  // namespace
+
+static auto registry =
+    torch::RegisterOperators()
+        .op("pointnet2::gather_points", &gather_points)
+        .op("pointnet2::furthest_point_sampling", &furthest_point_sampling_op)
+        .op("pointnet2::furthest_point_sampling_packed",
+            &furthest_point_sampling_packed_op)
+        .op("pointnet2::three_nn", &three_nn_op)
+        .op("pointnet2::three_nn_grid", &three_nn_grid_op)
+        .op("pointnet2::three_nn_packed", &three_nn_packed_op)
+        .op("pointnet2::three_interpolate", &three_interpolate)
+        .op("pointnet2::ball_query", &ball_query_op)
+        .op("pointnet2::ball_query_grid", &ball_query_grid_op)
+        .op("pointnet2::ball_query_packed", &ball_query_packed_op)
+        .op("pointnet2::knn_query", &knn_query_op)
+        .op("pointnet2::group_points", &group_points);
@@ -0,0 +1,391 @@
+''' Micro benchmarks for the pointnet2 ops.
+
+Usage: python benchmark.py {hdnet,knn,match,optimize,packed,primitives,refine_topk,sa_chunk,sample_uniformly,sampling,three_nn} [--device cuda] [--batch_size 8]
+'''
+import argparse
+import time
+import torch
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+
+import pointnet2_utils
+from pointnet2_modules import PointnetSAModuleVotes, PointnetSAModuleMatch
+from pytorch_utils import optimize_for_inference
+
+
+def timeit(fn, repeat=10, device='cpu'):
+    ''' Mean wall time of fn() in milliseconds, after one warm-up call. '''
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - tic) / repeat * 1000
+
+
+def scene_cloud(batch_size, num_point, device):
+    ''' Points on the floor and walls of a 8m x 8m x 3m room, like ScanNet. '''
+    xyz = torch.rand(batch_size, num_point, 3, device=device) * torch.tensor([8., 8., 3.], device=device)
+    face = torch.randint(0, 3, (batch_size, num_point), device=device)
+    xyz[..., 2][face == 0] = 0
+    xyz[..., 0][face == 1] = 0
+    xyz[..., 1][face == 2] = 0
+    return xyz
+
+
+def bench_knn(args):
+    ''' ball_query, ball_query_grid and knn_query at the four set abstraction
+    levels of Pointnet2Backbone on a 40k point scene. "padded" is the share of
+    duplicated ball query slots, "knn radius" the mean distance to the
+    furthest of the nsample neighbors. '''
+    xyz = scene_cloud(args.batch_size, 40000, args.device)
+    print('%6s %12s %12s %12s %8s %10s %s' % ('layer', 'ball_query', 'ball_grid', 'knn_query',
+                                             'padded', 'knn radius', 'knn matches torch'))
+    for name, npoint, radius, nsample in [('sa1', 2048, 0.2, 64), ('sa2', 1024, 0.4, 32),
+                                          ('sa3', 512, 0.8, 16), ('sa4', 256, 1.2, 16)]:
+        inds = pointnet2_utils.furthest_point_sample(xyz, npoint)
+        new_xyz = pointnet2_utils.gather_operation(xyz.transpose(1, 2).contiguous(), inds).transpose(1, 2).contiguous()
+        t_ball = timeit(lambda: pointnet2_utils.ball_query(radius, nsample, xyz, new_xyz), args.repeat, args.device)
+        t_grid = timeit(lambda: pointnet2_utils.ball_query_grid(radius, nsample, xyz, new_xyz), args.repeat, args.device)
+        t_knn = timeit(lambda: pointnet2_utils.knn_query(nsample, xyz, new_xyz), args.repeat, args.device)
+        idx = pointnet2_utils.ball_query_grid(radius, nsample, xyz, new_xyz).long()
+        padded = (idx[:, :, 1:] == idx[:, :, :1]).float().mean().item()
+        knn_idx = pointnet2_utils.knn_query(nsample, xyz, new_xyz)
+        far = pointnet2_utils.gather_operation(xyz.transpose(1, 2).contiguous(), knn_idx[:, :, -1].contiguous())
+        knn_radius = (far.transpose(1, 2) - new_xyz).norm(dim=-1).mean().item()
+        same = torch.equal(knn_idx, pointnet2_utils.knn_query(nsample, xyz, new_xyz, backend='torch'))
+        print('%6s %10.2fms %10.2fms %10.2fms %7.1f%% %9.3fm %s' % (name, t_ball, t_grid, t_knn,
+                                                                  padded * 100, knn_radius, same))
+
+
+def bench_three_nn(args):
+    ''' three_nn vs three_nn_grid for a growing number of known points. '''
+    unknown = scene_cloud(args.batch_size, 20000, args.device)
+    print('%8s %12s %12s %8s %s' % ('known', 'three_nn', 'grid', 'speedup', 'identical'))
+    for m in [256, 1024, 2048, 4096, 8192, 16384]:
+        known = scene_cloud(args.batch_size, m, args.device)
+        dist, idx = pointnet2_utils.three_nn(unknown, known)
+        dist_grid, idx_grid = pointnet2_utils.three_nn_grid(unknown, known)
+        same = torch.equal(idx, idx_grid) and torch.equal(dist, dist_grid)
+        t_brute = timeit(lambda: pointnet2_utils.three_nn(unknown, known), args.repeat, args.device)
+        t_grid = timeit(lambda: pointnet2_utils.three_nn_grid(unknown, known), args.repeat, args.device)
+        print('%8d %10.2fms %10.2fms %7.1fx %s' % (m, t_brute, t_grid, t_brute / t_grid, same))
+
+
+def bench_sampling(args):
+    ''' Runtime and coverage (max distance to the closest sample) of the samplers
+    at the sizes of sa1 and of the vote aggregations. '''
+    layers = [('sa1', 20000, 2048, {'voxel_size': 0.05}),
+              ('vote_agg', 1024, 256, {'voxel_size': 0.1})]
+    for name, num_point, npoint, voxel_kwargs in layers:
+        xyz = scene_cloud(args.batch_size, num_point, args.device)
+        print('%s: %d -> %d points' % (name, num_point, npoint))
+        print('%12s %10s %10s' % ('sampler', 'time', 'coverage'))
+        for sampler in sorted(pointnet2_utils.SAMPLERS.keys()):
+            kwargs = voxel_kwargs if sampler == 'voxel_fps' else {}
+            fn = lambda: pointnet2_utils.sample_points(xyz, npoint, sampler, **kwargs)
+            t = timeit(fn, args.repeat, args.device)
+            coverage = pointnet2_utils.sampling_coverage(xyz, fn()).mean().item()
+            print('%12s %8.2fms %9.3fm' % (sampler, t, coverage))
+
+
+def bench_packed(args):
+    ''' sa1 geometry (FPS + ball query) on scenes of 5k to 50k points, packed
+    vs resampled to a fixed 20k points per scene like pc_util.random_sampling,
+    and whether packed results match running each scene on its own. '''
+    sizes = torch.linspace(5000, 50000, args.batch_size).long().tolist()
+    clouds = [scene_cloud(1, n, args.device)[0] for n in sizes]
+    xyz, offsets = pointnet2_utils.pack_point_clouds(clouds)
+    fixed = torch.stack([c[torch.randint(0, c.shape[0], (20000,), device=args.device)] for c in clouds])
+
+    def packed():
+        inds = pointnet2_utils.furthest_point_sample_packed(xyz, offsets, 2048)
+        return inds, pointnet2_utils.ball_query_packed(0.2, 64, xyz, offsets, xyz[inds.long()])
+
+    def padded():
+        inds = pointnet2_utils.furthest_point_sample(fixed, 2048)
+        new_xyz = pointnet2_utils.gather_operation(fixed.transpose(1, 2).contiguous(), inds).transpose(1, 2).contiguous()
+        return inds, pointnet2_utils.ball_query(0.2, 64, fixed, new_xyz)
+
+    inds, idx = packed()
+    same = True
+    for i, cloud in enumerate(clouds):
+        ref_inds = pointnet2_utils.furthest_point_sample(cloud.unsqueeze(0), 2048)
+        ref_idx = pointnet2_utils.ball_query(0.2, 64, cloud.unsqueeze(0), cloud[ref_inds[0].long()].unsqueeze(0))
+        same = same and torch.equal(ref_inds[0] + offsets[i], inds[i]) and torch.equal(ref_idx[0] + offsets[i], idx[i])
+    print('%d scenes, %d points packed vs %d resampled' % (len(clouds), xyz.shape[0], fixed.numel() // 3))
+    print('packed %.2fms, resampled to 20k %.2fms, packed matches per scene: %s'
+          % (timeit(packed, args.repeat, args.device), timeit(padded, args.repeat, args.device), same))
+
+    # A ret_unique_cnt layer on the packed batch, unique_cnt against each scene
+    sa = PointnetSAModuleVotes(npoint=2048, radius=0.2, nsample=64, mlp=[0, 64],
+                               use_xyz=True, sample_uniformly=True, ret_unique_cnt=True).to(args.device).eval()
+    with torch.no_grad():
+        unique_cnt = sa(xyz, inds=inds, offsets=offsets)[3]
+        same_cnt = all(torch.equal(unique_cnt[i], sa(cloud.unsqueeze(0), inds=inds[i:i+1] - offsets[i])[3][0])
+                       for i, cloud in enumerate(clouds))
+    print('ret_unique_cnt on the packed batch matches per scene: %s' % same_cnt)
+
+
+def bench_sa_chunk(args):
+    ''' sa1 in one shot vs chunked under a few memory budgets: time, peak
+    memory of forward + backward (cuda only) and difference to the one-shot
+    output and gradients. BN runs with running stats, as chunking requires. '''
+    xyz = scene_cloud(args.batch_size, 20000, args.device)
+    features = torch.rand(args.batch_size, 1, 20000, device=args.device)
+    sa = PointnetSAModuleVotes(npoint=2048, radius=0.2, nsample=64, mlp=[1, 64, 64, 128],
+                               use_xyz=True, normalize_xyz=True).to(args.device).eval()
+    inds = pointnet2_utils.furthest_point_sample(xyz, 2048)
+
+    def run():
+        features.grad = None
+        sa.zero_grad()
+        out = sa(xyz, features.requires_grad_(), inds)[1]
+        out.sum().backward()
+        return out.detach(), features.grad.clone(), sa.mlp_module.layer0.conv.weight.grad.clone()
+
+    print('%12s %10s %10s %10s' % ('budget', 'time', 'peak', 'max diff'))
+    for budget in [None, 1 << 26, 1 << 24, 1 << 22]:
+        sa.max_group_elems = budget
+        if args.device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        res = run()
+        peak = torch.cuda.max_memory_allocated() / 2**20 if args.device == 'cuda' else float('nan')
+        if budget is None:
+            ref = res
+        diff = max((a - b).abs().max().item() for a, b in zip(ref, res))
+        t = timeit(run, args.repeat, args.device)
+        print('%12s %8.2fms %8.0fMB %10g' % (budget, t, peak, diff))
+
+    # With sample_uniformly the chunked forward returns the unique_cnt of its
+    # own query, same seed -> same resampling as the one-shot forward
+    sa = PointnetSAModuleVotes(npoint=2048, radius=0.2, nsample=64, mlp=[1, 64, 64, 128],
+                               use_xyz=True, normalize_xyz=True, sample_uniformly=True,
+                               ret_unique_cnt=True).to(args.device).eval()
+    outs = []
+    for budget in [None, 1 << 22]:
+        sa.max_group_elems = budget
+        torch.manual_seed(0)
+        with torch.no_grad():
+            outs.append(sa(xyz, features, inds))
+    print('ret_unique_cnt: same unique_cnt %s, max feature diff %g' % (
+        torch.equal(outs[0][3], outs[1][3]), (outs[0][1] - outs[1][1]).abs().max().item()))
+
+
+def bench_sample_uniformly(args):
+    ''' Batched resample_unique vs the former per-ball loop on the sa1 ball
+    query, and whether both keep the same set of unique indices per ball. '''
+    xyz = scene_cloud(args.batch_size, 20000, args.device)
+    inds = pointnet2_utils.furthest_point_sample(xyz, 2048)
+    new_xyz = pointnet2_utils.gather_operation(xyz.transpose(1, 2).contiguous(), inds).transpose(1, 2).contiguous()
+    idx = pointnet2_utils.ball_query(0.2, 64, xyz, new_xyz)
+
+    def loop():
+        out = idx.clone()
+        unique_cnt = torch.zeros((idx.shape[0], idx.shape[1]))
+        for i_batch in range(idx.shape[0]):
+            for i_region in range(idx.shape[1]):
+                unique_ind = torch.unique(idx[i_batch, i_region, :])
+                num_unique = unique_ind.shape[0]
+                unique_cnt[i_batch, i_region] = num_unique
+                sample_ind = torch.randint(0, num_unique, (idx.shape[2] - num_unique,), dtype=torch.long)
+                out[i_batch, i_region, :] = torch.cat((unique_ind, unique_ind[sample_ind.to(idx.device)]))
+        return out, unique_cnt
+
+    ref_idx, ref_cnt = loop()
+    new_idx, new_cnt = pointnet2_utils.resample_unique(idx)
+    same_cnt = torch.equal(ref_cnt, new_cnt.cpu())
+    # The first unique_cnt entries are the sorted unique indices in both
+    keep = torch.arange(idx.shape[2], device=idx.device) < new_cnt.long().unsqueeze(-1)
+    same_set = torch.equal(ref_idx[keep], new_idx[keep])
+    t_loop = timeit(loop, 1, args.device)
+    t_vec = timeit(lambda: pointnet2_utils.resample_unique(idx), args.repeat, args.device)
+    print('loop %.2fms, batched %.2fms (%.0fx), same unique_cnt: %s, same unique indices: %s'
+          % (t_loop, t_vec, t_loop / t_vec, same_cnt, same_set))
+
+
+def bench_hdnet(args):
+    ''' End to end HDNet inference throughput (SUN RGB-D config, xyz + height
+    input) at several num_point settings, to size serving. Run it with
+    --device cpu for CPU-only deployments, the thread count is torch's. '''
+    ROOT_DIR = os.path.dirname(BASE_DIR)
+    sys.path.append(os.path.join(ROOT_DIR, 'models'))
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from hdnet import HDNet
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DC = SunrgbdDatasetConfig()
+    net = HDNet(DC.num_class, DC.num_heading_bin, DC.num_size_cluster, DC.mean_size_arr,
+                input_feature_dim=1, num_proposal=256).to(args.device).eval()
+    print('device %s, %d threads, batch size %d' % (args.device, torch.get_num_threads(), args.batch_size))
+    print('%10s %12s %12s' % ('num_point', 'ms / batch', 'scenes / s'))
+    for num_point in [5000, 10000, 20000, 40000]:
+        pc = torch.cat([scene_cloud(args.batch_size, num_point, args.device),
+                        torch.rand(args.batch_size, num_point, 1, device=args.device)], dim=2)
+        with torch.no_grad():
+            t = timeit(lambda: net({'point_clouds': pc}, {}), args.repeat, args.device)
+        print('%10d %12.1f %12.2f' % (num_point, t, args.batch_size / t * 1000))
+
+
+def bench_optimize(args):
+    ''' HDNet inference latency before and after optimize_for_inference
+    (batch norms folded into the convolutions). The batch norm statistics
+    are randomized first, so the equivalence check is not trivially met by
+    the unit statistics of a fresh network. Meant for --device cpu. '''
+    ROOT_DIR = os.path.dirname(BASE_DIR)
+    sys.path.append(os.path.join(ROOT_DIR, 'models'))
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from hdnet import HDNet, INFERENCE_OUTPUTS
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DC = SunrgbdDatasetConfig()
+    net = HDNet(DC.num_class, DC.num_heading_bin, DC.num_size_cluster, DC.mean_size_arr,
+                input_feature_dim=1, num_proposal=256).to(args.device).eval()
+    for m in net.modules():
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+            m.running_mean.normal_(0, 0.1)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.normal_(0, 0.1)
+    fast, num_folded = optimize_for_inference(net)
+    print('device %s, %d threads, batch size %d, %d batch norms folded'
+          % (args.device, torch.get_num_threads(), args.batch_size, num_folded))
+
+    pc = torch.cat([scene_cloud(args.batch_size, 20000, args.device),
+                    torch.rand(args.batch_size, 20000, 1, device=args.device)], dim=2)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        ref = net({'point_clouds': pc}, {})
+        torch.manual_seed(0)
+        out = fast({'point_clouds': pc}, {})
+        t_ref = timeit(lambda: net({'point_clouds': pc}, {}), args.repeat, args.device)
+        t_fast = timeit(lambda: fast({'point_clouds': pc}, {}), args.repeat, args.device)
+    diff = max((ref[key] - out[key]).abs().max().item() for key in INFERENCE_OUTPUTS)
+    print('original %.1fms, folded %.1fms (%.2fx), max abs diff over INFERENCE_OUTPUTS %g'
+          % (t_ref, t_fast, t_ref / t_fast, diff))
+
+
+def bench_refine_topk(args):
+    ''' HDNet inference with the matching and refinement stage limited to the
+    top-K of the 256 proposals (HDNet.set_refine_pruning), 20k point scenes. '''
+    ROOT_DIR = os.path.dirname(BASE_DIR)
+    sys.path.append(os.path.join(ROOT_DIR, 'models'))
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from hdnet import HDNet
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DC = SunrgbdDatasetConfig()
+    net = HDNet(DC.num_class, DC.num_heading_bin, DC.num_size_cluster, DC.mean_size_arr,
+                input_feature_dim=1, num_proposal=256).to(args.device).eval()
+    pc = torch.cat([scene_cloud(args.batch_size, 20000, args.device),
+                    torch.rand(args.batch_size, 20000, 1, device=args.device)], dim=2)
+    print('%6s %12s' % ('K', 'ms / batch'))
+    for topk in [None, 128, 64, 32]:
+        net.set_refine_pruning(topk)
+        with torch.no_grad():
+            t = timeit(lambda: net({'point_clouds': pc}, {}), args.repeat, args.device)
+        print('%6s %12.1f' % (topk or 256, t))
+
+
+def bench_match(args):
+    ''' Primitive matching of ProposalModuleRefine (256 proposals, 2x1024
+    surface and 1024 line centers, a third of them selected): the padded
+    sets, unselected centers pushed 100m away, against the packed sets of
+    the selected centers that both query sets share, for ball and kNN
+    grouping. '''
+    B, N, M, upper = args.batch_size, 256, 1024, 100.0
+    queries = scene_cloud(B, N*6, args.device)
+    centers = scene_cloud(B, 2*M, args.device)
+    features = torch.rand(B, 128, 2*M, device=args.device)
+    keep = torch.rand(B, 2*M, device=args.device) < 1/3.
+    keep[:, 0] = True
+
+    for grouping in ['ball', 'knn']:
+        match = PointnetSAModuleMatch(npoint=N*6, radius=0.5, nsample=32, mlp=[128+6, 128, 64, 32],
+                                      use_xyz=True, normalize_xyz=True, grouping=grouping).to(args.device).eval()
+
+        def padded():
+            target = centers + upper * (~keep).float().unsqueeze(-1)
+            target_features = torch.cat((torch.zeros(B, 6, 2*M, device=args.device), features), dim=1)
+            return match(torch.cat((queries, target), dim=1),
+                         torch.cat((torch.zeros(B, 134, N*6, device=args.device), target_features), dim=2))[1]
+
+        def packed():
+            counts = keep.sum(1)
+            offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0))).int()
+            return match.forward_packed(queries, centers[keep].contiguous(), offsets,
+                                        features.transpose(1, 2)[keep].t().contiguous(), pad_channels=6)[1]
+
+        with torch.no_grad():
+            diff = (padded() - packed()).abs().max().item()
+            t_padded = timeit(padded, args.repeat, args.device)
+            t_packed = timeit(packed, args.repeat, args.device)
+        print('%s surface matching: padded %.2fms, packed %.2fms (%.1fx), %d of %d targets, max abs diff %g'
+              % (grouping, t_padded, t_packed, t_padded / t_packed, keep.sum().item(), keep.numel(), diff))
+
+def _surface_line_points_reference(obj_size, heading_angle, center):
+    ''' The former get_surface_line_points_batch_pytorch: one offset tensor
+    per face/edge center and the rotation repeated 6 and 12 times. '''
+    from box_util import rotz_batch_pytorch
+    R = rotz_batch_pytorch(-heading_angle.float())
+    offset_x = torch.zeros_like(obj_size)
+    offset_y = torch.zeros_like(obj_size)
+    offset_z = torch.zeros_like(obj_size)
+    offset_x[:,:,0] = 0.5
+    offset_y[:,:,1] = 0.5
+    offset_z[:,:,2] = 0.5
+    x, y, z = offset_x * obj_size, offset_y * obj_size, offset_z * obj_size
+    surface_3d = torch.cat((z, -z, y, -y, x, -x), dim=1)
+    line_3d = torch.cat((z + x, z - x, z + y, z - y, -z + x, -z - x, -z + y, -z - y,
+                         x + y, x - y, -x + y, -x - y), dim=1)
+    surface_3d = torch.matmul(surface_3d.unsqueeze(-2), R.repeat(1,6,1,1).transpose(3,2)).squeeze(-2)
+    line_3d = torch.matmul(line_3d.unsqueeze(-2), R.repeat(1,12,1,1).transpose(3,2)).squeeze(-2)
+    return center.repeat(1,6,1) + surface_3d, center.repeat(1,12,1) + line_3d
+
+
+def bench_primitives(args):
+    ''' Face and edge centers of 256 proposals per scene: the former
+    per-primitive implementation against the template einsum, split and
+    fused outputs. '''
+    sys.path.append(os.path.join(os.path.dirname(BASE_DIR), 'utils'))
+    from box_util import get_surface_line_points_batch_pytorch
+    B, N = args.batch_size, 256
+    obj_size = torch.rand(B, N, 3, device=args.device) + 0.1
+    heading_angle = torch.rand(B, N, device=args.device) * 6.28
+    center = scene_cloud(B, N, args.device)
+    funcs = [('reference', lambda: torch.cat(_surface_line_points_reference(obj_size, heading_angle, center), 1)),
+             ('template', lambda: torch.cat(get_surface_line_points_batch_pytorch(obj_size, heading_angle, center), 1)),
+             ('fused', lambda: get_surface_line_points_batch_pytorch(obj_size, heading_angle, center, fused=True))]
+    ref = funcs[0][1]()
+    for name, fn in funcs:
+        t = timeit(fn, args.repeat, args.device)
+        print('%-10s %8.3fms  max abs diff %g' % (name, t, (fn() - ref).abs().max().item()))
+
+
+BENCHMARKS = {
+    'hdnet': bench_hdnet,
+    'knn': bench_knn,
+    'match': bench_match,
+    'optimize': bench_optimize,
+    'packed': bench_packed,
+    'primitives': bench_primitives,
+    'refine_topk': bench_refine_topk,
+    'sa_chunk': bench_sa_chunk,
+    'sample_uniformly': bench_sample_uniformly,
+    'sampling': bench_sampling,
+    'three_nn': bench_three_nn,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=sorted(BENCHMARKS.keys()), help='Benchmark to run')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device [default: cuda if available]')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size [default: 8]')
+    parser.add_argument('--repeat', type=int, default=10, help='Timed repetitions [default: 10]')
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    BENCHMARKS[args.bench](args)
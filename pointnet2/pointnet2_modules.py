@@ -12,6 +12,7 @@ Extended with the following:
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 import os
 import sys
@@ -180,6 +181,10 @@ class PointnetSAModuleVotes(nn.Module):
             sample_uniformly: bool = False,
             ret_unique_cnt: bool = False,
             same_idx: bool = False,
+            sampler: str = 'fps', # one of pointnet2_utils.SAMPLERS
+            sampler_kwargs: dict = None,
+            max_group_elems: int = None, # memory budget of the chunked forward
+            grouping: str = 'ball' # 'ball' query or 'knn'
     ):
         super().__init__()
 
@@ -195,8 +200,22 @@ class PointnetSAModuleVotes(nn.Module):
         self.normalize_xyz = normalize_xyz
         self.ret_unique_cnt = ret_unique_cnt
         self.same_idx = same_idx
+        assert sampler in pointnet2_utils.SAMPLERS, "unknown sampler %s" % sampler
+        self.sampler = sampler
+        self.sampler_kwargs = {} if sampler_kwargs is None else sampler_kwargs
+        # Run the MLP on tiles of centroids so that no (B, C, tile, nsample)
+        # activation has more than max_group_elems elements. Only used while
+        # the batch norms normalize with running stats: eval, or training
+        # with frozen batch norms (HDNet.freeze_backbone_bn)
+        self.max_group_elems = max_group_elems
         
-        if npoint is not None:
+        assert grouping in ('ball', 'knn'), "unknown grouping %s" % grouping
+        self.grouping = grouping
+        if npoint is not None and grouping == 'knn':
+            assert not sample_uniformly, "kNN neighborhoods have no duplicates to resample"
+            self.grouper = pointnet2_utils.KNNAndGroup(radius, nsample,
+                use_xyz=use_xyz, ret_grouped_xyz=True, normalize_xyz=normalize_xyz)
+        elif npoint is not None:
             self.grouper = pointnet2_utils.QueryAndGroup(radius, nsample,
                 use_xyz=use_xyz, ret_grouped_xyz=True, normalize_xyz=normalize_xyz,
                 sample_uniformly=sample_uniformly, ret_unique_cnt=ret_unique_cnt)
@@ -207,11 +226,134 @@ class PointnetSAModuleVotes(nn.Module):
         if use_xyz and len(mlp_spec)>0:
             mlp_spec[0] += 3
         self.mlp_module = pt_utils.SharedMLP(mlp_spec, bn=bn)
+        self.max_width = max(mlp_spec) if len(mlp_spec) > 0 else 3
+
+    def _pool(self, new_features, grouped_xyz):
+        if self.pooling == 'max':
+            new_features = F.max_pool2d(
+                new_features, kernel_size=[1, new_features.size(3)]
+            )  # (B, mlp[-1], npoint, 1)
+        elif self.pooling == 'avg':
+            new_features = F.avg_pool2d(
+                new_features, kernel_size=[1, new_features.size(3)]
+            )  # (B, mlp[-1], npoint, 1)
+        elif self.pooling == 'rbf': 
+            # Use radial basis function kernel for weighted sum of features (normalized by nsample and sigma)
+            # Ref: https://en.wikipedia.org/wiki/Radial_basis_function_kernel
+            rbf = torch.exp(-1 * grouped_xyz.pow(2).sum(1,keepdim=False) / (self.sigma**2) / 2) # (B, npoint, nsample)
+            new_features = torch.sum(new_features * rbf.unsqueeze(1), -1, keepdim=True) / float(self.nsample) # (B, mlp[-1], npoint, 1)
+        return new_features.squeeze(-1)  # (B, mlp[-1], npoint)
+
+    def _can_chunk(self):
+        # Batch norm with batch statistics couples all centroids, tiles would
+        # change the result, so only normalization with running stats is tiled
+        if self.max_group_elems is None or self.npoint is None:
+            return False
+        for m in self.mlp_module.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm) and \
+                    (m.training or not m.track_running_stats):
+                return False
+        return True
+
+    def _group_mlp_pool(self, xyz, new_xyz, features, idx):
+        # group() skips the ret_unique_cnt check, the callers hold unique_cnt
+        grouped_features, grouped_xyz = self.grouper.group(xyz, new_xyz, features, idx)
+        return self._pool(self.mlp_module(grouped_features), grouped_xyz)
+
+    def _forward_chunked(self, xyz, new_xyz, features, idx):
+        r"""
+        Group, run the MLP and pool tile by tile, identical to the one-shot
+        forward. With autograd on, every tile is checkpointed, so backward
+        recomputes the tile activations instead of keeping all of them.
+        """
+        unique_cnt = None
+        if idx is None:
+            idx, unique_cnt = self.grouper.query(xyz, new_xyz)
+        B, npoint, nsample = idx.shape
+        step = max(1, self.max_group_elems // (B * self.max_width * nsample))
+        out = []
+        for s in range(0, npoint, step):
+            e = min(npoint, s + step)
+            tile = (xyz, new_xyz[:, s:e].contiguous(), features, idx[:, s:e].contiguous())
+            if torch.is_grad_enabled():
+                # non-reentrant: reaches the MLP parameters even when no input needs grad
+                out.append(checkpoint(self._group_mlp_pool, *tile, use_reentrant=False))
+            else:
+                out.append(self._group_mlp_pool(*tile))
+        return torch.cat(out, dim=2), unique_cnt
 
+    def _forward_full(self, xyz, new_xyz, features, idx):
+        unique_cnt = None
+        group_kwargs = {'idx': idx} if idx is not None else {}
+        if not self.ret_unique_cnt:
+            grouped_features, grouped_xyz = self.grouper(
+                xyz, new_xyz, features, **group_kwargs
+            )  # (B, C, npoint, nsample)
+        else:
+            grouped_features, grouped_xyz, unique_cnt = self.grouper(
+                xyz, new_xyz, features
+            )  # (B, C, npoint, nsample), (B,3,npoint,nsample), (B,npoint)
+
+        new_features = self.mlp_module(
+            grouped_features
+        )  # (B, mlp[-1], npoint, nsample)
+        return self._pool(new_features, grouped_xyz), unique_cnt
+
+
+    def _forward_packed(self, xyz, features, inds, cache, offsets):
+        r"""
+        Every cloud of the packed batch gets npoint centroids, so the outputs
+        are regular (B, npoint, ...) tensors. The B * npoint balls are then
+        grouped as one flat cloud over the packed points. The ball query is
+        done here, so unique_cnt comes from resample_unique and the grouping
+        goes through grouper.group, which takes the precomputed idx.
+        """
+        assert self.npoint is not None and not self.same_idx and self.sampler == 'fps' \
+            and self.grouping == 'ball', "packed batches need an FPS + ball query layer"
+        B = offsets.size(0) - 1
+        use_cache = cache is not None and not self.grouper.sample_uniformly
+        geometry = None
+        if use_cache:
+            key = ('sa_packed', self.npoint, self.radius, self.nsample)
+            geometry = cache.get(key, xyz, offsets)
+            if geometry is not None and inds is not None and geometry[0] is not inds:
+                geometry = None
+
+        if geometry is not None:
+            inds, new_xyz, idx = geometry
+        else:
+            if inds is None:
+                inds = pointnet2_utils.furthest_point_sample_packed(xyz, offsets, self.npoint)
+            else:
+                assert(inds.shape[1] == self.npoint)
+            new_xyz = xyz[inds.long()]  # (B, npoint, 3)
+            idx = pointnet2_utils.ball_query_packed(self.radius, self.nsample, xyz, offsets, new_xyz)
+            if use_cache:
+                cache.put(key, (xyz, offsets), (inds, new_xyz, idx))
+
+        unique_cnt = None
+        if self.grouper.sample_uniformly:
+            idx, unique_cnt = pointnet2_utils.resample_unique(idx)
+
+        flat = (xyz.unsqueeze(0), new_xyz.view(1, B * self.npoint, 3),
+                features.unsqueeze(0) if features is not None else None,
+                idx.view(1, B * self.npoint, self.nsample))
+        if self._can_chunk():
+            new_features, _ = self._forward_chunked(*flat)
+        else:
+            new_features = self._group_mlp_pool(*flat)
+        new_features = new_features.view(-1, B, self.npoint).transpose(0, 1).contiguous()
+
+        if not self.ret_unique_cnt:
+            return new_xyz, new_features, inds
+        else:
+            return new_xyz, new_features, inds, unique_cnt
 
     def forward(self, xyz: torch.Tensor,
                 features: torch.Tensor = None,
-                inds: torch.Tensor = None) -> (torch.Tensor, torch.Tensor):
+                inds: torch.Tensor = None,
+                cache: pointnet2_utils.GeometryCache = None,
+                offsets: torch.Tensor = None) -> (torch.Tensor, torch.Tensor):
         r"""
         Parameters
         ----------
@@ -221,6 +363,13 @@ class PointnetSAModuleVotes(nn.Module):
             (B, C, N) tensor of the descriptors of the the features
         inds : torch.Tensor
             (B, npoint) tensor that stores index to the xyz points (values in 0-N-1)
+        cache : pointnet2_utils.GeometryCache
+            Reuse inds, new_xyz and the ball query of another layer with the
+            same geometry that ran on the same xyz tensor
+        offsets : torch.Tensor
+            (B + 1) int32 tensor for a packed batch: xyz is then (N, 3) and
+            features (C, N), cloud i spans offsets[i]:offsets[i + 1], and inds
+            index the packed points
 
         Returns
         -------
@@ -232,44 +381,44 @@ class PointnetSAModuleVotes(nn.Module):
             (B, npoint) tensor of the inds
         """
 
-        if not self.same_idx:
-            xyz_flipped = xyz.transpose(1, 2).contiguous()
-            if inds is None:
-                inds = pointnet2_utils.furthest_point_sample(xyz, self.npoint)
-            else:
-                assert(inds.shape[1] == self.npoint)
-            new_xyz = pointnet2_utils.gather_operation(
-                xyz_flipped, inds
-            ).transpose(1, 2).contiguous() if self.npoint is not None else None
+        if offsets is not None:
+            return self._forward_packed(xyz, features, inds, cache, offsets)
+
+        # Random resampling in the balls cannot be shared between layers
+        use_cache = cache is not None and self.npoint is not None \
+            and not self.grouper.sample_uniformly
+        geometry = None
+        if use_cache:
+            key = ('sa', self.npoint, self.radius, self.nsample, self.grouping, self.same_idx,
+                   self.sampler, tuple(sorted(self.sampler_kwargs.items())))
+            geometry = cache.get(key, xyz)
+            if geometry is not None and inds is not None and geometry[0] is not inds:
+                geometry = None
+
+        if geometry is not None:
+            inds, new_xyz, idx = geometry
         else:
-            new_xyz = xyz
-
-        if not self.ret_unique_cnt:
-            grouped_features, grouped_xyz = self.grouper(
-                xyz, new_xyz, features
-            )  # (B, C, npoint, nsample)
+            if not self.same_idx:
+                xyz_flipped = xyz.transpose(1, 2).contiguous()
+                if inds is None:
+                    inds = pointnet2_utils.sample_points(xyz, self.npoint,
+                        self.sampler, **self.sampler_kwargs)
+                else:
+                    assert(inds.shape[1] == self.npoint)
+                new_xyz = pointnet2_utils.gather_operation(
+                    xyz_flipped, inds
+                ).transpose(1, 2).contiguous() if self.npoint is not None else None
+            else:
+                new_xyz = xyz
+            idx = None
+            if use_cache:
+                idx, _ = self.grouper.query(xyz, new_xyz)
+                cache.put(key, (xyz,), (inds, new_xyz, idx))
+
+        if self._can_chunk():
+            new_features, unique_cnt = self._forward_chunked(xyz, new_xyz, features, idx)
         else:
-            grouped_features, grouped_xyz, unique_cnt = self.grouper(
-                xyz, new_xyz, features
-            )  # (B, C, npoint, nsample), (B,3,npoint,nsample), (B,npoint)
-
-        new_features = self.mlp_module(
-            grouped_features
-        )  # (B, mlp[-1], npoint, nsample)
-        if self.pooling == 'max':
-            new_features = F.max_pool2d(
-                new_features, kernel_size=[1, new_features.size(3)]
-            )  # (B, mlp[-1], npoint, 1)
-        elif self.pooling == 'avg':
-            new_features = F.avg_pool2d(
-                new_features, kernel_size=[1, new_features.size(3)]
-            )  # (B, mlp[-1], npoint, 1)
-        elif self.pooling == 'rbf': 
-            # Use radial basis function kernel for weighted sum of features (normalized by nsample and sigma)
-            # Ref: https://en.wikipedia.org/wiki/Radial_basis_function_kernel
-            rbf = torch.exp(-1 * grouped_xyz.pow(2).sum(1,keepdim=False) / (self.sigma**2) / 2) # (B, npoint, nsample)
-            new_features = torch.sum(new_features * rbf.unsqueeze(1), -1, keepdim=True) / float(self.nsample) # (B, mlp[-1], npoint, 1)
-        new_features = new_features.squeeze(-1)  # (B, mlp[-1], npoint)
+            new_features, unique_cnt = self._forward_full(xyz, new_xyz, features, idx)
 
         if not self.ret_unique_cnt:
             return new_xyz, new_features, inds
@@ -412,6 +561,7 @@ class PointnetSAModuleMatch(nn.Module):
             sample_uniformly: bool = False,
             ret_unique_cnt: bool = False,
             same_idx: bool = False,
+            grouping: str = 'ball', # 'ball' query or 'knn'
     ):
         super().__init__()
 
@@ -428,7 +578,13 @@ class PointnetSAModuleMatch(nn.Module):
         self.ret_unique_cnt = ret_unique_cnt
         self.same_idx = same_idx
         
-        if npoint is not None:
+        assert grouping in ('ball', 'knn'), "unknown grouping %s" % grouping
+        self.grouping = grouping
+        if npoint is not None and grouping == 'knn':
+            assert not sample_uniformly, "kNN neighborhoods have no duplicates to resample"
+            self.grouper = pointnet2_utils.KNNAndGroup(radius, nsample,
+                use_xyz=use_xyz, ret_grouped_xyz=True, normalize_xyz=normalize_xyz)
+        elif npoint is not None:
             self.grouper = pointnet2_utils.QueryAndGroup(radius, nsample,
                 use_xyz=use_xyz, ret_grouped_xyz=True, normalize_xyz=normalize_xyz,
                 sample_uniformly=sample_uniformly, ret_unique_cnt=ret_unique_cnt)
@@ -476,6 +632,63 @@ class PointnetSAModuleMatch(nn.Module):
                 target_xyz, new_xyz, features[:,:,self.npoint:].contiguous()
             )  # (B, C, npoint, nsample), (B,3,npoint,nsample), (B,npoint)
 
+        new_features = self._mlp_pool(grouped_features, grouped_xyz)  # (B, mlp[-1], npoint)
+
+        if not self.ret_unique_cnt:
+            return new_xyz, new_features, inds
+        else:
+            return new_xyz, new_features, inds, unique_cnt
+
+    def forward_packed(self, new_xyz: torch.Tensor,
+                       xyz: torch.Tensor,
+                       offsets: torch.Tensor,
+                       features: torch.Tensor,
+                       pad_channels: int = 0) -> (torch.Tensor, torch.Tensor):
+        r"""
+        Same as forward, with the target points of every scene packed back to
+        back instead of padded to a common count, so several query sets can
+        share one target array (see pointnet2_utils.pack_point_clouds).
+
+        Parameters
+        ----------
+        new_xyz : torch.Tensor
+            (B, npoint, 3) query points
+        xyz : torch.Tensor
+            (N, 3) packed target points
+        offsets : torch.Tensor
+            (B + 1) int32 tensor, the targets of scene i are xyz[offsets[i]:offsets[i + 1]]
+        features : torch.Tensor
+            (C, N) descriptors of the packed targets
+        pad_channels : int
+            number of all-zero channels in front of the target descriptors
+            (constant indicator channels), added after grouping
+
+        Returns
+        -------
+        new_xyz : torch.Tensor
+            (B, npoint, 3) the query points
+        new_features : torch.Tensor
+            (B, mlp[-1], npoint) tensor of the new_features descriptors
+        """
+        assert not self.ret_unique_cnt
+        new_xyz = new_xyz.contiguous()
+        if self.grouping == 'knn':
+            idx = pointnet2_utils.knn_query_packed(self.nsample, xyz, offsets, new_xyz)
+        else:
+            idx = pointnet2_utils.ball_query_packed(self.radius, self.nsample, xyz, offsets, new_xyz)
+        grouped_xyz = pointnet2_utils.grouping_operation_packed(xyz.t().contiguous(), idx)  # (B, 3, npoint, nsample)
+        grouped_xyz -= new_xyz.transpose(1, 2).unsqueeze(-1)
+        if self.normalize_xyz:
+            grouped_xyz /= self.radius
+        grouped_features = pointnet2_utils.grouping_operation_packed(features, idx)  # (B, C, npoint, nsample)
+        if pad_channels > 0:
+            grouped_features = torch.cat((grouped_features.new_zeros(
+                (grouped_features.shape[0], pad_channels) + grouped_features.shape[2:]), grouped_features), dim=1)
+        if self.use_xyz:
+            grouped_features = torch.cat((grouped_xyz.to(grouped_features.dtype), grouped_features), dim=1)
+        return new_xyz, self._mlp_pool(grouped_features, grouped_xyz)
+
+    def _mlp_pool(self, grouped_features, grouped_xyz):
         new_features = self.mlp_module(
             grouped_features
         )  # (B, mlp[-1], npoint, nsample)
@@ -492,12 +705,7 @@ class PointnetSAModuleMatch(nn.Module):
             # Ref: https://en.wikipedia.org/wiki/Radial_basis_function_kernel
             rbf = torch.exp(-1 * grouped_xyz.pow(2).sum(1,keepdim=False) / (self.sigma**2) / 2) # (B, npoint, nsample)
             new_features = torch.sum(new_features * rbf.unsqueeze(1), -1, keepdim=True) / float(self.nsample) # (B, mlp[-1], npoint, 1)
-        new_features = new_features.squeeze(-1)  # (B, mlp[-1], npoint)
-
-        if not self.ret_unique_cnt:
-            return new_xyz, new_features, inds
-        else:
-            return new_xyz, new_features, inds, unique_cnt
+        return new_features.squeeze(-1)  # (B, mlp[-1], npoint)
         
 class PointnetSAModulePairwise(nn.Module):
     ''' Modified based on _PointnetSAModuleBase and PointnetSAModuleMSG
@@ -1027,15 +1235,19 @@ class PointnetFPModule(nn.Module):
         Pointnet module parameters
     bn : bool
         Use batchnorm
+    use_grid : bool
+        Find the three nearest neighbors with three_nn_grid
     """
 
-    def __init__(self, *, mlp: List[int], bn: bool = True):
+    def __init__(self, *, mlp: List[int], bn: bool = True, use_grid: bool = False):
         super().__init__()
         self.mlp = pt_utils.SharedMLP(mlp, bn=bn)
+        self.use_grid = use_grid
 
     def forward(
             self, unknown: torch.Tensor, known: torch.Tensor,
-            unknow_feats: torch.Tensor, known_feats: torch.Tensor
+            unknow_feats: torch.Tensor, known_feats: torch.Tensor,
+            cache: pointnet2_utils.GeometryCache = None
     ) -> torch.Tensor:
         r"""
         Parameters
@@ -1048,6 +1260,9 @@ class PointnetFPModule(nn.Module):
             (B, C1, n) tensor of the features to be propigated to
         known_feats : torch.Tensor
             (B, C2, m) tensor of features to be propigated
+        cache : pointnet2_utils.GeometryCache
+            Reuse the interpolation weights computed for the same
+            unknown and known tensors
 
         Returns
         -------
@@ -1056,10 +1271,19 @@ class PointnetFPModule(nn.Module):
         """
 
         if known is not None:
-            dist, idx = pointnet2_utils.three_nn(unknown, known)
-            dist_recip = 1.0 / (dist + 1e-8)
-            norm = torch.sum(dist_recip, dim=2, keepdim=True)
-            weight = dist_recip / norm
+            geometry = cache.get(('fp',), unknown, known) if cache is not None else None
+            if geometry is not None:
+                idx, weight = geometry
+            else:
+                if self.use_grid:
+                    dist, idx = pointnet2_utils.three_nn_grid(unknown, known)
+                else:
+                    dist, idx = pointnet2_utils.three_nn(unknown, known)
+                dist_recip = 1.0 / (dist + 1e-8)
+                norm = torch.sum(dist_recip, dim=2, keepdim=True)
+                weight = dist_recip / norm
+                if cache is not None:
+                    cache.put(('fp',), (unknown, known), (idx, weight))
 
             interpolated_feats = pointnet2_utils.three_interpolate(
                 known_feats, idx, weight
@@ -0,0 +1,318 @@
+''' Pure PyTorch implementations of the pointnet2 _ext ops.
+
+Used by pointnet2_utils when the compiled extension is not available or when
+the 'torch' backend is selected. Every op mirrors the semantics of the CUDA
+kernels (index dtype, padding of ball queries, FPS skipping points at the
+origin) so the two backends can be swapped freely. Queries are processed in
+chunks so the pairwise distance tensors stay below CHUNK_ELEMS elements.
+'''
+from __future__ import (
+    division,
+    absolute_import,
+    with_statement,
+    print_function,
+    unicode_literals,
+)
+import os
+import torch
+
+# Upper bound on the number of elements of any temporary pairwise tensor.
+CHUNK_ELEMS = int(os.environ.get('POINTNET2_CHUNK_ELEMS', 1 << 24))
+
+
+def _chunk_size(rows, elems_per_row):
+    return max(1, min(rows, CHUNK_ELEMS // max(1, elems_per_row)))
+
+
+def _sq_dist(a, b):
+    r"""
+    Squared euclidean distance computed coordinate-wise, exactly like the kernels
+
+    a: (B, n, 3), b: (B, m, 3) -> (B, n, m)
+    """
+    d = (a[:, :, None, 0] - b[:, None, :, 0]) ** 2
+    d += (a[:, :, None, 1] - b[:, None, :, 1]) ** 2
+    d += (a[:, :, None, 2] - b[:, None, :, 2]) ** 2
+    return d
+
+
+def furthest_point_sample(xyz, npoint):
+    r"""
+    Parameters
+    ----------
+    xyz : torch.Tensor
+        (B, N, 3) tensor
+    npoint : int
+        number of points to sample
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint) int32 tensor of sampled indices
+    """
+    B, N, _ = xyz.size()
+    xyz = xyz.detach()
+    idxs = torch.zeros(B, npoint, dtype=torch.long, device=xyz.device)
+    if npoint <= 0 or N == 0:
+        return idxs.int()
+    valid = (xyz * xyz).sum(-1) > 1e-3
+    temp = torch.full((B, N), 1e10, dtype=xyz.dtype, device=xyz.device)
+    neg = torch.full_like(temp, -1)
+    batch = torch.arange(B, device=xyz.device)
+    old = idxs[:, 0]
+    for j in range(1, npoint):
+        d = ((xyz - xyz[batch, old].unsqueeze(1)) ** 2).sum(-1)
+        temp = torch.min(temp, d)
+        old = torch.where(valid, temp, neg).argmax(dim=1)
+        idxs[:, j] = old
+    return idxs.int()
+
+
+def gather_operation(features, idx):
+    r"""
+    Parameters
+    ----------
+    features : torch.Tensor
+        (B, C, N) tensor
+    idx : torch.Tensor
+        (B, npoint) tensor of the features to gather
+
+    Returns
+    -------
+    torch.Tensor
+        (B, C, npoint) tensor
+    """
+    B, C, _ = features.size()
+    idx = idx.long().unsqueeze(1).expand(B, C, idx.size(1))
+    return torch.gather(features, 2, idx)
+
+
+def grouping_operation(features, idx):
+    r"""
+    Parameters
+    ----------
+    features : torch.Tensor
+        (B, C, N) tensor of features to group
+    idx : torch.Tensor
+        (B, npoint, nsample) tensor containing the indicies of features to group with
+
+    Returns
+    -------
+    torch.Tensor
+        (B, C, npoint, nsample) tensor
+    """
+    B, C, _ = features.size()
+    _, npoint, nsample = idx.size()
+    flat_idx = idx.long().view(B, 1, npoint * nsample).expand(B, C, npoint * nsample)
+    return torch.gather(features, 2, flat_idx).view(B, C, npoint, nsample)
+
+
+def ball_query(radius, nsample, xyz, new_xyz):
+    r"""
+    Parameters
+    ----------
+    radius : float
+        radius of the balls
+    nsample : int
+        maximum number of features in the balls
+    xyz : torch.Tensor
+        (B, N, 3) xyz coordinates of the features
+    new_xyz : torch.Tensor
+        (B, npoint, 3) centers of the ball query
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint, nsample) int32 tensor. Balls with fewer than nsample points
+        are padded with their first neighbor, empty balls are all zeros.
+    """
+    B, N, _ = xyz.size()
+    npoint = new_xyz.size(1)
+    xyz, new_xyz = xyz.detach(), new_xyz.detach()
+    radius2 = torch.tensor(radius, dtype=torch.float32).item() ** 2
+    k = min(nsample, N)
+    arange = torch.arange(N, device=xyz.device)
+    idx = torch.zeros(B, npoint, nsample, dtype=torch.long, device=xyz.device)
+    step = _chunk_size(npoint, B * N * 2)
+    for s in range(0, npoint, step):
+        e = min(npoint, s + step)
+        d2 = _sq_dist(new_xyz[:, s:e], xyz)
+        # Indices of hits in increasing order, misses become N.
+        key = torch.where(d2 < radius2, arange, torch.full_like(arange, N))
+        hits = torch.topk(key, k, dim=-1, largest=False, sorted=True)[0]
+        if k < nsample:
+            hits = torch.cat([hits, hits.new_full((B, e - s, nsample - k), N)], dim=-1)
+        first = hits[:, :, :1]
+        first = torch.where(first == N, torch.zeros_like(first), first)
+        idx[:, s:e] = torch.where(hits == N, first.expand_as(hits), hits)
+    return idx.int()
+
+
+def knn_query(nsample, xyz, new_xyz):
+    r"""
+    Parameters
+    ----------
+    nsample : int
+        number of neighbors
+    xyz : torch.Tensor
+        (B, N, 3) xyz coordinates of the features
+    new_xyz : torch.Tensor
+        (B, npoint, 3) centers of the query
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint, nsample) int32 indices of the nearest features, closest
+        first. Clouds with fewer than nsample points repeat the nearest one.
+    """
+    B, N, _ = xyz.size()
+    npoint = new_xyz.size(1)
+    xyz, new_xyz = xyz.detach(), new_xyz.detach()
+    idx = torch.zeros(B, npoint, nsample, dtype=torch.long, device=xyz.device)
+    k = min(nsample, N)
+    if k <= 0:
+        return idx.int()
+    step = _chunk_size(npoint, B * N * 2)
+    for s in range(0, npoint, step):
+        e = min(npoint, s + step)
+        d2 = _sq_dist(new_xyz[:, s:e], xyz)
+        ind = torch.topk(d2, k, dim=-1, largest=False, sorted=True)[1]
+        idx[:, s:e, :k] = ind
+        if k < nsample:
+            idx[:, s:e, k:] = ind[:, :, :1]
+    return idx.int()
+
+
+def three_nn(unknown, known):
+    r"""
+    Parameters
+    ----------
+    unknown : torch.Tensor
+        (B, n, 3) tensor of unknown features
+    known : torch.Tensor
+        (B, m, 3) tensor of known features
+
+    Returns
+    -------
+    dist2 : torch.Tensor
+        (B, n, 3) squared l2 distance to the three nearest neighbors
+    idx : torch.Tensor
+        (B, n, 3) int32 index of 3 nearest neighbors
+    """
+    B, n, _ = unknown.size()
+    m = known.size(1)
+    unknown, known = unknown.detach(), known.detach()
+    k = min(3, m)
+    dist2 = torch.full((B, n, 3), float('inf'), dtype=unknown.dtype, device=unknown.device)
+    idx = torch.zeros(B, n, 3, dtype=torch.long, device=unknown.device)
+    step = _chunk_size(n, B * m * 2)
+    for s in range(0, n, step):
+        e = min(n, s + step)
+        d2 = _sq_dist(unknown[:, s:e], known)
+        val, ind = torch.topk(d2, k, dim=-1, largest=False, sorted=True)
+        dist2[:, s:e, :k] = val
+        idx[:, s:e, :k] = ind
+    return dist2, idx.int()
+
+
+def _packed_bounds(offsets):
+    bounds = offsets.tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def furthest_point_sample_packed(xyz, offsets, npoint):
+    r"""
+    furthest_point_sample on every cloud of a packed batch
+
+    xyz: (N, 3), offsets: (B + 1) -> (B, npoint) int32 indices into xyz
+    """
+    return torch.cat([furthest_point_sample(xyz[s:e].unsqueeze(0), npoint) + s
+                      for s, e in _packed_bounds(offsets)], dim=0)
+
+
+def ball_query_packed(radius, nsample, xyz, offsets, new_xyz):
+    r"""
+    ball_query on every cloud of a packed batch
+
+    xyz: (N, 3), offsets: (B + 1), new_xyz: (B, npoint, 3)
+    -> (B, npoint, nsample) int32 indices into xyz
+    """
+    return torch.cat([ball_query(radius, nsample, xyz[s:e].unsqueeze(0), new_xyz[i:i + 1]) + s
+                      for i, (s, e) in enumerate(_packed_bounds(offsets))], dim=0)
+
+
+def three_nn_packed(unknown, offsets, known):
+    r"""
+    three_nn for every cloud of a packed batch of unknowns
+
+    unknown: (N, 3), offsets: (B + 1), known: (B, m, 3)
+    -> dist2, idx: (N, 3), idx into the known points of the same cloud
+    """
+    dist2, idx = [], []
+    for i, (s, e) in enumerate(_packed_bounds(offsets)):
+        d, j = three_nn(unknown[s:e].unsqueeze(0), known[i:i + 1])
+        dist2.append(d[0])
+        idx.append(j[0])
+    return torch.cat(dist2, dim=0), torch.cat(idx, dim=0)
+
+
+def three_interpolate(features, idx, weight):
+    r"""
+    Parameters
+    ----------
+    features : torch.Tensor
+        (B, c, m) Features descriptors to be interpolated from
+    idx : torch.Tensor
+        (B, n, 3) three nearest neighbors of the target features in features
+    weight : torch.Tensor
+        (B, n, 3) weights
+
+    Returns
+    -------
+    torch.Tensor
+        (B, c, n) tensor of the interpolated features
+    """
+    B, c, _ = features.size()
+    n = idx.size(1)
+    out = []
+    step = _chunk_size(n, B * c * 3)
+    for s in range(0, n, step):
+        e = min(n, s + step)
+        grouped = grouping_operation(features, idx[:, s:e])  # (B, c, e-s, 3)
+        out.append((grouped * weight[:, s:e].unsqueeze(1)).sum(-1))
+    return torch.cat(out, dim=2)
+
+
+if __name__ == '__main__':
+    # Cross-check against the compiled kernels: python pointnet2_torch.py
+    import pointnet2_utils
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    B, N, npoint, C = 2, 4096, 512, 32
+    xyz = torch.rand(B, N, 3, device=device) * 4
+    features = torch.rand(B, C, N, device=device, requires_grad=True)
+
+    for backend in ('ext', 'torch'):
+        pointnet2_utils.set_backend(backend)
+        inds = pointnet2_utils.furthest_point_sample(xyz, npoint)
+        new_xyz = pointnet2_utils.gather_operation(
+            xyz.transpose(1, 2).contiguous(), inds).transpose(1, 2).contiguous()
+        idx = pointnet2_utils.ball_query(0.4, 32, xyz, new_xyz)
+        grouped = pointnet2_utils.grouping_operation(features, idx)
+        dist, nn_idx = pointnet2_utils.three_nn(xyz, new_xyz)
+        weight = 1.0 / (dist + 1e-8)
+        weight = weight / weight.sum(dim=2, keepdim=True)
+        interp = pointnet2_utils.three_interpolate(grouped[:, :, :, 0].contiguous(), nn_idx, weight)
+        features.grad = None
+        (grouped.sum() + interp.sum()).backward()
+        res = [inds, idx, grouped, dist, nn_idx, interp, features.grad.clone()]
+        if backend == 'ext':
+            ref = res
+
+    names = ['fps', 'ball_query', 'grouping', 'three_nn dist', 'three_nn idx',
+             'three_interpolate', 'features grad']
+    for name, a, b in zip(names, ref, res):
+        if a.dtype == torch.int32:
+            print('%s identical: %s' % (name, torch.equal(a, b)))
+        else:
+            print('%s max abs diff: %g' % (name, (a - b).abs().max().item()))
@@ -15,7 +15,10 @@ import torch
 from torch.autograd import Function
 import torch.nn as nn
 import pytorch_utils as pt_utils
+import pointnet2_torch
+import os
 import sys
+import warnings
 
 try:
     import builtins
@@ -25,12 +28,55 @@ except:
 try:
     import pointnet2._ext as _ext
 except ImportError:
-    if not getattr(builtins, "__POINTNET2_SETUP__", False):
+    _ext = None
+
+BACKENDS = ("ext", "torch")
+# 'ext' runs the compiled kernels, 'torch' the pure PyTorch ops in
+# pointnet2_torch. Defaults to 'ext' whenever the extension is built.
+_backend = "ext" if _ext is not None else "torch"
+
+
+def set_backend(backend):
+    # type: (str) -> None
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("unknown pointnet2 backend %r, expected one of %s" % (
+            backend, ", ".join(BACKENDS)))
+    if backend == "ext" and _ext is None:
         raise ImportError(
-            "Could not import _ext module.\n"
+            "Could not import _ext module, cannot use the 'ext' backend.\n"
             "Please see the setup instructions in the README: "
             "https://github.com/erikwijmans/Pointnet2_PyTorch/blob/master/README.rst"
         )
+    _backend = backend
+
+
+if not getattr(builtins, "__POINTNET2_SETUP__", False):
+    # Validate POINTNET2_BACKEND once here instead of at the first op call
+    if "POINTNET2_BACKEND" in os.environ:
+        set_backend(os.environ["POINTNET2_BACKEND"])
+    elif _ext is None:
+        warnings.warn("pointnet2._ext is not built, using the pure PyTorch backend")
+
+
+def get_backend():
+    # type: () -> str
+    return _backend
+
+
+def _use_torch(backend):
+    backend = _backend if backend is None else backend
+    if backend not in BACKENDS:
+        raise ValueError("unknown pointnet2 backend %r, expected one of %s" % (
+            backend, ", ".join(BACKENDS)))
+    return backend == "torch"
+
+
+def _use_ops():
+    # While tracing, call the kernels through their torch.ops.pointnet2
+    # registration: the graph cannot record the pybind functions of _ext and
+    # would bake their outputs in as constants. Inference only, no backward.
+    return torch.jit.is_tracing()
 
 if False:
     # Workaround for type hints without depending on the `typing` module
@@ -68,14 +114,19 @@ class FurthestPointSampling(Function):
         torch.Tensor
             (B, npoint) tensor containing the set
         """
-        return _ext.furthest_point_sampling(xyz, npoint)
+        return _ext.furthest_point_sampling(xyz.float(), npoint)
 
     @staticmethod
     def backward(xyz, a=None):
         return None, None
 
 
-furthest_point_sample = FurthestPointSampling.apply
+def furthest_point_sample(xyz, npoint, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.furthest_point_sample(xyz, npoint)
+    if _use_ops():
+        return torch.ops.pointnet2.furthest_point_sampling(xyz.float(), npoint)
+    return FurthestPointSampling.apply(xyz, npoint)
 
 
 class GatherOperation(Function):
@@ -112,7 +163,12 @@ class GatherOperation(Function):
         return grad_features, None
 
 
-gather_operation = GatherOperation.apply
+def gather_operation(features, idx, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.gather_operation(features, idx)
+    if _use_ops():
+        return torch.ops.pointnet2.gather_points(features, idx)
+    return GatherOperation.apply(features, idx)
 
 
 class ThreeNN(Function):
@@ -135,7 +191,47 @@ class ThreeNN(Function):
         idx : torch.Tensor
             (B, n, 3) index of 3 nearest neighbors
         """
-        dist2, idx = _ext.three_nn(unknown, known)
+        dist2, idx = _ext.three_nn(unknown.float(), known.float())
+
+        return torch.sqrt(dist2), idx
+
+    @staticmethod
+    def backward(ctx, a=None, b=None):
+        return None, None
+
+
+def three_nn(unknown, known, backend=None):
+    if _use_torch(backend):
+        dist2, idx = pointnet2_torch.three_nn(unknown, known)
+        return torch.sqrt(dist2), idx
+    if _use_ops():
+        dist2, idx = torch.ops.pointnet2.three_nn(unknown.float(), known.float())
+        return torch.sqrt(dist2), idx
+    return ThreeNN.apply(unknown, known)
+
+
+class ThreeNNGrid(Function):
+    @staticmethod
+    def forward(ctx, unknown, known):
+        # type: (Any, torch.Tensor, torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        r"""
+            Find the three nearest neighbors of unknown in known with a voxel grid
+            built over known. Returns exactly the same result as ThreeNN.
+        Parameters
+        ----------
+        unknown : torch.Tensor
+            (B, n, 3) tensor of known features
+        known : torch.Tensor
+            (B, m, 3) tensor of unknown features
+
+        Returns
+        -------
+        dist : torch.Tensor
+            (B, n, 3) l2 distance to the three nearest neighbors
+        idx : torch.Tensor
+            (B, n, 3) index of 3 nearest neighbors
+        """
+        dist2, idx = _ext.three_nn_grid(unknown.float(), known.float())
 
         return torch.sqrt(dist2), idx
 
@@ -144,7 +240,15 @@ class ThreeNN(Function):
         return None, None
 
 
-three_nn = ThreeNN.apply
+def three_nn_grid(unknown, known, backend=None):
+    if _use_torch(backend):
+        # The torch backend is already chunked, the grid only exists in _ext
+        dist2, idx = pointnet2_torch.three_nn(unknown, known)
+        return torch.sqrt(dist2), idx
+    if _use_ops():
+        dist2, idx = torch.ops.pointnet2.three_nn_grid(unknown.float(), known.float())
+        return torch.sqrt(dist2), idx
+    return ThreeNNGrid.apply(unknown, known)
 
 
 class ThreeInterpolate(Function):
@@ -170,6 +274,7 @@ class ThreeInterpolate(Function):
         B, c, m = features.size()
         n = idx.size(1)
 
+        weight = weight.float()
         ctx.three_interpolate_for_backward = (idx, weight, m)
 
         return _ext.three_interpolate(features, idx, weight)
@@ -201,7 +306,12 @@ class ThreeInterpolate(Function):
         return grad_features, None, None
 
 
-three_interpolate = ThreeInterpolate.apply
+def three_interpolate(features, idx, weight, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.three_interpolate(features, idx, weight)
+    if _use_ops():
+        return torch.ops.pointnet2.three_interpolate(features, idx, weight.float())
+    return ThreeInterpolate.apply(features, idx, weight)
 
 
 class GroupingOperation(Function):
@@ -252,7 +362,12 @@ class GroupingOperation(Function):
         return grad_features, None
 
 
-grouping_operation = GroupingOperation.apply
+def grouping_operation(features, idx, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.grouping_operation(features, idx)
+    if _use_ops():
+        return torch.ops.pointnet2.group_points(features, idx)
+    return GroupingOperation.apply(features, idx)
 
 
 class BallQuery(Function):
@@ -277,14 +392,548 @@ class BallQuery(Function):
         torch.Tensor
             (B, npoint, nsample) tensor with the indicies of the features that form the query balls
         """
-        return _ext.ball_query(new_xyz, xyz, radius, nsample)
+        return _ext.ball_query(new_xyz.float(), xyz.float(), radius, nsample)
 
     @staticmethod
     def backward(ctx, a=None):
         return None, None, None, None
 
 
-ball_query = BallQuery.apply
+def ball_query(radius, nsample, xyz, new_xyz, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.ball_query(radius, nsample, xyz, new_xyz)
+    if _use_ops():
+        return torch.ops.pointnet2.ball_query(new_xyz.float(), xyz.float(), radius, nsample)
+    return BallQuery.apply(radius, nsample, xyz, new_xyz)
+
+
+class BallQueryGrid(Function):
+    @staticmethod
+    def forward(ctx, radius, nsample, xyz, new_xyz):
+        # type: (Any, float, int, torch.Tensor, torch.Tensor) -> torch.Tensor
+        r"""
+        Ball query on a uniform voxel grid built from xyz, with cells sized
+        from the radius. Returns exactly the same indices as BallQuery.
+
+        Parameters
+        ----------
+        radius : float
+            radius of the balls
+        nsample : int
+            maximum number of features in the balls
+        xyz : torch.Tensor
+            (B, N, 3) xyz coordinates of the features
+        new_xyz : torch.Tensor
+            (B, npoint, 3) centers of the ball query
+
+        Returns
+        -------
+        torch.Tensor
+            (B, npoint, nsample) tensor with the indicies of the features that form the query balls
+        """
+        return _ext.ball_query_grid(new_xyz.float(), xyz.float(), radius, nsample)
+
+    @staticmethod
+    def backward(ctx, a=None):
+        return None, None, None, None
+
+
+def ball_query_grid(radius, nsample, xyz, new_xyz, backend=None):
+    if _use_torch(backend):
+        # The torch backend is already chunked, the grid only exists in _ext
+        return pointnet2_torch.ball_query(radius, nsample, xyz, new_xyz)
+    if _use_ops():
+        return torch.ops.pointnet2.ball_query_grid(new_xyz.float(), xyz.float(), radius, nsample)
+    return BallQueryGrid.apply(radius, nsample, xyz, new_xyz)
+
+
+class KNNQuery(Function):
+    @staticmethod
+    def forward(ctx, nsample, xyz, new_xyz):
+        # type: (Any, int, torch.Tensor, torch.Tensor) -> torch.Tensor
+        r"""
+        The nsample nearest features of every center, found with a ring search
+        on a uniform voxel grid built from xyz
+
+        Parameters
+        ----------
+        nsample : int
+            number of neighbors
+        xyz : torch.Tensor
+            (B, N, 3) xyz coordinates of the features
+        new_xyz : torch.Tensor
+            (B, npoint, 3) centers of the query
+
+        Returns
+        -------
+        torch.Tensor
+            (B, npoint, nsample) tensor with the indicies of the nearest features,
+            sorted by distance (then index)
+        """
+        dist2, idx = _ext.knn_query(new_xyz.float(), xyz.float(), nsample)
+        return idx
+
+    @staticmethod
+    def backward(ctx, a=None):
+        return None, None, None
+
+
+def knn_query(nsample, xyz, new_xyz, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.knn_query(nsample, xyz, new_xyz)
+    if _use_ops():
+        return torch.ops.pointnet2.knn_query(new_xyz.float(), xyz.float(), nsample)[1]
+    return KNNQuery.apply(nsample, xyz, new_xyz)
+
+
+def voxel_furthest_point_sample(xyz, npoint, voxel_size, backend=None):
+    # type: (torch.Tensor, int, float, str) -> torch.Tensor
+    r"""
+    Keeps the first point of every occupied voxel and runs FPS on those.
+    Clouds with fewer than npoint occupied voxels fall back to plain FPS.
+
+    Parameters
+    ----------
+    xyz : torch.Tensor
+        (B, N, 3) tensor
+    npoint : int
+        number of points to sample
+    voxel_size : float
+        edge length of the voxels
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint) tensor of indices into xyz
+    """
+    B, N, _ = xyz.size()
+    xyz = xyz.detach()
+    arange = torch.arange(N, device=xyz.device)
+    reps = []
+    for b in range(B):
+        key = torch.floor((xyz[b] - xyz[b].min(0)[0]) / voxel_size).long()
+        dims = key.max(0)[0] + 1
+        key = (key[:, 0] * dims[1] + key[:, 1]) * dims[2] + key[:, 2]
+        key, perm = torch.sort(key * N + arange)
+        voxel = key // N
+        first = torch.ones_like(voxel)
+        first[1:] = (voxel[1:] != voxel[:-1]).long()
+        rep = torch.sort(perm[first.nonzero().squeeze(1)])[0]
+        reps.append(rep if rep.numel() >= npoint else arange)
+    # Pad with the first point, its copies get a zero distance and are never picked
+    R = max(rep.numel() for rep in reps)
+    reps = torch.stack([torch.cat([rep, rep[:1].expand(R - rep.numel())]) for rep in reps])
+    sub_xyz = torch.gather(xyz, 1, reps.unsqueeze(-1).expand(B, R, 3)).contiguous()
+    sub_inds = furthest_point_sample(sub_xyz, npoint, backend)
+    return torch.gather(reps, 1, sub_inds.long()).int()
+
+
+def bucket_furthest_point_sample(xyz, npoint, levels=3, backend=None):
+    # type: (torch.Tensor, int, int, str) -> torch.Tensor
+    r"""
+    Splits every cloud into 2**levels equal buckets (a KD-tree cut at the
+    median of the widest axis) and runs FPS inside all buckets at once, so
+    the sequential part of FPS is npoint / 2**levels steps long. levels is
+    lowered until both N and npoint split evenly.
+
+    Parameters
+    ----------
+    xyz : torch.Tensor
+        (B, N, 3) tensor
+    npoint : int
+        number of points to sample
+    levels : int
+        depth of the KD-tree
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint) tensor of indices into xyz
+    """
+    B, N, _ = xyz.size()
+    xyz = xyz.detach()
+    while levels > 0 and (N % (1 << levels) or npoint % (1 << levels)):
+        levels -= 1
+    perm = torch.arange(N, device=xyz.device).view(1, 1, N).repeat(B, 1, 1)  # (B, K, N/K)
+    for _ in range(levels):
+        K, n = perm.size(1), perm.size(2)
+        pts = torch.gather(xyz, 1, perm.view(B, K * n, 1).expand(B, K * n, 3)).view(B, K, n, 3)
+        axis = (pts.max(2)[0] - pts.min(2)[0]).argmax(-1)  # (B, K)
+        coord = torch.gather(pts, 3, axis.view(B, K, 1, 1).expand(B, K, n, 1)).squeeze(-1)
+        order = coord.argsort(-1)
+        perm = torch.gather(perm, 2, order).view(B, 2 * K, n // 2)
+    K, n = perm.size(1), perm.size(2)
+    pts = torch.gather(xyz, 1, perm.view(B, K * n, 1).expand(B, K * n, 3)).view(B * K, n, 3)
+    sub_inds = furthest_point_sample(pts.contiguous(), npoint // K, backend)  # (B*K, npoint/K)
+    inds = torch.gather(perm.view(B * K, n), 1, sub_inds.long())
+    return inds.view(B, npoint).int()
+
+
+def seeded_furthest_point_sample(xyz, npoint, seed=0, backend=None):
+    # type: (torch.Tensor, int, int, str) -> torch.Tensor
+    r"""
+    FPS started from a random point per cloud instead of point 0. The start
+    points come from a generator seeded with seed, so repeated calls give the
+    same samples.
+
+    Parameters
+    ----------
+    xyz : torch.Tensor
+        (B, N, 3) tensor
+    npoint : int
+        number of points to sample
+    seed : int
+        seed of the start points
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint) tensor of indices into xyz
+    """
+    B, N, _ = xyz.size()
+    gen = torch.Generator()
+    gen.manual_seed(seed)
+    start = torch.randint(0, N, (B, 1), generator=gen).to(xyz.device)
+    order = (torch.arange(N, device=xyz.device).unsqueeze(0) + start) % N  # (B, N)
+    rolled = torch.gather(xyz.detach(), 1, order.unsqueeze(-1).expand(B, N, 3)).contiguous()
+    sub_inds = furthest_point_sample(rolled, npoint, backend)
+    return torch.gather(order, 1, sub_inds.long()).int()
+
+
+SAMPLERS = {
+    'fps': furthest_point_sample,
+    'voxel_fps': voxel_furthest_point_sample,
+    'bucket_fps': bucket_furthest_point_sample,
+    'seeded_fps': seeded_furthest_point_sample,
+}
+
+
+def sample_points(xyz, npoint, sampler='fps', **kwargs):
+    # type: (torch.Tensor, int, str, **Any) -> torch.Tensor
+    r"""
+    Samples npoint points of xyz with one of SAMPLERS, kwargs go to the sampler
+    """
+    assert sampler in SAMPLERS, "unknown sampler %s" % sampler
+    return SAMPLERS[sampler](xyz, npoint, **kwargs)
+
+
+def sampling_coverage(xyz, inds):
+    # type: (torch.Tensor, torch.Tensor) -> torch.Tensor
+    r"""
+    Coverage of a sampling: max over all points of the distance to the
+    closest sampled point (lower is better, FPS approximates the minimum).
+
+    Parameters
+    ----------
+    xyz : torch.Tensor
+        (B, N, 3) tensor
+    inds : torch.Tensor
+        (B, npoint) sampled indices
+
+    Returns
+    -------
+    torch.Tensor
+        (B,) tensor
+    """
+    new_xyz = gather_operation(xyz.transpose(1, 2).contiguous(), inds).transpose(1, 2).contiguous()
+    dist, _ = three_nn_grid(xyz.contiguous(), new_xyz)
+    return dist[:, :, 0].max(1)[0]
+
+
+def resample_unique(idx):
+    # type: (torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+    r"""
+    Replaces the duplicates of each ball query by neighbors drawn uniformly
+    from its unique indices, for all balls at once
+
+    Parameters
+    ----------
+    idx : torch.Tensor
+        (B, npoint, nsample) ball query indices
+
+    Returns
+    -------
+    idx : torch.Tensor
+        (B, npoint, nsample) the sorted unique indices of each ball followed by
+        random picks among them
+    unique_cnt : torch.Tensor
+        (B, npoint) float tensor, number of unique indices of each ball
+    """
+    B, npoint, nsample = idx.size()
+    idx_sorted = idx.long().sort(dim=-1)[0]
+    is_new = torch.cat([
+        torch.ones_like(idx_sorted[:, :, :1]),
+        (idx_sorted[:, :, 1:] != idx_sorted[:, :, :-1]).long()
+    ], dim=-1)
+    unique_cnt = is_new.sum(-1, keepdim=True)  # (B, npoint, 1)
+    arange = torch.arange(nsample, device=idx.device)
+    # Stable move of the unique indices to the front of each row
+    order = ((1 - is_new) * nsample + arange).argsort(dim=-1)
+    unique_ind = idx_sorted.gather(-1, order)
+    pick = (torch.rand(B, npoint, nsample, device=idx.device) * unique_cnt.float()).long()
+    pick = torch.min(pick, unique_cnt - 1)
+    pick = torch.where(arange < unique_cnt, arange.expand_as(pick), pick)
+    return unique_ind.gather(-1, pick).to(idx.dtype), unique_cnt.squeeze(-1).float()
+
+
+def pack_point_clouds(clouds):
+    # type: (List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]
+    r"""
+    Packs clouds of different sizes into one batch without padding
+
+    Parameters
+    ----------
+    clouds : list of torch.Tensor
+        B (n_i, C) tensors
+
+    Returns
+    -------
+    points : torch.Tensor
+        (sum n_i, C) tensor, the clouds back to back
+    offsets : torch.Tensor
+        (B + 1) int32 tensor, cloud i is points[offsets[i]:offsets[i + 1]]
+    """
+    counts = torch.tensor([0] + [c.shape[0] for c in clouds], dtype=torch.long)
+    offsets = counts.cumsum(0).int().to(clouds[0].device)
+    return torch.cat(clouds, dim=0), offsets
+
+
+def packed_batch_index(offsets):
+    # type: (torch.Tensor) -> torch.Tensor
+    r"""
+    (N,) long tensor with the cloud of every point of a packed batch
+    """
+    counts = (offsets[1:] - offsets[:-1]).long()
+    return torch.repeat_interleave(torch.arange(counts.numel(), device=offsets.device), counts)
+
+
+class FurthestPointSamplingPacked(Function):
+    @staticmethod
+    def forward(ctx, xyz, offsets, npoint):
+        # type: (Any, torch.Tensor, torch.Tensor, int) -> torch.Tensor
+        r"""
+        FPS on every cloud of a packed batch, npoint points per cloud
+
+        Parameters
+        ----------
+        xyz : torch.Tensor
+            (N, 3) the clouds back to back
+        offsets : torch.Tensor
+            (B + 1) int32 tensor, cloud i spans offsets[i]:offsets[i + 1]
+        npoint : int32
+            number of features in the sampled set
+
+        Returns
+        -------
+        torch.Tensor
+            (B, npoint) tensor containing the indices into xyz
+        """
+        return _ext.furthest_point_sampling_packed(xyz.float(), offsets, npoint)
+
+    @staticmethod
+    def backward(xyz, a=None):
+        return None, None, None
+
+
+def furthest_point_sample_packed(xyz, offsets, npoint, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.furthest_point_sample_packed(xyz, offsets, npoint)
+    if _use_ops():
+        return torch.ops.pointnet2.furthest_point_sampling_packed(xyz.float(), offsets, npoint)
+    return FurthestPointSamplingPacked.apply(xyz, offsets, npoint)
+
+
+class BallQueryPacked(Function):
+    @staticmethod
+    def forward(ctx, radius, nsample, xyz, offsets, new_xyz):
+        # type: (Any, float, int, torch.Tensor, torch.Tensor, torch.Tensor) -> torch.Tensor
+        r"""
+        Ball query on every cloud of a packed batch
+
+        Parameters
+        ----------
+        radius : float
+            radius of the balls
+        nsample : int
+            maximum number of features in the balls
+        xyz : torch.Tensor
+            (N, 3) the clouds back to back
+        offsets : torch.Tensor
+            (B + 1) int32 tensor, cloud i spans offsets[i]:offsets[i + 1]
+        new_xyz : torch.Tensor
+            (B, npoint, 3) centers of the ball query in every cloud
+
+        Returns
+        -------
+        torch.Tensor
+            (B, npoint, nsample) tensor with the indicies into xyz of the features that form the query balls
+        """
+        return _ext.ball_query_packed(new_xyz.float(), xyz.float(), offsets, radius, nsample)
+
+    @staticmethod
+    def backward(ctx, a=None):
+        return None, None, None, None, None
+
+
+def ball_query_packed(radius, nsample, xyz, offsets, new_xyz, backend=None):
+    if _use_torch(backend):
+        return pointnet2_torch.ball_query_packed(radius, nsample, xyz, offsets, new_xyz)
+    if _use_ops():
+        return torch.ops.pointnet2.ball_query_packed(new_xyz.float(), xyz.float(), offsets, radius, nsample)
+    return BallQueryPacked.apply(radius, nsample, xyz, offsets, new_xyz)
+
+
+def knn_query_packed(nsample, xyz, offsets, new_xyz, backend=None):
+    # type: (int, torch.Tensor, torch.Tensor, torch.Tensor, str) -> torch.Tensor
+    r"""
+    knn_query against a packed batch: the clouds are padded with far away
+    points for knn_query, padding picks (clouds with fewer than nsample
+    points) repeat the nearest neighbor, as knn_query does
+
+    Parameters
+    ----------
+    nsample : int
+        number of neighbors
+    xyz : torch.Tensor
+        (N, 3) the clouds back to back
+    offsets : torch.Tensor
+        (B + 1) int32 tensor, cloud i is xyz[offsets[i]:offsets[i + 1]]
+    new_xyz : torch.Tensor
+        (B, npoint, 3) centers of the query of every cloud
+
+    Returns
+    -------
+    torch.Tensor
+        (B, npoint, nsample) int32 indices into the packed batch
+    """
+    B = offsets.size(0) - 1
+    starts = offsets[:-1].long()
+    counts = offsets[1:].long() - starts
+    batch = packed_batch_index(offsets)
+    local = torch.arange(xyz.size(0), device=xyz.device) - starts[batch]
+    padded = xyz.new_full((B, int(counts.max().item()), 3), 1e6)
+    padded[batch, local] = xyz.detach()
+    idx = knn_query(nsample, padded, new_xyz.contiguous(), backend).long()  # (B, npoint, nsample)
+    idx = torch.where(idx < counts.view(B, 1, 1), idx, idx[:, :, :1])
+    return (idx + starts.view(B, 1, 1)).int()
+
+
+def grouping_operation_packed(features, idx, backend=None):
+    # type: (torch.Tensor, torch.Tensor, str) -> torch.Tensor
+    r"""
+    Parameters
+    ----------
+    features : torch.Tensor
+        (C, N) features of a packed batch
+    idx : torch.Tensor
+        (B, npoint, nsample) indices into the packed batch
+
+    Returns
+    -------
+    torch.Tensor
+        (B, C, npoint, nsample) tensor
+    """
+    B, npoint, nsample = idx.size()
+    grouped = grouping_operation(features.unsqueeze(0), idx.view(1, B * npoint, nsample), backend)
+    return grouped.view(-1, B, npoint, nsample).transpose(0, 1)
+
+
+class ThreeNNPacked(Function):
+    @staticmethod
+    def forward(ctx, unknown, offsets, known):
+        # type: (Any, torch.Tensor, torch.Tensor, torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        r"""
+            Find the three nearest neighbors of a packed batch of unknown in known
+        Parameters
+        ----------
+        unknown : torch.Tensor
+            (N, 3) the clouds back to back
+        offsets : torch.Tensor
+            (B + 1) int32 tensor, cloud i spans offsets[i]:offsets[i + 1]
+        known : torch.Tensor
+            (B, m, 3) tensor of known features
+
+        Returns
+        -------
+        dist : torch.Tensor
+            (N, 3) l2 distance to the three nearest neighbors
+        idx : torch.Tensor
+            (N, 3) index of 3 nearest neighbors among the known points of the same cloud
+        """
+        dist2, idx = _ext.three_nn_packed(unknown.float(), offsets, known.float())
+
+        return torch.sqrt(dist2), idx
+
+    @staticmethod
+    def backward(ctx, a=None, b=None):
+        return None, None, None
+
+
+def three_nn_packed(unknown, offsets, known, backend=None):
+    if _use_torch(backend):
+        dist2, idx = pointnet2_torch.three_nn_packed(unknown, offsets, known)
+        return torch.sqrt(dist2), idx
+    if _use_ops():
+        dist2, idx = torch.ops.pointnet2.three_nn_packed(unknown.float(), offsets, known.float())
+        return torch.sqrt(dist2), idx
+    return ThreeNNPacked.apply(unknown, offsets, known)
+
+
+def three_interpolate_packed(features, idx, weight, offsets, backend=None):
+    # type: (torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, str) -> torch.Tensor
+    r"""
+    Parameters
+    ----------
+    features : torch.Tensor
+        (B, c, m) Features descriptors to be interpolated from
+    idx : torch.Tensor
+        (N, 3) three_nn_packed indices of a packed batch
+    weight : torch.Tensor
+        (N, 3) weights
+    offsets : torch.Tensor
+        (B + 1) int32 tensor, cloud i spans offsets[i]:offsets[i + 1]
+
+    Returns
+    -------
+    torch.Tensor
+        (c, N) tensor of the interpolated features
+    """
+    B, c, m = features.size()
+    # Index the known points of all clouds as one flat cloud
+    flat_idx = idx.long() + packed_batch_index(offsets).unsqueeze(1) * m
+    flat_features = features.transpose(0, 1).contiguous().view(1, c, B * m)
+    return three_interpolate(flat_features, flat_idx.int().unsqueeze(0).contiguous(),
+                             weight.unsqueeze(0).contiguous(), backend)[0]
+
+
+class GeometryCache(object):
+    r"""
+    Neighborhoods computed during one forward pass, keyed by the layer
+    geometry and the identity of its input tensors. Layers that see the very
+    same xyz tensors (e.g. the four backbone towers of HDNet) look up the
+    FPS indices, ball queries and interpolation weights instead of
+    recomputing them. Create a new cache for every forward pass.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, *tensors):
+        # type: (GeometryCache, tuple, torch.Tensor) -> Any
+        entry = self._entries.get((key,) + tuple(id(t) for t in tensors))
+        # The entry keeps its tensors alive, so their ids cannot be reused
+        if entry is None or any(a is not b for a, b in zip(entry[0], tensors)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, tensors, value):
+        # type: (GeometryCache, tuple, Tuple[torch.Tensor], Any) -> Any
+        self._entries[(key,) + tuple(id(t) for t in tensors)] = (tuple(tensors), value)
+        return value
 
 
 class QueryAndGroup(nn.Module):
@@ -297,9 +946,12 @@ class QueryAndGroup(nn.Module):
         Radius of ball
     nsample : int32
         Maximum number of features to gather in the ball
+    use_grid : bool
+        Run the ball query on a voxel grid (ball_query_grid), same result,
+        much faster for large point clouds
     """
 
-    def __init__(self, radius, nsample, use_xyz=True, ret_grouped_xyz=False, normalize_xyz=False, sample_uniformly=False, ret_unique_cnt=False, use_feature=False, ret_idx=False):
+    def __init__(self, radius, nsample, use_xyz=True, ret_grouped_xyz=False, normalize_xyz=False, sample_uniformly=False, ret_unique_cnt=False, use_feature=False, ret_idx=False, use_grid=False):
         # type: (QueryAndGroup, float, int, bool) -> None
         super(QueryAndGroup, self).__init__()
         self.radius, self.nsample, self.use_xyz = radius, nsample, use_xyz
@@ -309,11 +961,40 @@ class QueryAndGroup(nn.Module):
         self.ret_unique_cnt = ret_unique_cnt
         self.ret_idx = ret_idx
         self.use_feature = use_feature
+        self.use_grid = use_grid
         if self.ret_unique_cnt:
             assert(self.sample_uniformly)
 
-    def forward(self, xyz, new_xyz, features=None):
-        # type: (QueryAndGroup, torch.Tensor. torch.Tensor, torch.Tensor) -> Tuple[Torch.Tensor]
+    def query(self, xyz, new_xyz):
+        # type: (QueryAndGroup, torch.Tensor, torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        r"""
+        Parameters
+        ----------
+        xyz : torch.Tensor
+            xyz coordinates of the features (B, N, 3)
+        new_xyz : torch.Tensor
+            centriods (B, npoint, 3)
+
+        Returns
+        -------
+        idx : torch.Tensor
+            (B, npoint, nsample) indices of the grouped features
+        unique_cnt : torch.Tensor
+            (B, npoint) number of unique points in each ball, None unless sample_uniformly
+        """
+        if self.use_grid:
+            idx = ball_query_grid(self.radius, self.nsample, xyz, new_xyz)
+        else:
+            idx = ball_query(self.radius, self.nsample, xyz, new_xyz)
+
+        unique_cnt = None
+        if self.sample_uniformly:
+            idx, unique_cnt = resample_unique(idx)
+
+        return idx, unique_cnt
+
+    def forward(self, xyz, new_xyz, features=None, idx=None):
+        # type: (QueryAndGroup, torch.Tensor. torch.Tensor, torch.Tensor, torch.Tensor) -> Tuple[Torch.Tensor]
         r"""
         Parameters
         ----------
@@ -323,26 +1004,46 @@ class QueryAndGroup(nn.Module):
             centriods (B, npoint, 3)
         features : torch.Tensor
             Descriptors of the features (B, C, N)
+        idx : torch.Tensor
+            (B, npoint, nsample) precomputed result of query(xyz, new_xyz), optional
 
         Returns
         -------
         new_features : torch.Tensor
             (B, 3 + C, npoint, nsample) tensor
         """
-        idx = ball_query(self.radius, self.nsample, xyz, new_xyz)
+        if idx is None:
+            idx, unique_cnt = self.query(xyz, new_xyz)
+        else:
+            assert not self.ret_unique_cnt, "unique_cnt is not available for a precomputed idx"
+        new_features, grouped_xyz = self.group(xyz, new_xyz, features, idx)
 
-        if self.sample_uniformly:
-            unique_cnt = torch.zeros((idx.shape[0], idx.shape[1]))
-            for i_batch in range(idx.shape[0]):
-                for i_region in range(idx.shape[1]):
-                    unique_ind = torch.unique(idx[i_batch, i_region, :])
-                    num_unique = unique_ind.shape[0]
-                    unique_cnt[i_batch, i_region] = num_unique
-                    sample_ind = torch.randint(0, num_unique, (self.nsample - num_unique,), dtype=torch.long)
-                    all_ind = torch.cat((unique_ind, unique_ind[sample_ind]))
-                    idx[i_batch, i_region, :] = all_ind
+        ret = [new_features]
+        if self.ret_grouped_xyz:
+            ret.append(grouped_xyz)
+        if self.ret_unique_cnt:
+            ret.append(unique_cnt)
+        if self.ret_idx:
+            ret.append(idx)
+        if len(ret) == 1:
+            return ret[0]
+        else:
+            return tuple(ret)
 
+    def group(self, xyz, new_xyz, features, idx):
+        # type: (QueryAndGroup, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        r"""
+        Grouping step of forward for a precomputed idx, whatever the ret_*
+        flags: callers that already hold the query results (unique_cnt, idx)
+        only need the grouped tensors
 
+        Returns
+        -------
+        new_features : torch.Tensor
+            (B, 3 + C, npoint, nsample) tensor
+        grouped_xyz : torch.Tensor
+            (B, 3, npoint, nsample) local xyz of the grouped points
+        """
         xyz_trans = xyz.transpose(1, 2).contiguous()
         grouped_xyz = grouping_operation(xyz_trans, idx)  # (B, 3, npoint, nsample)
         grouped_xyz -= new_xyz.transpose(1, 2).unsqueeze(-1)
@@ -353,7 +1054,7 @@ class QueryAndGroup(nn.Module):
             grouped_features = grouping_operation(features, idx)
             if self.use_xyz:
                 new_features = torch.cat(
-                    [grouped_xyz, grouped_features], dim=1
+                    [grouped_xyz.to(grouped_features.dtype), grouped_features], dim=1
                 )  # (B, C + 3, npoint, nsample)
             else:
                 new_features = grouped_features
@@ -368,17 +1069,33 @@ class QueryAndGroup(nn.Module):
             ), "Cannot have not features and not use xyz as a feature!"
             new_features = grouped_xyz
 
-        ret = [new_features]
-        if self.ret_grouped_xyz:
-            ret.append(grouped_xyz)
-        if self.ret_unique_cnt:
-            ret.append(unique_cnt)
-        if self.ret_idx:
-            ret.append(idx)
-        if len(ret) == 1:
-            return ret[0]
-        else:
-            return tuple(ret)
+        return new_features, grouped_xyz
+
+class KNNAndGroup(QueryAndGroup):
+    r"""
+    Groups the nsample nearest neighbors of every centroid. Drop-in for
+    QueryAndGroup: dense regions keep their closest points instead of the
+    lowest indices in the ball, sparse regions get real neighbors instead of
+    padding. The radius only scales the local xyz when normalize_xyz is set.
+
+    Parameters
+    ---------
+    radius : float32
+        Scale of the local coordinates
+    nsample : int32
+        Number of neighbors to gather
+    """
+
+    def __init__(self, radius, nsample, use_xyz=True, ret_grouped_xyz=False, normalize_xyz=False, use_feature=False, ret_idx=False):
+        # type: (KNNAndGroup, float, int, bool) -> None
+        super(KNNAndGroup, self).__init__(radius, nsample, use_xyz=use_xyz,
+            ret_grouped_xyz=ret_grouped_xyz, normalize_xyz=normalize_xyz,
+            use_feature=use_feature, ret_idx=ret_idx)
+
+    def query(self, xyz, new_xyz):
+        # type: (KNNAndGroup, torch.Tensor, torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        return knn_query(self.nsample, xyz, new_xyz), None
+
 
 class PairwiseGroup(nn.Module):
     r"""
@@ -469,7 +1186,7 @@ class GroupAll(nn.Module):
             grouped_features = features.unsqueeze(2)
             if self.use_xyz:
                 new_features = torch.cat(
-                    [grouped_xyz, grouped_features], dim=1
+                    [grouped_xyz.to(grouped_features.dtype), grouped_features], dim=1
                 )  # (B, 3 + C, 1, N)
             else:
                 new_features = grouped_features
@@ -4,6 +4,8 @@
 # LICENSE file in the root directory of this source tree.
 
 ''' Modified based on Ref: https://github.com/erikwijmans/Pointnet2_PyTorch '''
+import contextlib
+import copy
 import torch
 import torch.nn as nn
 from typing import List, Tuple
@@ -323,3 +325,179 @@ class BNMomentumScheduler(object):
         self.model.apply(self.setter(self.lmbd(epoch)))
 
 
+def autocast(enabled=True, dtype='float16'):
+    r"""
+    torch.cuda.amp.autocast context when enabled, a no-op context otherwise,
+    so torch builds without amp keep working when mixed precision is off.
+    The pointnet2 gathers and interpolation follow the feature dtype, the
+    geometry ops (FPS, ball query, three_nn) always run in float32.
+
+    Parameters
+    ----------
+    enabled : bool
+        run the block under autocast
+    dtype : str
+        'float16' or 'bfloat16'
+    """
+    if not enabled:
+        return contextlib.suppress()
+    return torch.cuda.amp.autocast(dtype=getattr(torch, dtype))
+
+
+def fold_bn(conv, bn):
+    r"""
+    Fold an eval-mode batch norm into the convolution that feeds it, in place:
+    bn(conv(x)) == conv'(x). Grouped convolutions fold the same way, the
+    scale is per output channel.
+
+    Parameters
+    ----------
+    conv : nn.Conv1d, nn.Conv2d or nn.Conv3d
+    bn : nn.BatchNorm1d, nn.BatchNorm2d or nn.BatchNorm3d
+        must normalize with running statistics
+    """
+    assert bn.track_running_stats and bn.running_var is not None
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            shift = shift * bn.weight + bn.bias
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+        weight = conv.weight * scale.view(-1, *([1] * (conv.weight.dim() - 1)))
+        conv.weight = nn.Parameter(weight.to(conv.weight.dtype))
+        conv.bias = nn.Parameter((bias * scale + shift).to(conv.weight.dtype))
+    return conv
+
+
+def _unwrap_bn(module):
+    # pt_utils.BatchNorm*d wraps the torch module in a one element Sequential
+    if isinstance(module, _BNBase):
+        module = module[0]
+    if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.track_running_stats:
+        return module
+    return None
+
+
+def optimize_for_inference(net):
+    r"""
+    Eval-mode copy of net with every Conv+BatchNorm pair folded into a single
+    convolution. Two layouts are folded:
+
+    * conv followed by bn inside a Sequential (SharedMLP, pt_utils.Conv*d,
+      the fused backbone MLPs), the bn is replaced with nn.Identity
+    * sibling attributes conv<suffix> / bn<suffix> (conv_agg1 / bn_agg1,
+      conv1 / bn1, ...), which the forward passes of this repo always apply
+      as bn<suffix>(conv<suffix>(x)); bn<suffix> becomes nn.Identity
+
+    The activations are left alone: the ReLU modules already run in place
+    and eager PyTorch has no fused conv+relu kernel. export.py --optimize
+    traces the result and, on CPU, runs torch.jit.optimize_for_inference on
+    it, which fuses them. The copy is for inference only, it cannot be
+    trained or loaded from a checkpoint.
+
+    Parameters
+    ----------
+    net : nn.Module
+
+    Returns
+    -------
+    net : nn.Module
+        numerically equivalent module, up to float rounding
+    num_folded : int
+        number of batch norms folded
+    """
+    net = copy.deepcopy(net).eval()
+    num_folded = 0
+    for module in list(net.modules()):
+        children = list(module.named_children())
+        if isinstance(module, nn.Sequential):
+            for (_, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+                if isinstance(conv, nn.modules.conv._ConvNd) and _unwrap_bn(bn) is not None:
+                    fold_bn(conv, _unwrap_bn(bn))
+                    setattr(module, bn_name, nn.Identity())
+                    num_folded += 1
+        else:
+            named = dict(children)
+            for name, bn in children:
+                conv = named.get('conv' + name[2:]) if name.startswith('bn') else None
+                if isinstance(conv, nn.modules.conv._ConvNd) and _unwrap_bn(bn) is not None \
+                        and conv.out_channels == _unwrap_bn(bn).num_features:
+                    fold_bn(conv, _unwrap_bn(bn))
+                    setattr(module, name, nn.Identity())
+                    num_folded += 1
+    return net, num_folded
+
+
+def _is_conv_stack(module):
+    # SharedMLP / _FusedSharedMLP after folding: layers of conv, Identity, ReLU
+    if not isinstance(module, nn.Sequential) or len(module) == 0:
+        return False
+    for layer in module:
+        if not isinstance(layer, nn.Sequential) or len(layer) == 0 or \
+                not isinstance(layer[0], nn.modules.conv._ConvNd):
+            return False
+        if not all(isinstance(m, (nn.modules.conv._ConvNd, nn.Identity, nn.ReLU)) for m in layer):
+            return False
+    return True
+
+
+def _wrap_for_quantization(module, qconfig):
+    count = 0
+    for name, child in module.named_children():
+        if _is_conv_stack(child):
+            for layer in child:
+                names = [n for n, m in layer.named_children() if not isinstance(m, nn.Identity)]
+                if len(names) == 2:
+                    torch.quantization.fuse_modules(layer, [names], inplace=True)
+            count += len(child)
+        elif isinstance(child, nn.modules.conv._ConvNd):
+            count += 1
+        else:
+            count += _wrap_for_quantization(child, qconfig)
+            continue
+        wrapped = torch.quantization.QuantWrapper(child)
+        wrapped.qconfig = qconfig
+        setattr(module, name, wrapped)
+    return count
+
+
+def quantize_for_inference(net, calibrate, backend='fbgemm'):
+    r"""
+    Post-training static int8 quantization of the convolutions of net, for
+    CPU inference. The batch norms are folded first (optimize_for_inference),
+    then every SharedMLP stack runs in int8 end to end, conv and ReLU fused,
+    and every other convolution (the proposal, voting and refine heads) is
+    quantized on its own. Everything else, the pointnet2 geometry ops, the
+    grouping and the decoding, stays in float32: the quantized parts sit
+    between a quantize and a dequantize stub.
+
+    torch.quantization.quantize_dynamic only covers Linear and recurrent
+    layers, so the activation ranges come from calibration instead.
+
+    Parameters
+    ----------
+    net : nn.Module
+    calibrate : callable
+        calibrate(model) runs model on representative inputs (no grad);
+        the observers record the activation ranges
+    backend : str
+        'fbgemm' (x86) or 'qnnpack' (ARM)
+
+    Returns
+    -------
+    net : nn.Module
+        quantized copy of net, on the CPU
+    num_quantized : int
+        number of quantized convolutions
+    """
+    torch.backends.quantized.engine = backend
+    net, _ = optimize_for_inference(net)
+    net = net.cpu()
+    num_quantized = _wrap_for_quantization(
+        net, torch.quantization.get_default_qconfig(backend))
+    torch.quantization.prepare(net, inplace=True)
+    with torch.no_grad():
+        calibrate(net)
+    torch.quantization.convert(net, inplace=True)
+    return net, num_quantized
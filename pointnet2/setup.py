@@ -4,27 +4,45 @@
 # LICENSE file in the root directory of this source tree.
 
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+import torch
+from torch.utils.cpp_extension import BuildExtension, CUDAExtension, CppExtension
 import glob
+import os
 
 _ext_src_root = "_ext_src"
-_ext_sources = glob.glob("{}/src/*.cpp".format(_ext_src_root)) + glob.glob(
-    "{}/src/*.cu".format(_ext_src_root)
-)
+_ext_cpp_sources = glob.glob("{}/src/*.cpp".format(_ext_src_root))
+_ext_cu_sources = glob.glob("{}/src/*.cu".format(_ext_src_root))
 _ext_headers = glob.glob("{}/include/*".format(_ext_src_root))
 
+# Build the CUDA kernels when a GPU toolchain is around (or FORCE_CUDA=1),
+# otherwise fall back to a CPU-only build of the OpenMP kernels.
+_with_cuda = torch.cuda.is_available() or os.getenv("FORCE_CUDA", "0") == "1"
+_include = "-I{}".format("{}/include".format(_ext_src_root))
+
+if _with_cuda:
+    _ext_module = CUDAExtension(
+        name='pointnet2._ext',
+        sources=_ext_cpp_sources + _ext_cu_sources,
+        define_macros=[("WITH_CUDA", None)],
+        extra_compile_args={
+            "cxx": ["-O2", "-fopenmp", _include],
+            "nvcc": ["-O2", _include],
+        },
+        extra_link_args=["-fopenmp"],
+    )
+else:
+    _ext_module = CppExtension(
+        name='pointnet2._ext',
+        sources=_ext_cpp_sources,
+        extra_compile_args={
+            "cxx": ["-O2", "-fopenmp", _include],
+        },
+        extra_link_args=["-fopenmp"],
+    )
+
 setup(
     name='pointnet2',
-    ext_modules=[
-        CUDAExtension(
-            name='pointnet2._ext',
-            sources=_ext_sources,
-            extra_compile_args={
-                "cxx": ["-O2", "-I{}".format("{}/include".format(_ext_src_root))],
-                "nvcc": ["-O2", "-I{}".format("{}/include".format(_ext_src_root))],
-            },
-        )
-    ],
+    ext_modules=[_ext_module],
     cmdclass={
         'build_ext': BuildExtension
     }
@@ -0,0 +1,176 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+""" Post-training int8 quantization of HDNet for CPU inference.
+
+The convolutions (SharedMLP stacks, voting, proposal and refine heads) are
+quantized with pytorch_utils.quantize_for_inference after calibrating on the
+first --num_calib val scenes; the pointnet2 geometry ops stay in float32.
+The float32 and the int8 model are then evaluated on the val set on the CPU,
+the script reports both mAP@0.25 / mAP@0.5, their delta and the speedup.
+
+Sample usage:
+python quantize.py --data_path path/to/sunrgbd --dataset sunrgbd --checkpoint_path log_sunrgbd/checkpoint.tar --dump_dir quant_sunrgbd --use_3d_nms --use_cls_nms --per_class_proposal
+"""
+
+import os
+import sys
+import numpy as np
+import argparse
+import importlib
+import time
+import torch
+from torch.utils.data import DataLoader, Subset
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = BASE_DIR
+sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+from pytorch_utils import optimize_for_inference, quantize_for_inference
+from ap_helper import APCalculator, parse_predictions, parse_groundtruths
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='/scratch/cluster/yanght/Dataset/sunrgbd/', help='path to dataset')
+parser.add_argument('--model', default='hdnet', help='Model file name [default: hdnet]')
+parser.add_argument('--dataset', default='sunrgbd', help='Dataset name. sunrgbd or scannet. [default: sunrgbd]')
+parser.add_argument('--checkpoint_path', default=None, help='Model checkpoint path [default: None]')
+parser.add_argument('--dump_dir', default='quant', help='Dump dir to save the log [default: quant]')
+parser.add_argument('--num_point', type=int, default=20000, help='Point Number [default: 20000]')
+parser.add_argument('--num_target', type=int, default=256, help='Proposal number [default: 256]')
+parser.add_argument('--batch_size', type=int, default=8, help='Batch Size during evaluation [default: 8]')
+parser.add_argument('--vote_factor', type=int, default=1, help='Number of votes generated from each seed [default: 1]')
+parser.add_argument('--cluster_sampling', default='vote_fps', help='Sampling strategy for vote clusters: vote_fps, seed_fps, random [default: vote_fps]')
+parser.add_argument('--ap_iou_thresh', type=float, default=0.25, help='AP IoU threshold [default: 0.25]')
+parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
+parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
+parser.add_argument('--use_sunrgbd_v2', action='store_true', help='Use SUN RGB-D V2 box labels.')
+parser.add_argument('--use_3d_nms', action='store_true', help='Use 3D NMS instead of 2D NMS.')
+parser.add_argument('--use_cls_nms', action='store_true', help='Use per class NMS.')
+parser.add_argument('--use_old_type_nms', action='store_true', help='Use old type of NMS, IoBox2Area.')
+parser.add_argument('--per_class_proposal', action='store_true', help='Duplicate each proposal num_class times.')
+parser.add_argument('--nms_iou', type=float, default=0.25, help='NMS IoU threshold. [default: 0.25]')
+parser.add_argument('--conf_thresh', type=float, default=0.05, help='Filter out predictions with obj prob less than it. [default: 0.05]')
+parser.add_argument('--num_calib', type=int, default=200, help='Number of val scenes used for calibration [default: 200]')
+parser.add_argument('--num_eval', type=int, default=None, help='Evaluate on the first num_eval val scenes only [default: all]')
+parser.add_argument('--backend', default='fbgemm', help='Quantized engine: fbgemm (x86) or qnnpack (ARM) [default: fbgemm]')
+FLAGS = parser.parse_args()
+
+if FLAGS.use_cls_nms:
+    assert(FLAGS.use_3d_nms)
+
+DUMP_DIR = FLAGS.dump_dir
+if not os.path.exists(DUMP_DIR): os.mkdir(DUMP_DIR)
+DUMP_FOUT = open(os.path.join(DUMP_DIR, 'log_quantize.txt'), 'w')
+DUMP_FOUT.write(str(FLAGS)+'\n')
+def log_string(out_str):
+    DUMP_FOUT.write(out_str+'\n')
+    DUMP_FOUT.flush()
+    print(out_str)
+
+if FLAGS.dataset == 'sunrgbd':
+    sys.path.append(os.path.join(ROOT_DIR, 'sunrgbd'))
+    from sunrgbd_detection_dataset_hd import SunrgbdDetectionVotesDataset, MAX_NUM_OBJ
+    from model_util_sunrgbd import SunrgbdDatasetConfig
+    DATASET_CONFIG = SunrgbdDatasetConfig()
+    TEST_DATASET = SunrgbdDetectionVotesDataset(FLAGS.data_path, 'val', num_points=FLAGS.num_point,
+        augment=False, use_color=FLAGS.use_color, use_height=(not FLAGS.no_height),
+        use_v1=(not FLAGS.use_sunrgbd_v2))
+elif FLAGS.dataset == 'scannet':
+    sys.path.append(os.path.join(ROOT_DIR, 'scannet'))
+    from scannet_detection_dataset_hd import ScannetDetectionDataset, MAX_NUM_OBJ
+    from model_util_scannet import ScannetDatasetConfig
+    DATASET_CONFIG = ScannetDatasetConfig()
+    TEST_DATASET = ScannetDetectionDataset(FLAGS.data_path, 'val', num_points=FLAGS.num_point,
+                                           augment=False, use_angle=False,
+                                           use_color=FLAGS.use_color, use_height=(not FLAGS.no_height))
+else:
+    print('Unknown dataset %s. Exiting...'%(FLAGS.dataset))
+    exit(-1)
+
+CALIB_DATALOADER = DataLoader(Subset(TEST_DATASET, range(min(FLAGS.num_calib, len(TEST_DATASET)))),
+    batch_size=FLAGS.batch_size, shuffle=False, num_workers=4)
+EVAL_DATASET = TEST_DATASET if FLAGS.num_eval is None else \
+    Subset(TEST_DATASET, range(min(FLAGS.num_eval, len(TEST_DATASET))))
+EVAL_DATALOADER = DataLoader(EVAL_DATASET, batch_size=FLAGS.batch_size, shuffle=False, num_workers=4)
+
+CONFIG_DICT = {'remove_empty_box':False, 'use_3d_nms':FLAGS.use_3d_nms,
+    'nms_iou':FLAGS.nms_iou, 'use_old_type_nms':FLAGS.use_old_type_nms, 'cls_nms':FLAGS.use_cls_nms,
+    'per_class_proposal':FLAGS.per_class_proposal, 'conf_thresh':FLAGS.conf_thresh,
+    'dataset_config':DATASET_CONFIG}
+
+
+def build_net():
+    MODEL = importlib.import_module(FLAGS.model)
+    num_input_channel = int(FLAGS.use_color)*3 + int(not FLAGS.no_height)*1
+    net = MODEL.HDNet(num_class=DATASET_CONFIG.num_class,
+                      num_heading_bin=DATASET_CONFIG.num_heading_bin,
+                      num_size_cluster=DATASET_CONFIG.num_size_cluster,
+                      mean_size_arr=DATASET_CONFIG.mean_size_arr,
+                      num_proposal=FLAGS.num_target,
+                      input_feature_dim=num_input_channel,
+                      vote_factor=FLAGS.vote_factor,
+                      sampling=FLAGS.cluster_sampling)
+    if FLAGS.checkpoint_path is not None and os.path.isfile(FLAGS.checkpoint_path):
+        checkpoint = torch.load(FLAGS.checkpoint_path, map_location='cpu')
+        net.load_state_dict(checkpoint['model_state_dict'])
+        log_string('Loaded checkpoint %s (epoch: %d)'%(FLAGS.checkpoint_path, checkpoint['epoch']))
+    else:
+        log_string('No checkpoint given, quantizing randomly initialized weights')
+    net.eval()
+    return net
+
+
+def calibrate(net):
+    for batch_idx, batch_data_label in enumerate(CALIB_DATALOADER):
+        net({'point_clouds': batch_data_label['point_clouds']}, {})
+
+
+def evaluate(net, name):
+    r"""
+    mAP@ap_iou_thresh and mAP@2*ap_iou_thresh of net on EVAL_DATALOADER and
+    the total forward time in seconds (data loading and NMS excluded)
+    """
+    ap_calculator = APCalculator(ap_iou_thresh=FLAGS.ap_iou_thresh,
+        class2type_map=DATASET_CONFIG.class2type)
+    ap_calculator_l = APCalculator(ap_iou_thresh=FLAGS.ap_iou_thresh*2,
+        class2type_map=DATASET_CONFIG.class2type)
+    forward_time = 0
+    for batch_idx, batch_data_label in enumerate(EVAL_DATALOADER):
+        with torch.no_grad():
+            tic = time.time()
+            end_points = net({'point_clouds': batch_data_label['point_clouds']}, {})
+            forward_time += time.time() - tic
+        for key in batch_data_label:
+            end_points[key] = batch_data_label[key]
+        batch_gt_map_cls = parse_groundtruths(end_points, CONFIG_DICT)
+        batch_pred_map_cls = parse_predictions(end_points, CONFIG_DICT, opt_ang=(FLAGS.dataset == 'sunrgbd'))
+        ap_calculator.step(batch_pred_map_cls, batch_gt_map_cls)
+        ap_calculator_l.step(batch_pred_map_cls, batch_gt_map_cls)
+    maps = (ap_calculator.compute_metrics()['mAP'], ap_calculator_l.compute_metrics()['mAP'])
+    log_string('%-6s mAP@%.2f %.4f, mAP@%.2f %.4f, forward %.1fs (%.1f ms / scene)'
+               % (name, FLAGS.ap_iou_thresh, maps[0], FLAGS.ap_iou_thresh*2, maps[1],
+                  forward_time, forward_time / len(EVAL_DATASET) * 1000))
+    return maps, forward_time
+
+
+def quantize():
+    np.random.seed(0)
+    torch.manual_seed(0)
+    log_string('%d threads, %d calibration scenes, %d eval scenes'
+               % (torch.get_num_threads(), len(CALIB_DATALOADER.dataset), len(EVAL_DATASET)))
+    net = build_net()
+    # the float32 reference has its batch norms folded too, so the speedup is int8 only
+    fp32_net, _ = optimize_for_inference(net)
+    int8_net, num_quantized = quantize_for_inference(net, calibrate, FLAGS.backend)
+    log_string('Quantized %d convolutions' % num_quantized)
+
+    fp32_maps, fp32_time = evaluate(fp32_net, 'fp32')
+    int8_maps, int8_time = evaluate(int8_net, 'int8')
+    log_string('delta mAP@%.2f %+.4f, delta mAP@%.2f %+.4f, CPU speedup %.2fx'
+               % (FLAGS.ap_iou_thresh, int8_maps[0] - fp32_maps[0],
+                  FLAGS.ap_iou_thresh*2, int8_maps[1] - fp32_maps[1], fp32_time / int8_time))
+
+
+if __name__=='__main__':
+    quantize()
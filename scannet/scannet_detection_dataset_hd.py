@@ -19,6 +19,7 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 import pc_util
 from model_util_scannet import rotate_aligned_boxes
 from model_util_scannet import ScannetDatasetConfig
+from box_util import get_surface_line_points_batch
 
 DC = ScannetDatasetConfig()
 MAX_NUM_OBJ = 128
@@ -467,6 +468,11 @@ class ScannetDetectionDataset(Dataset):
         ret_dict['center_label'] = target_bboxes.astype(np.float32)[:,0:3]
         ret_dict['size_label'] = target_bboxes.astype(np.float32)[:,3:6]
         ret_dict['heading_label'] = angle_label.astype(np.float32)
+        # GT face/edge centers of the augmented boxes, used by the loss
+        gt_surface_center, gt_line_center = get_surface_line_points_batch(
+            ret_dict['size_label'], ret_dict['heading_label'], ret_dict['center_label'])
+        ret_dict['gt_surface_center'] = gt_surface_center.astype(np.float32)
+        ret_dict['gt_line_center'] = gt_line_center.astype(np.float32)
         ret_dict['heading_class_label'] = angle_classes.astype(np.int64)
         ret_dict['heading_residual_label'] = angle_residuals.astype(np.float32)
         ret_dict['size_class_label'] = size_classes.astype(np.int64)
@@ -31,6 +31,7 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 import pc_util
 import sunrgbd_utils
 from sunrgbd_utils import extract_pc_in_box3d
+from box_util import get_surface_line_points_batch
 from model_util_sunrgbd import SunrgbdDatasetConfig
 
 DC = SunrgbdDatasetConfig() # dataset specific config
@@ -626,6 +627,11 @@ class SunrgbdDetectionVotesDataset(Dataset):
         # new items
         ret_dict['size_label'] = box3d_sizes.astype(np.float32)
         ret_dict['heading_label'] = box3d_angles.astype(np.float32)
+        # GT face/edge centers of the augmented boxes, used by the loss
+        gt_surface_center, gt_line_center = get_surface_line_points_batch(
+            ret_dict['size_label'], ret_dict['heading_label'], ret_dict['center_label'])
+        ret_dict['gt_surface_center'] = gt_surface_center.astype(np.float32)
+        ret_dict['gt_line_center'] = gt_line_center.astype(np.float32)
         if self.use_height:
             ret_dict['floor_height'] = floor_height
 
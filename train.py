@@ -35,7 +35,7 @@ ROOT_DIR = BASE_DIR
 sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
 sys.path.append(os.path.join(ROOT_DIR, 'models'))
-from pytorch_utils import BNMomentumScheduler
+from pytorch_utils import BNMomentumScheduler, autocast
 from tf_visualizer import Visualizer as TfVisualizer
 from ap_helper import APCalculator, parse_predictions, parse_groundtruths
 from pc_util import compute_iou
@@ -72,9 +72,17 @@ parser.add_argument('--get_data', action='store_true', help='Use support relatio
 parser.add_argument('--use_sunrgbd_v2', action='store_true', help='Use V2 box labels for SUN RGB-D dataset')
 parser.add_argument('--overwrite', action='store_true', help='Overwrite existing log and dump folders.')
 parser.add_argument('--dump_results', action='store_true', help='Dump results.')
+parser.add_argument('--amp', action='store_true', help='Run the network under autocast (mixed precision).')
+parser.add_argument('--amp_dtype', default='float16', help='Autocast dtype: float16 or bfloat16 [default: float16]')
+parser.add_argument('--max_group_elems', type=int, default=None, help='Memory budget of the chunked backbone set abstraction, needs --freeze_backbone_bn to apply in training [default: None]')
+parser.add_argument('--freeze_backbone_bn', action='store_true', help='Keep the backbone batch norms at their running stats (fine-tuning).')
+parser.add_argument('--nn_distance_max_elems', type=int, default=None, help='Cap on the pairwise tile of nn_distance in the losses [default: nn_distance.MAX_TILE_ELEMS]')
 FLAGS = parser.parse_args()
 
 # ------------------------------------------------------------------------- GLOBAL CONFIG BEG
+if FLAGS.nn_distance_max_elems is not None:
+    import nn_distance
+    nn_distance.MAX_TILE_ELEMS = FLAGS.nn_distance_max_elems
 BATCH_SIZE = FLAGS.batch_size
 NUM_POINT = FLAGS.num_point
 MAX_EPOCH = FLAGS.max_epoch
@@ -179,7 +187,10 @@ net = Detector(num_class=DATASET_CONFIG.num_class,
                input_feature_dim=num_input_channel,
                vote_factor=FLAGS.vote_factor,
                sampling=FLAGS.cluster_sampling,
-               with_angle=(FLAGS.dataset == 'sunrgbd'))
+               with_angle=(FLAGS.dataset == 'sunrgbd'),
+               max_group_elems=FLAGS.max_group_elems)
+if FLAGS.freeze_backbone_bn:
+    net.freeze_backbone_bn()
 
 if torch.cuda.device_count() > 1:
   log_string("Let's use %d GPUs!" % (torch.cuda.device_count()))
@@ -192,13 +203,20 @@ criterion = MODEL.get_loss
 # Load the Adam optimizer
 optimizer = optim.Adam(net.parameters(), lr=BASE_LEARNING_RATE, weight_decay=FLAGS.weight_decay)
 
+# Loss scaling is only needed for float16, bfloat16 has the float32 range
+USE_SCALER = FLAGS.amp and FLAGS.amp_dtype == 'float16'
+if USE_SCALER:
+    scaler = torch.cuda.amp.GradScaler()
+
 # Load checkpoint if there is any
 it = -1 # for the initialize value of `LambdaLR` and `BNMomentumScheduler`
 start_epoch = 0
 if CHECKPOINT_PATH is not None and os.path.isfile(CHECKPOINT_PATH):
-    checkpoint = torch.load(CHECKPOINT_PATH)
+    checkpoint = torch.load(CHECKPOINT_PATH, map_location=device)
     net.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if USE_SCALER and 'scaler_state_dict' in checkpoint:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
     start_epoch = checkpoint['epoch']
     log_string("-> loaded checkpoint %s (epoch: %d)"%(CHECKPOINT_PATH, start_epoch))
 
@@ -252,7 +270,8 @@ def train_one_epoch():
         # Forward pass
         inputs = {'point_clouds': batch_data_label['point_clouds']}
         optimizer.zero_grad()
-        end_points = net(inputs, end_points)            
+        with autocast(FLAGS.amp, FLAGS.amp_dtype):
+            end_points = net(inputs, end_points)
 
         # Compute loss and gradients, update parameters.
         for key in batch_data_label:
@@ -261,8 +280,13 @@ def train_one_epoch():
 
         loss, end_points = criterion(inputs, end_points, DATASET_CONFIG)
 
-        loss.backward()
-        optimizer.step()
+        if USE_SCALER:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
         
         # Accumulate statistics and print out
         for key in end_points:
@@ -301,7 +325,7 @@ def evaluate_one_epoch():
         inputs = {'point_clouds': batch_data_label['point_clouds']}
 
         tic = time.time()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(FLAGS.amp, FLAGS.amp_dtype):
             end_points = net(inputs, end_points)
         toc = time.time()
         t = toc - tic
@@ -383,6 +407,8 @@ def train(start_epoch):
                          'optimizer_state_dict': optimizer.state_dict(),
                          'loss': loss,
             }
+            if USE_SCALER:
+                save_dict['scaler_state_dict'] = scaler.state_dict()
             try: # with nn.DataParallel() the net is added as a submodule of DataParallel
                 save_dict['model_state_dict'] = net.module.state_dict()
             except:
@@ -213,7 +213,7 @@ def roty_batch_pytorch(t):
     return: (x1,x2,...,xn,3,3)
     """
     input_shape = t.shape
-    output = torch.zeros(tuple(list(input_shape)+[3,3])).cuda()
+    output = torch.zeros(tuple(list(input_shape)+[3,3]), device=t.device)
     c = torch.cos(t)
     s = torch.sin(t)
     output[...,0,0] = c
@@ -230,7 +230,7 @@ def rotz_batch_pytorch(t):
     return: (x1,x2,...,xn,3,3)
     """
     input_shape = t.shape
-    output = torch.zeros(tuple(list(input_shape)+[3,3])).cuda()
+    output = torch.zeros(tuple(list(input_shape)+[3,3]), device=t.device)
     c = torch.cos(t)
     s = torch.sin(t)
     output[...,0,0] = c
@@ -279,89 +279,77 @@ def get_3d_box_batch(box_size, heading_angle, center):
     corners_3d = np.matmul(corners_3d, np.transpose(R, tuple(tlist)))
     corners_3d += np.expand_dims(center, -2)
     return corners_3d
-'''
-def get_surface_line_points_batch_pytorch(box_size, heading_angle, center):
-    input_shape = heading_angle.shape
-    R = roty_batch_pytorch(heading_angle.float())
-    l = box_size[...,0].unsqueeze(-1) # [x1,...,xn,1]
-    w = box_size[...,1].unsqueeze(-1)
-    h = box_size[...,2].unsqueeze(-1)
-
-    surface_3d = torch.zeros(tuple(list(input_shape)+[6,3])).cuda()
-    surface_3d[...,0] = torch.cat((torch.zeros_like(l),torch.zeros_like(l),l/2,-l/2,torch.zeros_like(l),torch.zeros_like(l)), -1)
-    surface_3d[...,1] = torch.cat((torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l),w/2,-w/2), -1)
-    surface_3d[...,2] = torch.cat((h/2,-h/2,torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l)), -1)
-    
-    surface_3d = torch.matmul(surface_3d, R.transpose(3,2))
-    surface_3d += center.unsqueeze(-2)
 
-    line_3d = torch.zeros(tuple(list(input_shape)+[12,3])).cuda()
-    line_3d[...,0] = torch.cat((torch.zeros_like(l),torch.zeros_like(l),l/2,-l/2,torch.zeros_like(l),torch.zeros_like(l),l/2,-l/2,l/2,-l/2,l/2,-l/2), -1)
-    line_3d[...,1] = torch.cat((w/2,-w/2,torch.zeros_like(l),torch.zeros_like(l),w/2,-w/2,torch.zeros_like(l),torch.zeros_like(l),w/2,-w/2,-w/2,w/2), -1)
-    line_3d[...,2] = torch.cat((h/2,h/2,h/2,h/2,-h/2,-h/2,-h/2,-h/2,torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l),torch.zeros_like(l)), -1)
-    
-    line_3d = torch.matmul(line_3d, R.transpose(3,2))
-    line_3d += center.unsqueeze(-2)
-    
-    return surface_3d.view(input_shape[0], input_shape[1]*6, 3).contiguous(), line_3d.view(input_shape[0], input_shape[1]*12, 3).contiguous()
-'''
-def get_surface_line_points_batch_pytorch(obj_size, heading_angle, center):
-    ''' box_size: [x1,x2,...,xn,3]
-        heading_angle: [x1,x2,...,xn], clockwise, sunrgbd's angle is clockwise
+# Face and edge centers of a unit box, in the order of
+# get_surface_line_points_batch_pytorch: upper, lower, front, back, left,
+# right faces, then the 4 upper, 4 lower and 4 vertical edges. Columns are
+# multiplied by the box size (l, w, h).
+SURFACE_OFFSETS = np.array([[0,0,0.5], [0,0,-0.5], [0,0.5,0], [0,-0.5,0], [0.5,0,0], [-0.5,0,0]])
+LINE_OFFSETS = np.array([[0.5,0,0.5], [-0.5,0,0.5], [0,0.5,0.5], [0,-0.5,0.5],
+                         [0.5,0,-0.5], [-0.5,0,-0.5], [0,0.5,-0.5], [0,-0.5,-0.5],
+                         [0.5,0.5,0], [0.5,-0.5,0], [-0.5,0.5,0], [-0.5,-0.5,0]])
+PRIMITIVE_OFFSETS = np.concatenate((SURFACE_OFFSETS, LINE_OFFSETS), 0) # (18,3)
+
+def get_surface_line_points_batch(box_size, heading_angle, center):
+    ''' Numpy version of get_surface_line_points_batch_pytorch, per box.
+        box_size: [x1,x2,...,xn,3]
+        heading_angle: [x1,x2,...,xn], clockwise, rotated with rotz(-heading_angle)
         center: [x1,x2,...,xn,3]
     Return:
-        [x1,x3,...,xn,8,3]
+        surface_center: [x1,x2,...,xn,6,3]
+        line_center: [x1,x2,...,xn,12,3]
     '''
-    input_shape = heading_angle.shape
-    R = rotz_batch_pytorch(-heading_angle.float()) #### Add the rotz here, clockwise to counter-clockwise
-
-    offset_x = torch.zeros_like(obj_size)
-    offset_y = torch.zeros_like(obj_size)
-    offset_z = torch.zeros_like(obj_size)
-    offset_x[:,:,0] = 0.5#obj_size[:,:,0] / 2.0
-    offset_y[:,:,1] = 0.5#obj_size[:,:,1] / 2.0
-    offset_z[:,:,2] = 0.5#obj_size[:,:,2] / 2.0
-    
-    obj_upper_surface_center = offset_z * obj_size
-    obj_lower_surface_center = -offset_z * obj_size
-    
-    obj_front_surface_center = offset_y * obj_size
-    obj_back_surface_center = -offset_y * obj_size
-    
-    obj_left_surface_center = offset_x * obj_size
-    obj_right_surface_center = -offset_x * obj_size
-    # (B, 6*N, 3)
-    surface_3d = torch.cat((obj_upper_surface_center, obj_lower_surface_center, obj_front_surface_center, obj_back_surface_center, obj_left_surface_center, obj_right_surface_center), dim=1)
-
-    ## Get the object line center here
-    obj_line_center_0 = offset_z * obj_size + offset_x * obj_size
-    obj_line_center_1 = offset_z * obj_size - offset_x * obj_size
-    obj_line_center_2 = offset_z * obj_size + offset_y * obj_size
-    obj_line_center_3 = offset_z * obj_size - offset_y * obj_size
-    
-    obj_line_center_4 = - offset_z * obj_size + offset_x * obj_size
-    obj_line_center_5 = - offset_z * obj_size - offset_x * obj_size
-    obj_line_center_6 = - offset_z * obj_size + offset_y * obj_size
-    obj_line_center_7 = - offset_z * obj_size - offset_y * obj_size
-    
-    obj_line_center_8 = offset_x * obj_size + offset_y * obj_size
-    obj_line_center_9 = offset_x * obj_size - offset_y * obj_size
-    obj_line_center_10 = - offset_x * obj_size + offset_y * obj_size
-    obj_line_center_11 = - offset_x * obj_size - offset_y * obj_size
-    # (B, 12*N, 3)
-    line_3d = torch.cat((obj_line_center_0, obj_line_center_1, obj_line_center_2, obj_line_center_3, obj_line_center_4, obj_line_center_5, obj_line_center_6, obj_line_center_7, obj_line_center_8, obj_line_center_9, obj_line_center_10, obj_line_center_11), dim=1)
-    
-    surface_rot = R.repeat(1,6,1,1)
-    surface_3d = torch.matmul(surface_3d.unsqueeze(-2), surface_rot.transpose(3,2)).squeeze(-2)
-    surface_center = center.repeat(1,6,1) + surface_3d#.transpose(2,1).contiguous().view(input_shape[0],6*input_shape[1],3)
-
-    line_rot = R.repeat(1,12,1,1)
-    line_3d = torch.matmul(line_3d.unsqueeze(-2), line_rot.transpose(3,2)).squeeze(-2)
-    line_center = center.repeat(1,12,1) + line_3d#.transpose(2,1).contiguous().view(input_shape[0],12*input_shape[1],3)
-    
-    return surface_center, line_center
+    c = np.cos(-heading_angle)[...,np.newaxis,np.newaxis]
+    s = np.sin(-heading_angle)[...,np.newaxis,np.newaxis]
+    ret = []
+    for offsets in [SURFACE_OFFSETS, LINE_OFFSETS]:
+        local = offsets * np.expand_dims(box_size, -2) # [x1,...,xn,6 or 12,3]
+        rotated = np.stack((c[...,0]*local[...,0] - s[...,0]*local[...,1],
+                            s[...,0]*local[...,0] + c[...,0]*local[...,1],
+                            local[...,2]), -1)
+        ret.append(rotated + np.expand_dims(center, -2))
+    return ret[0], ret[1]
+
+def get_surface_line_points_batch_pytorch(obj_size, heading_angle, center, fused=False):
+    ''' Face and edge centers of a batch of boxes: the PRIMITIVE_OFFSETS template
+        scaled by the box size, rotated with rotz(-heading_angle) and moved to the
+        center in one broadcasted einsum.
+        obj_size: (B,N,3)
+        heading_angle: (B,N), clockwise, sunrgbd's angle is clockwise
+        center: (B,N,3)
+    Return:
+        surface_center: (B,6*N,3), line_center: (B,12*N,3), index j*N+n is
+        primitive j of box n; or (B,18*N,3), both concatenated, if fused
+    '''
+    B, N = heading_angle.shape
+    R = rotz_batch_pytorch(-heading_angle.float()) # (B,N,3,3)
+    template = torch.from_numpy(PRIMITIVE_OFFSETS).to(obj_size)
+    local = template.view(1,18,1,3) * obj_size.unsqueeze(1) # (B,18,N,3)
+    points = torch.einsum('bnij,bpnj->bpni', R, local) + center.unsqueeze(1)
+    points = points.reshape(B, 18*N, 3)
+    if fused:
+        return points
+    return points[:,:6*N], points[:,6*N:]
+
+def check_surface_line_points():
+    ''' Torch generator, split and fused, against the numpy version used by
+    the datasets. pointnet2/benchmark.py primitives also compares it with
+    the former per-primitive implementation. '''
+    torch.manual_seed(0)
+    obj_size = torch.rand(2, 64, 3) + 0.1
+    heading_angle = (torch.rand(2, 64) - 0.5) * 2 * np.pi
+    center = torch.rand(2, 64, 3) * 5
+    out = get_surface_line_points_batch_pytorch(obj_size, heading_angle, center)
+    fused = get_surface_line_points_batch_pytorch(obj_size, heading_angle, center, fused=True)
+    surface, line = get_surface_line_points_batch(obj_size.numpy(), heading_angle.numpy(), center.numpy())
+    surface = torch.from_numpy(surface).float().transpose(1,2).reshape(2, 6*64, 3)
+    line = torch.from_numpy(line).float().transpose(1,2).reshape(2, 12*64, 3)
+    print('max abs diff to numpy: split %g, fused %g' % (
+        max((a - b).abs().max().item() for a, b in zip(out, (surface, line))),
+        (fused - torch.cat((surface, line), 1)).abs().max().item()))
  
 if __name__=='__main__':
+    check_surface_line_points()
 
     # Function for polygon ploting
     import matplotlib